@@ -5,8 +5,11 @@ from gevent import monkey, get_hub
 from gevent.hub import LoopExit
 monkey.patch_all()
 
+import os
 import signal
+import time
 import gevent
+import gevent.event
 import gevent.pool
 from rq import Worker
 from rq.job import Status
@@ -16,6 +19,9 @@ from rq.exceptions import DequeueTimeout
 from rq.logutils import setup_loghandlers
 from rq.version import VERSION
 
+# Idle heartbeats are written at most this often, in seconds
+HEARTBEAT_INTERVAL = 10
+
 
 class GeventDeathPenalty(BaseDeathPenalty):
     def setup_death_penalty(self):
@@ -34,7 +40,13 @@ class GeventWorker(Worker):
         pool_size = 4
         if 'pool_size' in kwargs:
             pool_size = kwargs.pop('pool_size')
+        # With prefetch the next job is dequeued while the pool is still
+        # full, so it starts as soon as a greenlet finishes
+        self.prefetch = kwargs.pop('prefetch', os.environ.get('RQ_PREFETCH') == 'True')
         self.gevent_pool = gevent.pool.Pool(pool_size)
+        self.slot_freed = gevent.event.Event()
+        self._last_heartbeat = 0
+        self._last_pool_len = None
         super(GeventWorker, self).__init__(*args, **kwargs)
 
     def register_birth(self):
@@ -42,8 +54,18 @@ class GeventWorker(Worker):
         self.connection.hset(self.key, 'pool_size', self.gevent_pool.size)
 
     def heartbeat(self, timeout=0):
+        # Skip idle heartbeats that would write nothing new to Redis. Job
+        # specific timeouts and pool size changes always go through.
+        pool_len = len(self.gevent_pool)
+        now = time.time()
+        if (timeout == 0 and pool_len == self._last_pool_len and
+                now - self._last_heartbeat < HEARTBEAT_INTERVAL):
+            return
+        self._last_heartbeat = now
+        self._last_pool_len = pool_len
+
         super(GeventWorker, self).heartbeat(timeout)
-        self.connection.hset(self.key, 'curr_pool_len', len(self.gevent_pool))
+        self.connection.hset(self.key, 'curr_pool_len', pool_len)
 
     def _install_signal_handlers(self):
         def request_force_stop():
@@ -119,6 +141,7 @@ class GeventWorker(Worker):
     def execute_job(self, job, queue):
         def job_done(child):
             self.did_perform_work = True
+            self.slot_freed.set()
             self.heartbeat()
             if job.get_status() == Status.FINISHED:
                 queue.enqueue_dependents(job)
@@ -126,10 +149,25 @@ class GeventWorker(Worker):
         child_greenlet = self.gevent_pool.spawn(self.perform_job, job)
         child_greenlet.link(job_done)
 
+    def wait_for_free_slot(self):
+        """
+        Block until the pool has room for another greenlet. Finished jobs
+        wake us through slot_freed instead of the loop polling the pool.
+        """
+        while self.gevent_pool.full():
+            self.slot_freed.clear()
+            self.slot_freed.wait(HEARTBEAT_INTERVAL)
+            self.heartbeat()
+            if self._stopped:
+                raise StopRequested()
+
     def dequeue_job_and_maintain_ttl(self, timeout):
         if self._stopped:
             raise StopRequested()
 
+        if not self.prefetch:
+            self.wait_for_free_slot()
+
         result = None
         while True:
             if self._stopped:
@@ -137,11 +175,6 @@ class GeventWorker(Worker):
 
             self.heartbeat()
 
-            while self.gevent_pool.full():
-                gevent.sleep(0.1)
-                if self._stopped:
-                    raise StopRequested()
-
             try:
                 result = self.queue_class.dequeue_any(self.queues, timeout, connection=self.connection)
                 if result is not None:
@@ -152,6 +185,16 @@ class GeventWorker(Worker):
             except DequeueTimeout:
                 pass
 
+        if self.prefetch and result is not None:
+            try:
+                self.wait_for_free_slot()
+            except StopRequested:
+                # hand the prefetched job back for another worker, at the
+                # head of the queue where it was taken from: push_job_id
+                # appends and the queue dequeues from the left
+                job, queue = result
+                queue.connection.lpush(queue.key, job.id)
+                raise
+
         self.heartbeat()
         return result
-
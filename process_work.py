@@ -0,0 +1,270 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import multiprocessing
+import os
+import signal
+import threading
+
+from rq import Worker
+from rq.job import Job, Status
+from rq.worker import StopRequested, green, blue
+from rq.exceptions import DequeueTimeout
+from rq.logutils import setup_loghandlers
+from rq.utils import import_attribute
+from rq.version import VERSION
+
+# Longest time the parent blocks on Redis or on a busy pool before it
+# reaps finished jobs and refreshes its heartbeat
+REAP_INTERVAL = 5
+
+
+class PoolChildWorker(Worker):
+    """
+    Performs jobs inside a pool process. The parent ProcessPoolWorker owns
+    the worker key in Redis, so state and heartbeat updates from here are
+    skipped instead of registering a worker per pool process.
+    """
+    def set_state(self, state, pipeline=None):
+        pass
+
+    def heartbeat(self, timeout=0, pipeline=None):
+        pass
+
+    def set_current_job_id(self, job_id, pipeline=None):
+        pass
+
+    def procline(self, message):
+        pass
+
+
+_child_worker = None
+
+
+def _init_child(connection_class, connection_kwargs, queue_names):
+    """
+    Runs once in each pool process after the fork. Redis sockets must not
+    be shared across processes, so each child opens its own connection.
+    """
+    global _child_worker
+    # Shutdown is coordinated by the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    connection = connection_class(**connection_kwargs)
+    _child_worker = PoolChildWorker(queue_names, connection=connection)
+
+
+def _perform_job(job_id):
+    """
+    Fetch and perform one job in a pool process. perform_job records the
+    result or failure on the job itself, this only reports back the id.
+    """
+    try:
+        job = Job.fetch(job_id, connection=_child_worker.connection)
+        _child_worker.perform_job(job)
+    except Exception:
+        _child_worker.log.exception('Could not perform job %s' % job_id)
+    return job_id
+
+
+class ProcessPoolWorker(Worker):
+    """
+    An RQ worker running jobs in a pre-forked pool of processes, one per
+    CPU by default, so CPU-bound jobs use every core of the host.
+
+    Pass preload, a callable or the dotted path of one (also read from the
+    RQ_WORKER_PRELOAD environment variable), to load data such as the
+    microdata in the parent before the pool forks. Every pool process then
+    shares it copy-on-write.
+    """
+    def __init__(self, *args, **kwargs):
+        pool_size = kwargs.pop('pool_size', None) or \
+            int(os.environ.get('RQ_POOL_SIZE', multiprocessing.cpu_count()))
+        preload = kwargs.pop('preload', None) or os.environ.get('RQ_WORKER_PRELOAD')
+        if isinstance(preload, basestring):
+            preload = import_attribute(preload)
+        self.pool_size = pool_size
+        self.preload = preload
+        self.process_pool = None
+        self.in_flight = {}
+        # Ids of jobs whose pool process has finished, added by the pool's
+        # result thread. Reaping goes by these rather than by ready(): in
+        # Python 2 the callback runs before the result is marked ready.
+        self.done_ids = set()
+        self.slot_freed = threading.Condition()
+        super(ProcessPoolWorker, self).__init__(*args, **kwargs)
+
+    def register_birth(self):
+        super(ProcessPoolWorker, self).register_birth()
+        self.connection.hset(self.key, 'pool_size', self.pool_size)
+
+    def heartbeat(self, timeout=0):
+        super(ProcessPoolWorker, self).heartbeat(timeout)
+        self.connection.hset(self.key, 'curr_pool_len', len(self.in_flight))
+
+    def start_pool(self):
+        if self.preload is not None:
+            self.log.info('Preloading with %s' % self.preload)
+            self.preload()
+
+        connection_kwargs = self.connection.connection_pool.connection_kwargs
+        queue_names = [queue.name for queue in self.queues]
+        self.process_pool = multiprocessing.Pool(
+            self.pool_size, _init_child,
+            (type(self.connection), connection_kwargs, queue_names))
+
+    def stop_pool(self, force=False):
+        if self.process_pool is None:
+            return
+        if force:
+            self.process_pool.terminate()
+        else:
+            self.process_pool.close()
+        self.process_pool.join()
+        self.reap()
+
+    def _install_signal_handlers(self):
+        def request_force_stop(signum, frame):
+            self.log.warning('Cold shut down.')
+            self.stop_pool(force=True)
+            raise SystemExit()
+
+        def request_stop(signum, frame):
+            signal.signal(signal.SIGINT, request_force_stop)
+            signal.signal(signal.SIGTERM, request_force_stop)
+
+            self.log.warning('Warm shut down requested.')
+            self.log.warning('Stopping after all running jobs are finished. '
+                             'Press Ctrl+C again for a cold shutdown.')
+            self._stopped = True
+            with self.slot_freed:
+                self.slot_freed.notify()
+
+        signal.signal(signal.SIGINT, request_stop)
+        signal.signal(signal.SIGTERM, request_stop)
+
+    def work(self, burst=False):
+        """Starts the work loop.
+        Pops jobs from the queues and hands them to the process pool while
+        it has free processes. When all queues are empty, block and wait for
+        new jobs to arrive on any of the queues, unless `burst` mode is
+        enabled.
+        The return value indicates whether any jobs were processed.
+        """
+        setup_loghandlers()
+        self._install_signal_handlers()
+
+        self.did_perform_work = False
+        self.register_birth()
+        self.log.info('RQ worker started, version %s' % VERSION)
+        self.set_state('starting')
+        self.start_pool()
+        try:
+            while True:
+                if self.stopped:
+                    self.log.info('Stopping on request.')
+                    break
+
+                timeout = None if burst else max(1, self.default_worker_ttl - 60)
+                try:
+                    result = self.dequeue_job_and_maintain_ttl(timeout)
+
+                    if result is None and burst:
+                        # Let running jobs finish so their dependents are
+                        # enqueued before checking the queues again
+                        self.wait_for_running_jobs()
+                        result = self.dequeue_job_and_maintain_ttl(timeout)
+
+                    if result is None:
+                        break
+                except StopRequested:
+                    break
+
+                job, queue = result
+                self.execute_job(job, queue)
+
+        finally:
+            self.stop_pool()
+            if not self.is_horse:
+                self.register_death()
+        return self.did_perform_work
+
+    def job_done(self, job_id):
+        """
+        Called from the pool's result thread when a process is free again
+        """
+        with self.slot_freed:
+            self.done_ids.add(job_id)
+            self.slot_freed.notify()
+
+    def execute_job(self, job, queue):
+        async_result = self.process_pool.apply_async(
+            _perform_job, (job.id,), callback=self.job_done)
+        self.in_flight[job.id] = (async_result, job, queue)
+        self.heartbeat()
+
+    def reap(self, wait=0):
+        """
+        Collect finished jobs and enqueue their dependents, first waiting up
+        to wait seconds for one to finish if none has
+        """
+        with self.slot_freed:
+            if (wait and not self._stopped and
+                    not self.done_ids.intersection(self.in_flight)):
+                self.slot_freed.wait(wait)
+            # A job can finish before execute_job has put it in in_flight,
+            # its id is kept for the next reap
+            done = self.done_ids.intersection(self.in_flight)
+            self.done_ids.difference_update(done)
+        # Jobs that raised in the pool never get the callback
+        done.update(job_id for job_id, (async_result, _, _)
+                    in self.in_flight.items() if async_result.ready())
+        for job_id in done:
+            async_result, job, queue = self.in_flight.pop(job_id)
+            self.did_perform_work = True
+            job.refresh()
+            if job.get_status() == Status.FINISHED:
+                queue.enqueue_dependents(job)
+        if done:
+            self.heartbeat()
+        return len(done)
+
+    def wait_for_running_jobs(self):
+        while self.in_flight:
+            self.reap(REAP_INTERVAL)
+
+    def dequeue_job_and_maintain_ttl(self, timeout):
+        if self._stopped:
+            raise StopRequested()
+
+        result = None
+        while True:
+            if self._stopped:
+                raise StopRequested()
+
+            self.reap()
+            self.heartbeat()
+
+            if len(self.in_flight) >= self.pool_size:
+                # Sleep until a process frees up rather than polling
+                self.reap(REAP_INTERVAL)
+                continue
+
+            # Don't block on Redis for long while jobs are running, they
+            # need reaping and the heartbeat has to reflect them
+            blocking = timeout
+            if timeout is not None and self.in_flight:
+                blocking = min(timeout, REAP_INTERVAL)
+
+            try:
+                result = self.queue_class.dequeue_any(self.queues, blocking, connection=self.connection)
+                if result is not None:
+                    job, queue = result
+                    self.log.info('%s: %s (%s)' % (green(queue.name),
+                                  blue(job.description), job.id))
+                break
+            except DequeueTimeout:
+                pass
+
+        self.heartbeat()
+        return result
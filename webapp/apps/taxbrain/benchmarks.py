@@ -0,0 +1,278 @@
+"""
+Benchmarks for the code between dropq and the browser.
+
+Every benchmark runs against synthetic dropq results with the same shape as
+the real ones (all seven tables, one set of rows per budget year), so the
+numbers do not depend on a dropq cluster. Run them with
+
+    ./manage.py run_benchmarks --output report.json
+
+and compare a later run against a saved report with --baseline. No baseline
+is shipped: timings only compare on the same machine, so save your own with
+--save-baseline before making a change.
+"""
+from collections import OrderedDict
+import datetime
+import json
+import platform
+import random
+import sys
+import timeit
+
+from .helpers import (NUM_BUDGET_YEARS, TAXCALC_RESULTS_BIN_ROW_KEYS,
+                      TAXCALC_RESULTS_DEC_ROW_KEYS,
+                      TAXCALC_RESULTS_MTABLE_COL_LABELS,
+                      TAXCALC_RESULTS_DFTABLE_COL_LABELS, taxcalc_version)
+
+# Share of a baseline timing a benchmark may slow down by before it counts
+# as a regression
+DEFAULT_TOLERANCE = 0.10
+# Each timing sample runs the benchmark for at least this long
+MIN_SAMPLE_SECONDS = 0.2
+
+# Inputs of a typical reform, as posted by the input form
+SAMPLE_FORM_DATA = {
+    'II_em': '4500',
+    'II_em_cpi': 'True',
+    'STD_0': '7000,7200',
+    'STD_1': '14000,14400',
+    'II_brk2_0': '36000,38000,40000',
+    'II_brk2_1': '72250,74000',
+    'II_brk2_2': '36500',
+    'ID_Charity_crt_Cash': '0.4',
+    'EITC_rt_1': '0.4',
+    'CTC_c': '1500',
+}
+
+# The same reform after worker_data_from_inputs, as package_up_vars gets it
+SAMPLE_USER_VALUES = {
+    'II_em': [4500.0],
+    'STD_0': [7000.0, 7200.0],
+    'STD_1': [14000.0, 14400.0],
+    'II_brk2_0': [36000.0, 38000.0, 40000.0],
+    'II_brk2_1': [72250.0, 74000.0],
+    'II_brk2_2': [36500.0],
+    'ID_Charity_crt_Cash': [0.4],
+    'EITC_rt_1': [0.4],
+    'CTC_c': [1500.0],
+}
+
+
+def _number(rng, scale):
+    return "{0:.2f}".format(rng.uniform(-scale, scale))
+
+
+def _table(rng, row_keys, num_cols, years, percent_cols=0):
+    table = {}
+    for row in row_keys:
+        for yi in years:
+            cells = [_number(rng, 1e9) for _ in range(num_cols - percent_cols)]
+            cells += [_number(rng, 100) + "%" for _ in range(percent_cols)]
+            table["{0}_{1}".format(row, yi)] = cells
+    return table
+
+
+def synthetic_dropq_results(num_years=NUM_BUDGET_YEARS, seed=0):
+    """
+    Merged dropq results for num_years budget years, as stored in
+    TaxSaveInputs.tax_result: string cells, "%" suffixes on the share
+    columns of the difference tables, and the same row keys as dropq.
+    The same seed always gives the same results.
+    """
+    rng = random.Random(seed)
+    results = _tables(rng, range(num_years))
+    results['fiscal_tots'] = [_number(rng, 1e11) for _ in range(num_years)]
+    return results
+
+
+def synthetic_year_result(year_n, seed=0):
+    """
+    The result of a single dropq year job, as a dropq host returns it
+    """
+    rng = random.Random(seed * 1000 + year_n)
+    result = _tables(rng, [year_n])
+    result['fiscal_tots'] = _number(rng, 1e11)
+    return result
+
+
+def _tables(rng, years):
+    num_m = len(TAXCALC_RESULTS_MTABLE_COL_LABELS)
+    num_df = len(TAXCALC_RESULTS_DFTABLE_COL_LABELS)
+    dec, bins = TAXCALC_RESULTS_DEC_ROW_KEYS, TAXCALC_RESULTS_BIN_ROW_KEYS
+    return {
+        'mX_dec': _table(rng, dec, num_m, years),
+        'mY_dec': _table(rng, dec, num_m, years),
+        'df_dec': _table(rng, dec, num_df, years, percent_cols=3),
+        'mX_bin': _table(rng, bins, num_m, years),
+        'mY_bin': _table(rng, bins, num_m, years),
+        'df_bin': _table(rng, bins, num_df, years, percent_cols=3),
+    }
+
+
+def _bench_package_up_vars(num_years):
+    from .helpers import package_up_vars
+
+    def run():
+        # package_up_vars removes entries from its argument
+        package_up_vars(dict(SAMPLE_USER_VALUES))
+    return run
+
+
+def _bench_results_to_tables(num_years):
+    from .helpers import taxcalc_results_to_tables
+    results = synthetic_dropq_results(num_years)
+    return lambda: taxcalc_results_to_tables(results)
+
+
+def _bench_format_csv(num_years):
+    from .helpers import format_csv
+    results = synthetic_dropq_results(num_years)
+    return lambda: format_csv(results, 1)
+
+
+def _bench_form_validation(num_years):
+    from .forms import PersonalExemptionForm
+
+    def run():
+        form = PersonalExemptionForm(SAMPLE_FORM_DATA)
+        if not form.is_valid():
+            raise ValueError("sample form data is invalid: {0}".format(form.errors))
+    return run
+
+
+def _request():
+    from django.contrib.auth.models import AnonymousUser
+    from django.test import RequestFactory
+    request = RequestFactory().get('/taxbrain/')
+    request.user = AnonymousUser()
+    return request
+
+
+def _bench_render_results(num_years):
+    from django.template.loader import render_to_string
+    from .forms import PersonalExemptionForm
+    from .helpers import taxcalc_results_to_tables
+    from .models import OutputUrl
+
+    form = PersonalExemptionForm(SAMPLE_FORM_DATA)
+    form.is_valid()
+    inputs = form.save(commit=False)
+    unique_url = OutputUrl(pk=1, unique_inputs=inputs,
+                           taxcalc_vers=taxcalc_version)
+    context = {
+        'locals': {'inputs': inputs, 'url': unique_url},
+        'unique_url': unique_url,
+        'taxcalc_version': taxcalc_version,
+        'tables': taxcalc_results_to_tables(synthetic_dropq_results(num_years)),
+        'created_on': datetime.datetime(2015, 1, 1),
+    }
+    request = _request()
+    return lambda: render_to_string('taxbrain/results.html', context,
+                                    request=request)
+
+
+def _bench_render_input_form(num_years):
+    from django.template.loader import render_to_string
+    from .forms import PersonalExemptionForm
+    from .helpers import TAXCALC_DEFAULT_PARAMS
+
+    request = _request()
+
+    def run():
+        context = {
+            'form': PersonalExemptionForm(),
+            'params': TAXCALC_DEFAULT_PARAMS,
+            'taxcalc_version': taxcalc_version,
+        }
+        render_to_string('taxbrain/input_form.html', context, request=request)
+    return run
+
+
+# name -> factory taking the number of budget years and returning the
+# callable to time
+BENCHMARKS = OrderedDict([
+    ('package_up_vars', _bench_package_up_vars),
+    ('taxcalc_results_to_tables', _bench_results_to_tables),
+    ('format_csv', _bench_format_csv),
+    ('form_validation', _bench_form_validation),
+    ('render_results', _bench_render_results),
+    ('render_input_form', _bench_render_input_form),
+])
+
+
+def time_callable(func, repeat=5):
+    """
+    Time func over repeat samples. Each sample calls func enough times to
+    take at least MIN_SAMPLE_SECONDS. Returns per call seconds.
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= MIN_SAMPLE_SECONDS:
+            break
+        number *= 2
+    samples = sorted(t / number for t in timer.repeat(repeat, number))
+    return {
+        'number': number,
+        'repeat': repeat,
+        'min': samples[0],
+        'median': samples[len(samples) // 2],
+        'max': samples[-1],
+    }
+
+
+def run_benchmarks(names=None, num_years=NUM_BUDGET_YEARS, repeat=5):
+    """
+    Run the named benchmarks, all of them by default, and return the report
+    """
+    names = names or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        raise KeyError("Unknown benchmarks: {0}".format(", ".join(unknown)))
+
+    results = OrderedDict()
+    for name in names:
+        func = BENCHMARKS[name](num_years)
+        results[name] = time_callable(func, repeat)
+
+    return {
+        'created': datetime.datetime.utcnow().isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'taxcalc_version': taxcalc_version,
+        'num_years': num_years,
+        'results': results,
+    }
+
+
+def compare_reports(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare the minimum per call time of every benchmark in both reports.
+    Returns a list of (name, baseline seconds, current seconds, ratio,
+    verdict) where verdict is 'slower', 'faster' or 'same'.
+    """
+    rows = []
+    for name, current in report['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if before is None:
+            continue
+        ratio = current['min'] / before['min'] if before['min'] else float('inf')
+        if ratio > 1 + tolerance:
+            verdict = 'slower'
+        elif ratio < 1 - tolerance:
+            verdict = 'faster'
+        else:
+            verdict = 'same'
+        rows.append((name, before['min'], current['min'], ratio, verdict))
+    return rows
+
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,174 @@
+"""
+How long year jobs take, and how many dropq hosts the queue needs.
+
+Every finished year job leaves its year, its reform size (the number of
+parameters the reform changes), its host, its queue wait and its compute
+time on its DropqJob row. DurationModel fits the recent ones with a line
+per budget year, seconds = intercept + slope * reform size, and falls back
+to a single line over all years, then to the plain mean, then to
+DEFAULT_JOB_SECONDS while there is too little history.
+
+The scheduler uses the model for the ETA on the processing page. The same
+predictions summed over the queue give the backlog in slot-seconds, from
+which required_hosts derives the number of hosts that would clear it in
+DROPQ_TARGET_DRAIN_SECONDS, as a signal for autoscaling the dropq hosts.
+"""
+import math
+import os
+
+from django.core.cache import cache
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import DropqJob
+
+# Year job duration assumed until enough jobs have finished to measure it
+DEFAULT_JOB_SECONDS = 60
+# Number of recent jobs the model is fitted to
+DURATION_SAMPLE = int(os.environ.get('DROPQ_DURATION_SAMPLE', 500))
+# Jobs needed before a year, or all years together, get their own line
+DURATION_MIN_SAMPLES = 10
+# The model is refitted at most this often
+DURATION_MODEL_TTL = 30
+DURATION_MODEL_CACHE_KEY = 'taxbrain.duration_model'
+# The backlog should be cleared within this many seconds
+DROPQ_TARGET_DRAIN_SECONDS = int(os.environ.get('DROPQ_TARGET_DRAIN_SECONDS', 300))
+
+
+def fit_line(points):
+    """
+    Least squares fit of y = intercept + slope * x to (x, y) points.
+    Returns (intercept, slope), with a zero slope when every x is the same.
+    """
+    n = float(len(points))
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    if var_x == 0:
+        return mean_y, 0.0
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+    return mean_y - slope * mean_x, slope
+
+
+class DurationModel(object):
+    """
+    Predicts the seconds a year job takes from its year and reform size.
+    samples is a list of (year, reform_size, seconds).
+    """
+    def __init__(self, samples, min_samples=DURATION_MIN_SAMPLES,
+                 default=DEFAULT_JOB_SECONDS):
+        self.count = len(samples)
+        self.default = default
+        self.overall = None
+        self.years = {}
+        if self.count:
+            self.mean = sum(s for _, _, s in samples) / float(self.count)
+        else:
+            self.mean = default
+        if self.count >= min_samples:
+            self.overall = fit_line([(size, s) for _, size, s in samples])
+
+        by_year = {}
+        for year, size, seconds in samples:
+            by_year.setdefault(year, []).append((size, seconds))
+        for year, points in by_year.items():
+            if len(points) >= min_samples:
+                self.years[year] = fit_line(points)
+
+    def predict(self, year, reform_size):
+        line = self.years.get(year, self.overall)
+        if line is None:
+            return self.mean
+        intercept, slope = line
+        # A line fitted to a narrow range of sizes can dip below zero
+        # outside it
+        return max(intercept + slope * reform_size, 1.0)
+
+    def mean_seconds(self):
+        return max(self.mean, 1.0)
+
+    def describe(self):
+        return {
+            'samples': self.count,
+            'mean_seconds': self.mean_seconds(),
+            'overall': self.overall,
+            'years': dict((str(year), line) for year, line in self.years.items()),
+        }
+
+
+def job_seconds(submitted_at, finished_at, compute_seconds):
+    """
+    Duration of a finished job: the compute time its host reported, or
+    else the time from submission to the poll that found it done
+    """
+    if compute_seconds is not None:
+        return compute_seconds
+    return (finished_at - submitted_at).total_seconds()
+
+
+def recent_samples():
+    recent = (DropqJob.objects.filter(status=DropqJob.DONE,
+                                      hedge_of__isnull=True,
+                                      submitted_at__isnull=False,
+                                      finished_at__isnull=False)
+              .order_by('-finished_at')
+              .values_list('year', 'reform_size', 'submitted_at',
+                           'finished_at', 'compute_seconds')[:DURATION_SAMPLE])
+    return [(year, size, job_seconds(start, end, compute))
+            for year, size, start, end, compute in recent]
+
+
+def duration_model():
+    """
+    The model fitted to the recent jobs, refitted every DURATION_MODEL_TTL
+    seconds
+    """
+    model = cache.get(DURATION_MODEL_CACHE_KEY)
+    if model is None:
+        model = DurationModel(recent_samples())
+        cache.set(DURATION_MODEL_CACHE_KEY, model, DURATION_MODEL_TTL)
+    return model
+
+
+def pending_jobs():
+    """
+    The unfinished year jobs in one aggregate query, as (status, priority,
+    year, reform size, submitted_at, hedge_of, count) rows. Queued jobs
+    group by year and size, running ones mostly stand alone since each has
+    its own submission time.
+    """
+    return (DropqJob.objects.filter(status__in=[DropqJob.QUEUED,
+                                                DropqJob.SUBMITTED])
+            .values_list('status', 'priority', 'year', 'reform_size',
+                         'submitted_at', 'hedge_of')
+            .annotate(n=Count('id')).order_by())
+
+
+def backlog_seconds(model, pending=None):
+    """
+    Predicted slot-seconds of work left in the queued and running jobs.
+    pending is what pending_jobs returns, queried here when not given.
+    """
+    if pending is None:
+        pending = pending_jobs()
+    total = 0.0
+    now = timezone.now()
+    for status, _, year, size, submitted_at, hedge_of, n in pending:
+        if status == DropqJob.QUEUED:
+            total += n * model.predict(year, size)
+        elif hedge_of is None and submitted_at is not None:
+            elapsed = (now - submitted_at).total_seconds()
+            total += n * max(model.predict(year, size) - elapsed, 0)
+    return total
+
+
+def required_hosts(work_seconds, host_capacity,
+                   target_seconds=DROPQ_TARGET_DRAIN_SECONDS):
+    """
+    Hosts of host_capacity slots each needed to finish work_seconds of
+    year jobs within target_seconds
+    """
+    if work_seconds <= 0:
+        return 0
+    slots = work_seconds / float(target_seconds)
+    return int(math.ceil(slots / max(host_capacity, 1)))
@@ -0,0 +1,183 @@
+"""
+Versioned local store for the microdata file.
+
+Datasets are installed under a cache directory as content addressed files,
+puf-<sha256 prefix>.csv.gz, next to a small manifest naming the current
+version. A download goes to a temporary file which is hashed, checked
+against DATASET_SHA256 when that is set, and only then renamed into place,
+so a partial download is never mistaken for a valid dataset. Workers that
+find a current dataset on disk start without touching the source.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+DATASET_NAME = 'puf.csv.gz'
+DATASET_CACHE_DIR = os.environ.get('DATASET_CACHE_DIR', 'datasets')
+# Where to fetch the dataset from: s3://bucket/key or a local file or
+# directory. Defaults to a puf.csv.gz in the working directory if there is
+# one, otherwise the pufbucket S3 bucket.
+DATASET_SOURCE = os.environ.get('DATASET_SOURCE', DATASET_NAME
+                                if os.path.exists(DATASET_NAME)
+                                else 's3://pufbucket/' + DATASET_NAME)
+# Optional pin of the expected content hash
+DATASET_SHA256 = os.environ.get('DATASET_SHA256')
+# Re-hash the installed file on every start instead of trusting its size
+DATASET_VERIFY = os.environ.get('DATASET_VERIFY', 'False') == 'True'
+
+
+def file_checksum(path, blocksize=1 << 20):
+    """
+    sha256 hex digest of the file at path
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(blocksize), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class LocalSource(object):
+    """
+    Copies the dataset from a local file, or from a file of the same name
+    inside a local directory
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def fetch(self, name, dest):
+        path = self.path
+        if os.path.isdir(path):
+            path = os.path.join(path, name)
+        shutil.copyfile(path, dest)
+
+    def __str__(self):
+        return self.path
+
+
+class S3Source(object):
+    """
+    Downloads the dataset from an S3 bucket
+    """
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+
+    def fetch(self, name, dest):
+        from boto.s3.connection import S3Connection
+
+        aws_connection = S3Connection(os.environ.get('AWS_KEY_ID'),
+                                      os.environ.get('AWS_SECRET_ID'))
+        bucket = aws_connection.get_bucket(self.bucket)
+        bucket.get_key(self.key).get_contents_to_filename(dest)
+
+    def __str__(self):
+        return "s3://{0}/{1}".format(self.bucket, self.key)
+
+
+def source_from_url(url):
+    """
+    Build a dataset source from an s3://bucket/key url or a local path
+    """
+    if url.startswith('s3://'):
+        bucket, _, key = url[len('s3://'):].partition('/')
+        return S3Source(bucket, key)
+    return LocalSource(url)
+
+
+class DatasetManager(object):
+    """
+    Installs and locates versions of one dataset in cache_dir
+    """
+    def __init__(self, cache_dir, name, source, expected_sha256=None):
+        self.cache_dir = cache_dir
+        self.name = name
+        self.source = source
+        self.expected_sha256 = expected_sha256
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.cache_dir, self.name + '.json')
+
+    def versioned_path(self, sha256):
+        stem, dot, ext = self.name.partition('.')
+        return os.path.join(self.cache_dir,
+                            "{0}-{1}{2}{3}".format(stem, sha256[:12], dot, ext))
+
+    def current(self, verify=False):
+        """
+        Return (path, sha256) of the installed dataset, or None if nothing
+        valid is installed. Without verify the file is trusted if its size
+        matches the manifest.
+        """
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        sha256 = manifest.get('sha256')
+        if self.expected_sha256 and sha256 != self.expected_sha256:
+            return None
+        path = self.versioned_path(sha256)
+        if not os.path.exists(path) or os.path.getsize(path) != manifest.get('size'):
+            return None
+        if verify and file_checksum(path) != sha256:
+            print "dataset failed verification: ", path
+            return None
+        return path, sha256
+
+    def install(self):
+        """
+        Fetch the dataset from the source and atomically install it as the
+        current version. Returns (path, sha256).
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        print "fetching dataset from ", self.source
+        fd, tmp_path = tempfile.mkstemp(prefix='.' + self.name, dir=self.cache_dir)
+        os.close(fd)
+        try:
+            self.source.fetch(self.name, tmp_path)
+            sha256 = file_checksum(tmp_path)
+            if self.expected_sha256 and sha256 != self.expected_sha256:
+                raise IOError("Dataset {0} has sha256 {1}, expected {2}".format(
+                              self.name, sha256, self.expected_sha256))
+            path = self.versioned_path(sha256)
+            os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        manifest = {'name': self.name, 'sha256': sha256,
+                    'size': os.path.getsize(path), 'source': str(self.source)}
+        fd, tmp_manifest = tempfile.mkstemp(prefix='.manifest', dir=self.cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp_manifest, self.manifest_path)
+        print "installed dataset ", path
+        return path, sha256
+
+    def ensure(self, verify=False):
+        """
+        Return (path, sha256) of the current dataset, installing it first
+        if necessary
+        """
+        return self.current(verify=verify) or self.install()
+
+
+def dataset_version(sha256):
+    """
+    Short version string of a dataset, used in cache keys and results
+    """
+    return sha256[:12]
+
+
+def default_dataset_manager():
+    return DatasetManager(DATASET_CACHE_DIR, DATASET_NAME,
+                          source_from_url(DATASET_SOURCE),
+                          expected_sha256=DATASET_SHA256)
@@ -0,0 +1,324 @@
+"""
+A dropq worker that runs on the local machine.
+
+It speaks the same HTTP protocol as the remote dropq hosts listed in
+DROPQ_WORKERS (/dropq_start_job, /dropq_query_result, /dropq_get_result,
+/dropq_cancel_job and /dropq_capabilities) but computes each year job with the tasks.py code path, in a process pool
+that shares the resident microdata. Start it with
+
+    ./manage.py run_dropq_worker --port 5050
+
+and point the webapp at it with DROPQ_WORKERS=127.0.0.1:5050.
+"""
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import json
+import threading
+import time
+import urlparse
+import uuid
+import multiprocessing
+from collections import OrderedDict
+
+from .dropq_wire import (DROPQ_BINARY_CONTENT_TYPE, BINARY_MEDIA_RANGE,
+                         encode_year_result)
+from .helpers import BASELINE_TABLES, taxcalc_version, dropq_version
+from .metrics import inc
+from .registry import version_key
+from .sampler import SamplingProfiler
+from .tracing import TRACE_HEADER, COMPUTE_HEADER, SERIALIZE_HEADER
+from .tasks import loaded_dataset_version, run_nth_year
+
+# Finished results that were never fetched are dropped after this long
+RESULT_TTL_IN_SECONDS = 60 * 60
+# Number of year results kept to answer repeated identical jobs
+RESULT_CACHE_SIZE = 256
+
+
+# Ids of cancelled jobs, shared with the pool processes
+_cancelled = None
+
+
+def _init_pool(cancelled):
+    global _cancelled
+    _cancelled = cancelled
+
+
+def run_year_job(job_id, year_n, user_mods, profile=False):
+    """
+    Run one year job in a pool process, unless it was cancelled while it
+    waited for a free process. A job that has started runs to completion.
+    With profile, a sampled profile of the job is added to its result.
+    The time the job took is added as compute_seconds.
+    """
+    if _cancelled is not None and job_id in _cancelled:
+        return None
+    start = time.time()
+    if profile:
+        with SamplingProfiler() as profiler:
+            result = dict(run_nth_year(year_n, user_mods))
+        result['profile'] = profiler.collapsed()
+    else:
+        result = dict(run_nth_year(year_n, user_mods))
+    result['compute_seconds'] = time.time() - start
+    return result
+
+
+def result_cache_key(dataset_version, year_n, user_mods):
+    """
+    Identify a year job by the dataset it runs against, its year and its
+    user_mods, so a new dataset version never serves stale results
+    """
+    mods = json.dumps(user_mods, sort_keys=True)
+    return hashlib.sha1("{0}:{1}:{2}".format(dataset_version, year_n, mods)).hexdigest()
+
+
+class FinishedResult(object):
+    """
+    Stands in for the AsyncResult of a job answered from the result cache
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
+
+class DropqJobStore(object):
+    """
+    Keeps track of the year jobs running in the process pool, by job id
+    """
+    def __init__(self, pool, dataset_version, cancelled=None):
+        self.pool = pool
+        self.dataset_version = dataset_version
+        # job id -> True for cancelled jobs still waiting in the pool
+        self.cancelled = cancelled if cancelled is not None else {}
+        self.cancelled_results = {}
+        self.jobs = {}
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def start(self, year_n, user_mods, profile=False):
+        job_id = uuid.uuid4().hex
+        key = result_cache_key(self.dataset_version, year_n, user_mods)
+        with self.lock:
+            # A profiled job has to run, not come from the cache
+            cached = None if profile else self.cache.get(key)
+        if cached is not None:
+            inc('taxbrain_cache_requests_total', cache='dropq_results', result='hit')
+            async_result = FinishedResult(cached)
+        else:
+            inc('taxbrain_cache_requests_total', cache='dropq_results', result='miss')
+            async_result = self.pool.apply_async(run_year_job,
+                                                 (job_id, year_n, user_mods, profile))
+        with self.lock:
+            self.expire()
+            self.jobs[job_id] = (async_result, time.time(), key)
+        return job_id
+
+    def expire(self):
+        """
+        Drop finished jobs whose results have been waiting too long.
+        Must be called with the lock held.
+        """
+        cutoff = time.time() - RESULT_TTL_IN_SECONDS
+        for job_id, (async_result, started, _) in self.jobs.items():
+            if started < cutoff and async_result.ready():
+                del self.jobs[job_id]
+        for job_id, async_result in self.cancelled_results.items():
+            if async_result.ready():
+                del self.cancelled_results[job_id]
+                self.cancelled.pop(job_id, None)
+
+    def cancel(self, job_id):
+        """
+        Forget a job and skip it if it has not started yet. Returns False
+        for unknown job ids.
+        """
+        with self.lock:
+            job = self.jobs.pop(job_id, None)
+            if job is None:
+                return False
+            if not job[0].ready():
+                self.cancelled[job_id] = True
+                self.cancelled_results[job_id] = job[0]
+        return True
+
+    def ready(self, job_id):
+        """
+        True if the job is done, False if it is still running and None if
+        the job id is unknown
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        return job[0].ready()
+
+    def result(self, job_id):
+        """
+        Return the result of a finished job and forget about it. Raises
+        KeyError for unknown job ids and re-raises the job's exception if
+        it failed.
+        """
+        with self.lock:
+            async_result, _, key = self.jobs.pop(job_id)
+        value = dict(async_result.get())
+        profile = value.pop('profile', None)
+        compute_seconds = value.pop('compute_seconds', None)
+
+        with self.lock:
+            self.cache.pop(key, None)
+            self.cache[key] = value
+            while len(self.cache) > RESULT_CACHE_SIZE:
+                self.cache.popitem(last=False)
+
+        result = dict(value)
+        result['taxcalc_version'] = taxcalc_version
+        result['dropq_version'] = dropq_version
+        result['dataset_version'] = self.dataset_version
+        if profile is not None:
+            result['profile'] = profile
+        if compute_seconds is not None:
+            result['compute_seconds'] = compute_seconds
+        return result
+
+
+class DropqRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def respond(self, status, body, content_type='text/plain', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        trace_id = self.headers.getheader(TRACE_HEADER)
+        if trace_id:
+            self.send_header(TRACE_HEADER, trace_id)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        path = urlparse.urlparse(self.path).path
+        if path not in ('/dropq_start_job', '/dropq_cancel_job'):
+            return self.respond(404, 'not found')
+
+        length = int(self.headers.getheader('content-length') or 0)
+        form = urlparse.parse_qs(self.rfile.read(length))
+
+        if path == '/dropq_cancel_job':
+            job_id = form.get('job_id', [''])[0]
+            if not self.server.jobs.cancel(job_id):
+                return self.respond(404, 'unknown job')
+            return self.respond(200, 'cancelled')
+
+        try:
+            year_n = int(form['year'][0])
+            user_mods = json.loads(form['user_mods'][0])
+        except (KeyError, ValueError):
+            return self.respond(400, 'expected year and user_mods')
+
+        # JSON turns the integer year keys of user_mods into strings
+        user_mods = {int(k): v for k, v in user_mods.items()}
+        profile = form.get('profile', [''])[0] == '1'
+        job_id = self.server.jobs.start(year_n, user_mods, profile)
+        self.respond(200, job_id)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        job_id = urlparse.parse_qs(url.query).get('job_id', [''])[0]
+
+        if url.path == '/dropq_capabilities':
+            return self.respond(200, json.dumps(self.server.capabilities()),
+                                'application/json')
+
+        if url.path == '/dropq_query_result':
+            ready = self.server.jobs.ready(job_id)
+            if ready is None:
+                return self.respond(404, 'unknown job')
+            return self.respond(200, 'YES' if ready else 'NO')
+
+        if url.path == '/dropq_get_result':
+            try:
+                result = self.server.jobs.result(job_id)
+            except KeyError:
+                return self.respond(404, 'unknown job')
+            except Exception as e:
+                print "job failed: ", job_id, e
+                return self.respond(500, 'job failed')
+
+            # The client already holds the base plan tables of this year
+            # as computed by hosts of our version
+            baseline = urlparse.parse_qs(url.query).get('baseline', [''])[0]
+            if baseline and baseline == version_key(self.server.capabilities()):
+                for name in BASELINE_TABLES:
+                    result.pop(name, None)
+
+            timings = {}
+            compute_seconds = result.pop('compute_seconds', None)
+            if compute_seconds is not None:
+                timings[COMPUTE_HEADER] = repr(compute_seconds)
+
+            start = time.time()
+            accept = self.headers.getheader('accept') or ''
+            if BINARY_MEDIA_RANGE in accept:
+                try:
+                    body = encode_year_result(result)
+                    timings[SERIALIZE_HEADER] = repr(time.time() - start)
+                    return self.respond(200, body, DROPQ_BINARY_CONTENT_TYPE,
+                                        timings)
+                except ValueError:
+                    # non-numeric cells, fall back to JSON
+                    pass
+            body = json.dumps(result)
+            timings[SERIALIZE_HEADER] = repr(time.time() - start)
+            return self.respond(200, body, 'application/json', timings)
+
+        self.respond(404, 'not found')
+
+
+class DropqServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, pool, dataset_version, cancelled=None,
+                 capacity=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, DropqRequestHandler)
+        self.jobs = DropqJobStore(pool, dataset_version, cancelled)
+        self.capacity = capacity
+
+    def capabilities(self):
+        return {
+            'taxcalc_version': taxcalc_version,
+            'dropq_version': dropq_version,
+            'dataset_version': self.jobs.dataset_version,
+            'capacity': self.capacity,
+            'formats': ['application/json', BINARY_MEDIA_RANGE],
+        }
+
+
+def serve(host='127.0.0.1', port=5050, processes=None):
+    """
+    Load the microdata, fork the process pool and serve the dropq protocol
+    until interrupted.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    # Load before forking so every pool process shares the frame
+    version = loaded_dataset_version()
+    manager = multiprocessing.Manager()
+    cancelled = manager.dict()
+    pool = multiprocessing.Pool(processes, initializer=_init_pool,
+                                initargs=(cancelled,))
+    server = DropqServer((host, port), pool, version, cancelled, processes)
+    print "dropq worker listening on {0}:{1} with {2} processes".format(
+        host, port, processes)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.terminate()
+        pool.join()
+        manager.shutdown()
@@ -0,0 +1,132 @@
+"""
+Compact binary encoding of single year dropq results.
+
+The tables of a year result (mY_dec, mX_bin, ...) map row keys to lists of
+numbers, which dropq hosts send as JSON strings. This format ships each
+table as one little-endian float64 array instead, zlib compressed behind a
+small versioned header:
+
+    magic (4 bytes) | version (1 byte) | metadata length (4 bytes) | zlib body
+
+The body is the JSON metadata (row keys and column counts of each table,
+plus every non-table value such as fiscal_tots and the versions) followed
+by the raw table arrays in metadata order.
+
+Decoding gives back the cells exactly as the JSON reply would have them.
+The metadata records the number of decimals and the percent sign of each
+column, and any cell that doesn't print back the same way from its float
+is kept verbatim, so both transports merge to the same results.
+
+The webapp asks for it with an Accept header. Workers that don't know the
+format reply with JSON as before.
+"""
+import json
+import struct
+import zlib
+
+import numpy as np
+
+DROPQ_BINARY_CONTENT_TYPE = 'application/x-dropq-binary'
+WIRE_FORMAT_VERSION = 2
+# hosts only send binary to clients asking for their exact version
+BINARY_MEDIA_RANGE = '{0};v={1}'.format(DROPQ_BINARY_CONTENT_TYPE,
+                                        WIRE_FORMAT_VERSION)
+ACCEPT_HEADER = '{0}, application/json'.format(BINARY_MEDIA_RANGE)
+
+MAGIC = b'DQWF'
+HEADER = struct.Struct('!4sBI')
+DTYPE = np.dtype('<f8')
+
+
+def _as_number(value):
+    """
+    Convert a dropq cell to a float, dropping any percent sign
+    """
+    if isinstance(value, basestring) and value.endswith('%'):
+        value = value[:-1]
+    return float(value)
+
+
+def _cell_format(value):
+    """
+    The (decimals, percent) a string cell is printed with, None for
+    anything else
+    """
+    if not isinstance(value, basestring):
+        return None
+    percent = value.endswith('%')
+    digits = value[:-1] if percent else value
+    decimals = len(digits) - digits.index('.') - 1 if '.' in digits else 0
+    return [decimals, percent]
+
+
+def _format_cell(number, fmt):
+    decimals, percent = fmt
+    return '{0:.{1}f}{2}'.format(number, decimals, '%' if percent else '')
+
+
+def encode_year_result(result):
+    """
+    Encode a single year dropq result. Raises ValueError if a table holds
+    something that isn't a number, in which case the caller should send
+    JSON instead.
+    """
+    tables = []
+    extra = {}
+    arrays = []
+    for name in sorted(result):
+        value = result[name]
+        if not isinstance(value, dict):
+            extra[name] = value
+            continue
+        rows = sorted(value)
+        cols = len(value[rows[0]]) if rows else 0
+        values = [[_as_number(v) for v in value[row]] for row in rows]
+        arr = np.array(values, dtype=DTYPE).reshape(len(rows), cols)
+        # the first row sets the format of each column, cells printed any
+        # other way are sent as they are
+        formats = [_cell_format(v) for v in value[rows[0]]] if rows else []
+        verbatim = []
+        for i, row in enumerate(rows):
+            for j, cell in enumerate(value[row]):
+                fmt = formats[j]
+                if fmt is None or _format_cell(arr[i, j], fmt) != cell:
+                    verbatim.append([i, j, cell])
+        tables.append({'name': name, 'rows': rows, 'cols': cols,
+                       'formats': formats, 'verbatim': verbatim})
+        arrays.append(arr.tobytes())
+
+    meta = json.dumps({'tables': tables, 'extra': extra}).encode('utf-8')
+    body = zlib.compress(meta + b''.join(arrays))
+    return HEADER.pack(MAGIC, WIRE_FORMAT_VERSION, len(meta)) + body
+
+
+def decode_year_result(data):
+    """
+    Decode a payload made by encode_year_result into the usual result dict,
+    with the table cells as the host formatted them.
+    """
+    magic, version, meta_len = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a dropq binary payload")
+    if version != WIRE_FORMAT_VERSION:
+        raise ValueError("Unsupported dropq wire format version {0}".format(version))
+
+    body = zlib.decompress(data[HEADER.size:])
+    meta = json.loads(body[:meta_len].decode('utf-8'))
+
+    result = dict(meta['extra'])
+    offset = meta_len
+    for table in meta['tables']:
+        count = len(table['rows']) * table['cols']
+        arr = np.frombuffer(body, dtype=DTYPE, count=count, offset=offset)
+        offset += count * DTYPE.itemsize
+        arr = arr.reshape(len(table['rows']), table['cols'])
+        formats = table['formats']
+        cells = [[_format_cell(x, formats[j]) if formats[j] else x
+                  for j, x in enumerate(row)] for row in arr.tolist()]
+        for i, j, cell in table['verbatim']:
+            cells[i][j] = cell
+        result[table['name']] = dict(zip(table['rows'], cells))
+
+    return result
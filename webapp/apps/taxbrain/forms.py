@@ -10,7 +10,7 @@ class PersonalExemptionForm(ModelForm):
 
     class Meta:
         model = TaxSaveInputs
-        exclude = ['creation_date']
+        exclude = ['creation_date', 'batch']
         widgets = {}
         labels = {}
 
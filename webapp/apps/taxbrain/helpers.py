@@ -1,4 +1,8 @@
 from collections import namedtuple
+import hashlib
+import itertools
+import math
+import operator
 import taxcalc
 import dropq
 import os
@@ -8,6 +12,14 @@ import json
 import pandas as pd
 import time
 
+from django.core.cache import cache
+
+from .metrics import timed, inc
+from .tracing import (trace_headers, span, COMPUTE_HEADER,
+                      SERIALIZE_HEADER)
+from .dropq_wire import (ACCEPT_HEADER, DROPQ_BINARY_CONTENT_TYPE,
+                         decode_year_result)
+
 
 #
 # Prepare user params to send to DropQ/Taxcalc
@@ -39,6 +51,11 @@ TAXCALC_COMING_SOON_INDEXED_BY_MARS = [
 TIMEOUT_IN_SECONDS = 1.0
 MAX_ATTEMPTS_SUBMIT_JOB = 20
 
+# Parameter sweeps vary at most this many fields at once
+MAX_SWEEP_PARAMS = 2
+# Base plan tables, identical for every point of a parameter sweep
+BASELINE_TABLES = ['mX_dec', 'mX_bin']
+
 #
 # Display TaxCalc result data
 #
@@ -223,6 +240,7 @@ def leave_name_in(key, val, dd):
             return False
 
 
+@timed('taxbrain_stage_seconds', stage='package_up_vars')
 def package_up_vars(user_values):
     dd = taxcalc.parameters.default_data(start_year=START_YEAR)
     for k, v in user_values.items():
@@ -451,6 +469,7 @@ for k, param in TAXCALC_DEFAULT_PARAMS.iteritems():
 """
 
 
+@timed('taxbrain_stage_seconds', stage='results_to_tables')
 def taxcalc_results_to_tables(results):
     """
     Take various results from dropq, i.e. mY_dec, mX_bin, df_dec, etc
@@ -551,7 +570,7 @@ def taxcalc_results_to_tables(results):
                 if multi_year_cells:
                     for yi, year in enumerate(years):
                         value = table_data["{0}_{1}".format(row_key, yi)][col_key]
-                        if value[-1] == "%":
+                        if isinstance(value, basestring) and value[-1] == "%":
                             value = value[:-1]
                         cell['year_values'][year] = value
 
@@ -559,7 +578,7 @@ def taxcalc_results_to_tables(results):
 
                 else:
                     value = table_data[row_key][col_key]
-                    if value[-1] == "%":
+                    if isinstance(value, basestring) and value[-1] == "%":
                             value = value[:-1]
                     cell['value'] = value
 
@@ -579,6 +598,7 @@ def taxcalc_results_to_tables(results):
     tables['result_years'] = years
     return tables
 
+@timed('taxbrain_stage_seconds', stage='format_csv')
 def format_csv(tax_results, url_id):
     """
     Takes a dictionary with the tax_results, having these keys:
@@ -715,76 +735,229 @@ def format_csv(tax_results, url_id):
 
     return res
 
-def submit_dropq_calculation(mods):
-    print "mods is ", mods
-    user_mods = package_up_vars(mods)
-    if not bool(user_mods):
+def worker_data_from_inputs(model):
+    """
+    Take a saved (or unsaved) TaxSaveInputs model and return the dictionary
+    of user specified values to hand to package_up_vars. Comma separated
+    fields are split into lists of floats and empty values are dropped.
+    """
+    curr_dict = dict(model.__dict__)
+
+    for key, value in curr_dict.items():
+        if type(value) == type(unicode()):
+            curr_dict[key] = [float(x) for x in value.split(',') if x]
+
+    return {k:v for k, v in curr_dict.items() if not (v == [] or v == None)}
+
+
+def dropq_submit_year(hostname, user_mods_json, year, profile=False,
+                      trace_id=None):
+    """
+    Start one year job on a dropq host. Returns the job id assigned by the
+    host, or None if the host refused the job or could not be reached.
+    With profile, the host adds a sampled profile of the job to its result.
+    """
+    theurl = "http://{hn}/dropq_start_job".format(hn=hostname)
+    data = {'user_mods': user_mods_json, 'year': str(year)}
+    if profile:
+        data['profile'] = '1'
+    try:
+        with timed('dropq_request_seconds', host=hostname, op='submit'):
+            response = requests.post(theurl, data=data, timeout=TIMEOUT_IN_SECONDS,
+                                     headers=trace_headers(trace_id))
+    except Timeout:
+        print "Couldn't submit to: ", hostname
+        inc('dropq_requests_total', host=hostname, op='submit', outcome='timeout')
+        return None
+    except RequestException as re:
+        print "Something unexpected happened: ", re
+        inc('dropq_requests_total', host=hostname, op='submit', outcome='error')
+        return None
+
+    if response.status_code == 200:
+        print "submitted: ", str(year), hostname
+        inc('dropq_requests_total', host=hostname, op='submit', outcome='ok')
+        return response.text
+
+    print "FAILED: ", str(year), hostname
+    inc('dropq_requests_total', host=hostname, op='submit', outcome='refused')
+    return None
+
+def dropq_job_ready(hostname, job_id, trace_id=None):
+    """
+    Ask a dropq host whether one of its year jobs has finished
+    """
+    result_url = "http://{hn}/dropq_query_result".format(hn=hostname)
+    try:
+        with timed('dropq_request_seconds', host=hostname, op='poll'):
+            job_response = requests.get(result_url, params={'job_id':job_id},
+                                        timeout=TIMEOUT_IN_SECONDS,
+                                        headers=trace_headers(trace_id))
+    except RequestException as re:
+        print "Couldn't poll: ", hostname, re
+        inc('dropq_requests_total', host=hostname, op='poll', outcome='error')
         return False
-    print "user_mods is ", user_mods
-    print "submit work"
-    user_mods={START_YEAR:user_mods}
-    years = list(range(0,NUM_BUDGET_YEARS))
-
-    hostnames = DROPQ_WORKERS
-    num_hosts = len(hostnames)
-    data = {}
-    data['user_mods'] = json.dumps(user_mods)
-    job_ids = []
-    hostname_idx = 0
-    for y in years:
-        year_submitted = False
-        attempts = 0
-        while not year_submitted:
-            data['year'] = str(y)
-            theurl = "http://{hn}/dropq_start_job".format(hn=hostnames[hostname_idx])
-            try:
-                response = requests.post(theurl, data=data, timeout=TIMEOUT_IN_SECONDS)
-                if response.status_code == 200:
-                    print "submitted: ", str(y), hostnames[hostname_idx]
-                    year_submitted = True
-                    job_ids.append((response.text, hostnames[hostname_idx]))
-                    hostname_idx = (hostname_idx + 1) % num_hosts
-                else:
-                    print "FAILED: ", str(y), hostnames[hostname_idx]
-                    hostname_idx = (hostname_idx + 1) % num_hosts
-                    attempts += 1
-            except Timeout:
-                print "Couldn't submit to: ", hostnames[hostname_idx]
-                hostname_idx = (hostname_idx + 1) % num_hosts
-                attempts += 1
-            except RequestException as re:
-                print "Something unexpected happened: ", re
-                hostname_idx = (hostname_idx + 1) % num_hosts
-                attempts += 1
-            if attempts > MAX_ATTEMPTS_SUBMIT_JOB:
-                print "Exceeded max attempts. Bailing out."
-                raise IOError()
-
-    return job_ids
-
-def dropq_results_ready(job_ids):
-    jobs_done = [False] * len(job_ids)
-    for idx, id_hostname in enumerate(job_ids):
-        id_, hostname = id_hostname
-        result_url = "http://{hn}/dropq_query_result".format(hn=hostname)
-        job_response = requests.get(result_url, params={'job_id':id_})
-        if job_response.status_code == 200: # Valid response
-            rep = job_response.text
-            if rep == 'YES':
-                jobs_done[idx] = True
-                print "got one!: ", id_
 
-    return all(jobs_done)
+    if job_response.status_code == 200: # Valid response
+        inc('dropq_requests_total', host=hostname, op='poll', outcome='ok')
+        if job_response.text == 'YES':
+            print "got one!: ", job_id
+            return True
+        return False
+    inc('dropq_requests_total', host=hostname, op='poll', outcome='refused')
+    return False
+
+def dropq_capabilities(hostname):
+    """
+    Ask a dropq host what it runs: versions, dataset, capacity and payload
+    formats. Returns the capabilities dict, {} for hosts that predate the
+    /dropq_capabilities endpoint, or None if the host could not be reached.
+    """
+    caps_url = "http://{hn}/dropq_capabilities".format(hn=hostname)
+    try:
+        with timed('dropq_request_seconds', host=hostname, op='capabilities'):
+            response = requests.get(caps_url, timeout=TIMEOUT_IN_SECONDS)
+    except RequestException as re:
+        print "Couldn't probe: ", hostname, re
+        inc('dropq_requests_total', host=hostname, op='capabilities', outcome='error')
+        return None
+
+    if response.status_code == 404:
+        return {}
+    if response.status_code != 200:
+        return None
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+def dropq_cancel_job(hostname, job_id, trace_id=None):
+    """
+    Ask a dropq host to drop one of its year jobs. Returns True if the host
+    acknowledged the cancel or no longer knows the job.
+    """
+    cancel_url = "http://{hn}/dropq_cancel_job".format(hn=hostname)
+    try:
+        with timed('dropq_request_seconds', host=hostname, op='cancel'):
+            response = requests.post(cancel_url, data={'job_id': job_id},
+                                     timeout=TIMEOUT_IN_SECONDS,
+                                     headers=trace_headers(trace_id))
+    except RequestException as re:
+        print "Couldn't cancel on: ", hostname, re
+        inc('dropq_requests_total', host=hostname, op='cancel', outcome='error')
+        return False
 
-def dropq_get_results(job_ids):
+    return response.status_code in (200, 404)
+
+def baseline_cache_key(version, year):
+    """
+    Cache key of the base plan tables of a budget year, as computed by the
+    hosts with the given version key, see registry.version_key
+    """
+    return 'taxbrain.baseline.{0}.{1}'.format(
+        hashlib.sha1(version.encode('utf-8')).hexdigest(), year)
+
+def dropq_get_results(job_ids, profiles=None, spans=None, trace_id=None,
+                      version=None):
+    """
+    Fetch and merge the year results of a run. Job profiles sent along
+    with the results are taken out and, if profiles is a dict, stored in
+    it by year. If spans is a list, the compute, serialize, transfer and
+    decode spans of each year are added to it, see tracing.py.
+    Raises IOError if any year can't be fetched, since the years are
+    merged by position and a gap would shift the ones after it.
+
+    The base plan tables of a year only depend on the code and data of the
+    hosts. With the version key of the hosts the run went to, they are
+    kept in the cache once per year and version, and hosts of that version
+    are asked not to send them again.
+    """
     ans = []
+    headers = trace_headers(trace_id)
+    headers['Accept'] = ACCEPT_HEADER
     for idx, id_hostname in enumerate(job_ids):
         id_, hostname = id_hostname
+        if id_ is None or hostname is None:
+            raise IOError("Year {0} of the run has no dropq job".format(idx))
         result_url = "http://{hn}/dropq_get_result".format(hn=hostname)
-        job_response = requests.get(result_url, params={'job_id':id_})
+        params = {'job_id': id_}
+        baseline_key = baseline_cache_key(version, START_YEAR + idx) if version else None
+        baseline = cache.get(baseline_key) if baseline_key else None
+        if baseline is not None:
+            params['baseline'] = version
+        fetch_start = time.time()
+        with timed('dropq_request_seconds', host=hostname, op='fetch'):
+            job_response = requests.get(result_url, params=params,
+                                        headers=headers)
+        fetch_seconds = time.time() - fetch_start
         if job_response.status_code == 200: # Valid response
-            ans.append(job_response.json())
+            inc('dropq_requests_total', host=hostname, op='fetch', outcome='ok')
+            content_type = job_response.headers.get('Content-Type', '')
+            decode_start = time.time()
+            with timed('taxbrain_stage_seconds', stage='decode_result'):
+                if content_type.startswith(DROPQ_BINARY_CONTENT_TYPE):
+                    result = decode_year_result(job_response.content)
+                else:
+                    result = job_response.json()
+            if spans is not None:
+                spans.extend(_fetch_spans(job_response.headers, idx, hostname,
+                                          fetch_start, fetch_seconds,
+                                          time.time() - decode_start))
+            profile = result.pop('profile', None)
+            if profile is not None and profiles is not None:
+                profiles[idx] = profile
+            if baseline_key is not None:
+                if all(name in result for name in BASELINE_TABLES):
+                    cache.add(baseline_key, {name: result[name]
+                                             for name in BASELINE_TABLES}, None)
+                elif baseline is not None:
+                    result.update(baseline)
+            ans.append(result)
+        else:
+            inc('dropq_requests_total', host=hostname, op='fetch', outcome='refused')
+            raise IOError("Could not fetch year {0} from {1}: status {2}".format(
+                idx, hostname, job_response.status_code))
+
+    if ENFORCE_REMOTE_VERSION_CHECK:
+        versions = [r.get('taxcalc_version', None) for r in ans]
+        if not all([ver==taxcalc_version for ver in versions]):
+            msg ="Got different taxcalc versions from workers. Bailing out"
+            print msg
+            raise IOError(msg)
+        versions = [r.get('dropq_version', None) for r in ans]
+        if not all([ver==dropq_version for ver in versions]):
+            msg ="Got different dropq versions from workers. Bailing out"
+            print msg
+            raise IOError(msg)
+
+    return merge_dropq_year_results(ans)
 
+def _fetch_spans(headers, year, hostname, fetch_start, fetch_seconds,
+                 decode_seconds):
+    """
+    Spans of fetching one year result, using the timings the host sent
+    """
+    spans = []
+    serialize = 0.0
+    for name, header in (('compute', COMPUTE_HEADER),
+                         ('serialize', SERIALIZE_HEADER)):
+        try:
+            seconds = float(headers[header])
+        except (KeyError, ValueError):
+            continue
+        spans.append(span(name, seconds, year, hostname))
+        if name == 'serialize':
+            serialize = seconds
+    spans.append(span('transfer', max(fetch_seconds - serialize, 0), year,
+                      hostname, fetch_start))
+    spans.append(span('decode', decode_seconds, year, hostname))
+    return spans
+
+def merge_dropq_year_results(year_results):
+    """
+    Merge the results of single year dropq jobs, given in budget year
+    order, into the multi-year result dict used for display.
+    """
     mY_dec = {}
     mX_dec = {}
     df_dec = {}
@@ -792,7 +965,7 @@ def dropq_get_results(job_ids):
     mX_bin = {}
     df_bin = {}
     fiscal_tots = []
-    for result in ans:
+    for result in year_results:
         mY_dec.update(result['mY_dec'])
         mX_dec.update(result['mX_dec'])
         df_dec.update(result['df_dec'])
@@ -801,21 +974,121 @@ def dropq_get_results(job_ids):
         df_bin.update(result['df_bin'])
         fiscal_tots.append(result['fiscal_tots'])
 
-    if ENFORCE_REMOTE_VERSION_CHECK:
-        versions = [r.get('taxcalc_version', None) for r in ans]
-        if not all([ver==taxcalc_version for ver in versions]):
-            msg ="Got different taxcalc versions from workers. Bailing out"
-            print msg
-            raise IOError(msg)
-        versions = [r.get('dropq_version', None) for r in ans]
-        if not all([ver==dropq_version for ver in versions]):
-            msg ="Got different dropq versions from workers. Bailing out"
-            print msg
-            raise IOError(msg)
-
-
     results = {'mY_dec': mY_dec, 'mX_dec': mX_dec, 'df_dec': df_dec,
                'mY_bin': mY_bin, 'mX_bin': mX_bin, 'df_bin': df_bin,
                'fiscal_tots': fiscal_tots}
 
     return results
+
+
+def expand_sweep_grid(grid, max_points=None):
+    """
+    Expand a parameter sweep specification into its grid points.
+
+    Parameters:
+    -----------
+    grid: dict mapping a TaxSaveInputs field name to either a list of values
+          or a {'start': x, 'stop': y, 'step': z} range, stop inclusive
+    max_points: largest number of grid points allowed. The size of the grid
+          is checked before any of it is built.
+
+    Returns:
+    --------
+    (names, points): the sorted field names and the list of grid points,
+    each a list of values in the same order as names
+    """
+    if not grid or len(grid) > MAX_SWEEP_PARAMS:
+        raise ValueError("A sweep varies between 1 and {0} fields".format(
+                         MAX_SWEEP_PARAMS))
+
+    names = sorted(grid)
+    ranges = {}
+    counts = []
+    for name in names:
+        spec = grid[name]
+        if isinstance(spec, dict):
+            start = float(spec['start'])
+            stop = float(spec['stop'])
+            step = float(spec['step'])
+            if step <= 0:
+                raise ValueError("Sweep step for {0} must be positive".format(name))
+            steps = (stop - start) / step
+            if math.isinf(steps) or math.isnan(steps):
+                raise ValueError("Sweep range for {0} is not finite".format(name))
+            # tolerate floating point error in (stop - start) / step
+            count = max(int(math.floor(steps + 1e-9)) + 1, 0)
+            ranges[name] = (start, step, count)
+        else:
+            count = len(spec)
+        if not count:
+            raise ValueError("Sweep over {0} has no values".format(name))
+        counts.append(count)
+
+    total = reduce(operator.mul, counts, 1)
+    if max_points is not None and total > max_points:
+        raise ValueError("The sweep has {0} points, at most {1} are allowed".format(
+                         total, max_points))
+
+    axes = []
+    for name in names:
+        if name in ranges:
+            start, step, count = ranges[name]
+            axes.append([round(start + i * step, 10) for i in range(count)])
+        else:
+            axes.append(list(grid[name]))
+    return names, [list(point) for point in itertools.product(*axes)]
+
+
+def split_baseline_tables(results):
+    """
+    Split dropq results into the base plan tables, which are shared by all
+    points of a sweep, and the remaining reform specific tables.
+    """
+    baseline = {k: v for k, v in results.items() if k in BASELINE_TABLES}
+    rest = {k: v for k, v in results.items() if k not in BASELINE_TABLES}
+    return baseline, rest
+
+
+def revenue_total(results):
+    """
+    Total revenue change over the budget window, None if results have no
+    usable fiscal_tots
+    """
+    try:
+        return sum(float(v) for v in results['fiscal_tots'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def sweep_revenue_table(names, points, point_results):
+    """
+    Build the consolidated revenue-vs-parameter table of a sweep.
+
+    Parameters:
+    -----------
+    names: swept field names
+
+    points: grid points, each a list of values ordered like names
+
+    point_results: the dropq results for each point, or None if that point
+                   has not finished yet
+
+    Returns:
+    --------
+    dict with the budget years and one row per grid point holding the
+    point's values, yearly revenue change and budget window total
+    """
+    years = list(range(START_YEAR, START_YEAR + NUM_BUDGET_YEARS))
+    rows = []
+    for point, results in zip(points, point_results):
+        row = {'point': dict(zip(names, point))}
+        if results is None:
+            row['fiscal_tots'] = None
+            row['total'] = None
+        else:
+            tots = [float(v) for v in results['fiscal_tots']]
+            row['fiscal_tots'] = tots
+            row['total'] = sum(tots)
+        rows.append(row)
+
+    return {'params': names, 'years': years, 'rows': rows}
@@ -0,0 +1,370 @@
+"""
+End-to-end load test of the submit, poll and fetch path against fake dropq
+hosts on the local machine.
+
+FakeDropqHost speaks the dropq protocol but only sleeps: each year job is
+ready after a configurable latency, start requests fail at a configurable
+rate and results are synthetic, padded to a configurable size. LoadTest
+points DROPQ_WORKERS at a set of fake hosts and drives virtual users,
+each with its own django.test.Client, through the input form, the
+processing page and the results page. Run it with
+
+    ./manage.py run_load_test --hosts 4 --users 20 --runs 3
+
+which works in a throwaway test database, like the test runner.
+"""
+from collections import defaultdict
+import BaseHTTPServer
+import SocketServer
+import json
+import random
+import threading
+import time
+import urlparse
+import uuid
+
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from .benchmarks import SAMPLE_FORM_DATA, synthetic_year_result
+from .helpers import taxcalc_version, dropq_version
+from .scheduler import percentile
+
+REPORT_PERCENTILES = (50, 90, 99)
+
+
+class FakeJobStore(object):
+    """
+    Year jobs of a fake host: each is ready once its latency has passed
+    """
+    def __init__(self, latency, jitter, straggler_rate, straggler_factor,
+                 failure_rate, result_bytes, seed):
+        self.latency = latency
+        self.jitter = jitter
+        self.straggler_rate = straggler_rate
+        self.straggler_factor = straggler_factor
+        self.failure_rate = failure_rate
+        self.padding = 'x' * result_bytes
+        self.rng = random.Random(seed)
+        self.jobs = {}
+        self.counts = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.counts[endpoint] += 1
+
+    def start(self, year_n):
+        """
+        Returns the new job id, or None for an injected failure
+        """
+        with self.lock:
+            if self.rng.random() < self.failure_rate:
+                return None
+            latency = self.latency * (1 + self.jitter * self.rng.uniform(-1, 1))
+            if self.rng.random() < self.straggler_rate:
+                latency *= self.straggler_factor
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = (year_n, time.time() + latency)
+        return job_id
+
+    def ready(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        return time.time() >= job[1]
+
+    def result(self, job_id):
+        with self.lock:
+            year_n, _ = self.jobs.pop(job_id)
+        result = synthetic_year_result(year_n)
+        result['taxcalc_version'] = taxcalc_version
+        result['dropq_version'] = dropq_version
+        if self.padding:
+            result['padding'] = self.padding
+        return result
+
+    def cancel(self, job_id):
+        with self.lock:
+            return self.jobs.pop(job_id, None) is not None
+
+
+class FakeDropqHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, body, content_type='text/plain'):
+        time.sleep(self.server.request_latency)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        path = urlparse.urlparse(self.path).path
+        jobs = self.server.jobs
+        jobs.count(path)
+        length = int(self.headers.getheader('content-length') or 0)
+        form = urlparse.parse_qs(self.rfile.read(length))
+
+        if path == '/dropq_start_job':
+            job_id = jobs.start(int(form.get('year', ['0'])[0]))
+            if job_id is None:
+                return self.respond(500, 'injected failure')
+            return self.respond(200, job_id)
+
+        if path == '/dropq_cancel_job':
+            if not jobs.cancel(form.get('job_id', [''])[0]):
+                return self.respond(404, 'unknown job')
+            return self.respond(200, 'cancelled')
+
+        self.respond(404, 'not found')
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        jobs = self.server.jobs
+        jobs.count(url.path)
+        job_id = urlparse.parse_qs(url.query).get('job_id', [''])[0]
+
+        if url.path == '/dropq_capabilities':
+            caps = {'taxcalc_version': taxcalc_version,
+                    'dropq_version': dropq_version,
+                    'dataset_version': 'loadtest',
+                    'capacity': self.server.capacity,
+                    'formats': ['application/json']}
+            return self.respond(200, json.dumps(caps), 'application/json')
+
+        if url.path == '/dropq_query_result':
+            ready = jobs.ready(job_id)
+            if ready is None:
+                return self.respond(404, 'unknown job')
+            return self.respond(200, 'YES' if ready else 'NO')
+
+        if url.path == '/dropq_get_result':
+            try:
+                result = jobs.result(job_id)
+            except KeyError:
+                return self.respond(404, 'unknown job')
+            return self.respond(200, json.dumps(result), 'application/json')
+
+        self.respond(404, 'not found')
+
+
+class FakeDropqHost(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A dropq host on 127.0.0.1 that fakes the year jobs.
+
+    latency: mean seconds until a year job is ready
+    jitter: latency varies uniformly by this fraction either way
+    straggler_rate, straggler_factor: share of jobs that take
+        straggler_factor times longer
+    failure_rate: share of start requests answered with a 500
+    result_bytes: padding added to every year result
+    request_latency: seconds added to every HTTP response
+    capacity: reported through /dropq_capabilities
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=1.0, jitter=0.2, straggler_rate=0.0,
+                 straggler_factor=5.0, failure_rate=0.0, result_bytes=0,
+                 request_latency=0.0, capacity=4, seed=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           FakeDropqHandler)
+        self.jobs = FakeJobStore(latency, jitter, straggler_rate,
+                                 straggler_factor, failure_rate, result_bytes,
+                                 seed)
+        self.request_latency = request_latency
+        self.capacity = capacity
+        self.thread = None
+
+    @property
+    def address(self):
+        return "127.0.0.1:{0}".format(self.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class RunStats(object):
+    """
+    Latencies and query counts collected by all virtual users
+    """
+    def __init__(self):
+        self.pages = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.run_seconds = []
+        self.run_queries = []
+        self.outcomes = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def page(self, name, seconds, queries):
+        with self.lock:
+            self.pages[name].append(seconds)
+            self.queries[name].append(queries)
+
+    def run(self, outcome, seconds=None, queries=None):
+        with self.lock:
+            self.outcomes[outcome] += 1
+            if outcome == 'done':
+                self.run_seconds.append(seconds)
+                self.run_queries.append(queries)
+
+
+class VirtualUser(threading.Thread):
+    """
+    Submits runs one after the other and follows each to its results page
+    """
+    def __init__(self, index, username, password, runs, poll_interval,
+                 timeout, stats):
+        super(VirtualUser, self).__init__(name='vu-{0}'.format(index))
+        self.daemon = True
+        self.index = index
+        self.credentials = {'username': username, 'password': password}
+        self.runs = runs
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.stats = stats
+        self.errors = []
+
+    def request(self, name, method, path, data=None):
+        start = time.time()
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(path, data or {})
+        self.stats.page(name, time.time() - start, len(queries))
+        return response, len(queries)
+
+    def reform(self, n):
+        # Vary the reform so no run is a repeat of another
+        data = dict(SAMPLE_FORM_DATA)
+        data['II_em'] = str(4000 + 10 * self.index + n)
+        return data
+
+    def one_run(self, n):
+        start = time.time()
+        response, queries = self.request('submit', 'post', '/taxbrain/',
+                                         self.reform(n))
+        if response.status_code != 302:
+            # Admission control or validation turned the run away
+            self.stats.run('refused')
+            return
+
+        location = response['Location']
+        while True:
+            if time.time() - start > self.timeout:
+                self.stats.run('timeout')
+                return
+            time.sleep(self.poll_interval)
+            response, polled = self.request('poll', 'get', location)
+            queries += polled
+            if response.status_code == 302:
+                break
+            # The processing page shows an error once the run failed or
+            # was cancelled
+            if response.context and response.context.get('error'):
+                self.stats.run('failed')
+                return
+
+        response, fetched = self.request('results', 'get', response['Location'])
+        queries += fetched
+        if response.status_code != 200:
+            self.stats.run('failed')
+            return
+        self.stats.run('done', time.time() - start, queries)
+
+    def run(self):
+        self.client = Client()
+        try:
+            if not self.client.login(**self.credentials):
+                raise RuntimeError("login failed for {0}".format(
+                    self.credentials['username']))
+            for n in range(self.runs):
+                self.one_run(n)
+        except Exception as e:
+            self.errors.append(repr(e))
+            self.stats.run('error')
+        finally:
+            connection.close()
+
+
+def summarize(values):
+    if not values:
+        return None
+    summary = {'count': len(values), 'mean': sum(values) / float(len(values)),
+               'max': max(values)}
+    for pct in REPORT_PERCENTILES:
+        summary['p{0}'.format(pct)] = percentile(values, pct)
+    return summary
+
+
+class LoadTest(object):
+    """
+    Drive users virtual users, each submitting runs runs, against hosts, a
+    list of started FakeDropqHosts. users is a list of (username, password)
+    of accounts allowed to use TaxBrain.
+    """
+    def __init__(self, hosts, users, runs, poll_interval=0.5, timeout=300):
+        self.hosts = hosts
+        self.users = users
+        self.runs = runs
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+    def use_hosts(self):
+        from django.core.cache import cache
+        from . import helpers
+        from .registry import CAPABILITY_CACHE_KEY
+
+        # Shared by reference with the scheduler and the registry
+        helpers.DROPQ_WORKERS[:] = [host.address for host in self.hosts]
+        cache.delete(CAPABILITY_CACHE_KEY)
+
+    def run(self):
+        self.use_hosts()
+        stats = RunStats()
+        vus = [VirtualUser(i, username, password, self.runs,
+                           self.poll_interval, self.timeout, stats)
+               for i, (username, password) in enumerate(self.users)]
+
+        start = time.time()
+        for vu in vus:
+            vu.start()
+        for vu in vus:
+            vu.join()
+        elapsed = time.time() - start
+
+        done = stats.outcomes.get('done', 0)
+        http_calls = defaultdict(int)
+        for host in self.hosts:
+            for endpoint, n in host.jobs.counts.items():
+                http_calls[endpoint] += n
+
+        return {
+            'hosts': len(self.hosts),
+            'users': len(self.users),
+            'runs_per_user': self.runs,
+            'elapsed_seconds': elapsed,
+            'outcomes': dict(stats.outcomes),
+            'throughput_runs_per_minute': done * 60.0 / elapsed if elapsed else 0,
+            'run_seconds': summarize(stats.run_seconds),
+            'page_seconds': dict((name, summarize(values))
+                                 for name, values in stats.pages.items()),
+            'db_queries_per_run': summarize(stats.run_queries),
+            'db_queries_per_page': dict((name, summarize(values))
+                                        for name, values in stats.queries.items()),
+            'dropq_calls': dict(http_calls),
+            'dropq_calls_per_run': dict((endpoint, n / float(done))
+                                        for endpoint, n in http_calls.items())
+                                   if done else {},
+            'errors': [e for vu in vus for e in vu.errors],
+        }
@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ("Time the helpers and page renders against synthetic dropq "
+            "results and optionally compare with a saved report")
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*',
+                            help="Benchmarks to run, all of them by default")
+        parser.add_argument('--years', type=int, default=None,
+                            help="Budget years in the synthetic results")
+        parser.add_argument('--repeat', type=int, default=5,
+                            help="Timing samples per benchmark")
+        parser.add_argument('--output', default=None,
+                            help="Write the JSON report to this file")
+        parser.add_argument('--baseline', default=None,
+                            help="Compare with the JSON report in this file")
+        parser.add_argument('--save-baseline', default=None,
+                            help="Also write the report here, to compare "
+                                 "against later")
+        parser.add_argument('--tolerance', type=float, default=None,
+                            help="Allowed slowdown against the baseline, "
+                                 "as a fraction")
+
+    def handle(self, *args, **options):
+        from webapp.apps.taxbrain import benchmarks
+
+        kwargs = {'repeat': options['repeat']}
+        if options['years']:
+            kwargs['num_years'] = options['years']
+        try:
+            report = benchmarks.run_benchmarks(options['names'], **kwargs)
+        except KeyError as e:
+            raise CommandError(e.args[0])
+
+        for name, timing in report['results'].items():
+            self.stdout.write("{0:<28} {1:>10.3f} ms  (median {2:.3f} ms, {3} x {4})".format(
+                name, timing['min'] * 1000, timing['median'] * 1000,
+                timing['repeat'], timing['number']))
+
+        for path in (options['output'], options['save_baseline']):
+            if path:
+                benchmarks.save_report(report, path)
+
+        if not options['baseline']:
+            return
+
+        tolerance = options['tolerance']
+        if tolerance is None:
+            tolerance = benchmarks.DEFAULT_TOLERANCE
+        baseline = benchmarks.load_report(options['baseline'])
+        if baseline.get('num_years') != report['num_years']:
+            self.stderr.write("Baseline was taken with {0} budget years, this run "
+                              "used {1}".format(baseline.get('num_years'),
+                                                report['num_years']))
+
+        slower = []
+        self.stdout.write("")
+        for name, before, now, ratio, verdict in benchmarks.compare_reports(
+                report, baseline, tolerance):
+            self.stdout.write("{0:<28} {1:>10.3f} ms -> {2:>10.3f} ms  x{3:.2f}  {4}".format(
+                name, before * 1000, now * 1000, ratio, verdict))
+            if verdict == 'slower':
+                slower.append(name)
+
+        if slower:
+            raise CommandError("Slower than the baseline: {0}".format(", ".join(slower)))
@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ("Refresh the dropq host capabilities, poll running dropq year "
+            "jobs, cancel abandoned runs, requeue lost claims, hand queued "
+            "jobs to hosts as slots free up and hedge stragglers")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=2.0,
+                            help="Seconds to wait between passes")
+
+    def handle(self, *args, **options):
+        from webapp.apps.taxbrain.models import DropqJob
+        from webapp.apps.taxbrain.registry import (refresh_capabilities,
+                                                   DROPQ_CAPABILITY_TTL)
+        from webapp.apps.taxbrain.scheduler import (refresh_jobs, dispatch_pending,
+                                                    cancel_abandoned_runs,
+                                                    hedge_stragglers,
+                                                    requeue_lost_claims)
+
+        probed_at = 0
+        while True:
+            # Well before requests would find the answers stale
+            if time.time() - probed_at >= DROPQ_CAPABILITY_TTL / 2.0:
+                refresh_capabilities()
+                probed_at = time.time()
+            refresh_jobs(DropqJob.objects.filter(status=DropqJob.SUBMITTED))
+            cancelled = cancel_abandoned_runs()
+            if cancelled:
+                self.stdout.write("cancelled {0} abandoned year jobs".format(cancelled))
+            lost = requeue_lost_claims()
+            if lost:
+                self.stdout.write("requeued {0} lost claims".format(lost))
+            submitted = dispatch_pending()
+            if submitted:
+                self.stdout.write("submitted {0} year jobs".format(submitted))
+            hedged = hedge_stragglers()
+            if hedged:
+                self.stdout.write("hedged {0} straggling year jobs".format(hedged))
+            time.sleep(options['interval'])
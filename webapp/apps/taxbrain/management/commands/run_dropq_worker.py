@@ -0,0 +1,23 @@
+import multiprocessing
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ("Run a local dropq worker implementing /dropq_start_job, "
+            "/dropq_query_result and /dropq_get_result")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1',
+                            help="Interface to listen on")
+        parser.add_argument('--port', type=int, default=5050,
+                            help="Port to listen on")
+        parser.add_argument('--processes', type=int,
+                            default=multiprocessing.cpu_count(),
+                            help="Size of the process pool running year jobs")
+
+    def handle(self, *args, **options):
+        from webapp.apps.taxbrain.dropq_service import serve
+
+        serve(host=options['host'], port=options['port'],
+              processes=options['processes'])
@@ -0,0 +1,118 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ("Drive virtual users through submitting, polling and viewing "
+            "runs against fake dropq hosts, in a throwaway test database")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hosts', type=int, default=2,
+                            help="Number of fake dropq hosts")
+        parser.add_argument('--capacity', type=int, default=4,
+                            help="Year jobs each fake host reports it can run")
+        parser.add_argument('--latency', type=float, default=1.0,
+                            help="Mean seconds a year job takes")
+        parser.add_argument('--jitter', type=float, default=0.2,
+                            help="Year job latency varies by this fraction")
+        parser.add_argument('--straggler-rate', type=float, default=0.0,
+                            help="Share of year jobs that straggle")
+        parser.add_argument('--straggler-factor', type=float, default=5.0,
+                            help="How many times longer a straggler takes")
+        parser.add_argument('--failure-rate', type=float, default=0.0,
+                            help="Share of job submissions the hosts refuse")
+        parser.add_argument('--result-bytes', type=int, default=0,
+                            help="Padding added to every year result")
+        parser.add_argument('--request-latency', type=float, default=0.0,
+                            help="Seconds added to every dropq HTTP response")
+        parser.add_argument('--users', type=int, default=10,
+                            help="Concurrent virtual users")
+        parser.add_argument('--runs', type=int, default=2,
+                            help="Runs each virtual user submits in turn")
+        parser.add_argument('--poll-interval', type=float, default=0.5,
+                            help="Seconds between polls of the processing page")
+        parser.add_argument('--timeout', type=float, default=300,
+                            help="Give up on a run after this many seconds")
+        parser.add_argument('--seed', type=int, default=0,
+                            help="Seed for the injected latencies and failures")
+        parser.add_argument('--output', default=None,
+                            help="Write the JSON report to this file")
+
+    def handle(self, *args, **options):
+        from django.contrib.auth.models import Permission, User
+        from django.db import connection
+        from django.test.utils import (setup_test_environment,
+                                       teardown_test_environment)
+        from webapp.apps.taxbrain.loadtest import FakeDropqHost, LoadTest
+
+        # Like the test runner: response contexts are recorded and nothing
+        # touches the real database
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+        hosts = []
+        try:
+            permission = Permission.objects.get(codename='view_inputs')
+            users = []
+            for i in range(options['users']):
+                username = 'loadtest{0}'.format(i)
+                user = User.objects.create_user(username, password=username)
+                user.user_permissions.add(permission)
+                users.append((username, username))
+
+            for i in range(options['hosts']):
+                hosts.append(FakeDropqHost(
+                    latency=options['latency'],
+                    jitter=options['jitter'],
+                    straggler_rate=options['straggler_rate'],
+                    straggler_factor=options['straggler_factor'],
+                    failure_rate=options['failure_rate'],
+                    result_bytes=options['result_bytes'],
+                    request_latency=options['request_latency'],
+                    capacity=options['capacity'],
+                    seed=options['seed'] + i).start())
+
+            report = LoadTest(hosts, users, options['runs'],
+                              poll_interval=options['poll_interval'],
+                              timeout=options['timeout']).run()
+        finally:
+            for host in hosts:
+                host.stop()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.report(report)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+    def report(self, report):
+        write = self.stdout.write
+        write("{0} users x {1} runs on {2} hosts in {3:.1f} s".format(
+            report['users'], report['runs_per_user'], report['hosts'],
+            report['elapsed_seconds']))
+        write("outcomes: " + ", ".join("{0} {1}".format(k, v) for k, v
+                                       in sorted(report['outcomes'].items())))
+        write("throughput: {0:.1f} runs/minute".format(
+            report['throughput_runs_per_minute']))
+
+        def line(label, summary, unit, scale=1):
+            if summary is None:
+                return
+            write("{0:<20} p50 {1:>9.3f}  p90 {2:>9.3f}  p99 {3:>9.3f}  "
+                  "max {4:>9.3f} {5}".format(
+                      label, summary['p50'] * scale, summary['p90'] * scale,
+                      summary['p99'] * scale, summary['max'] * scale, unit))
+
+        line("run", report['run_seconds'], "s")
+        for name, summary in sorted(report['page_seconds'].items()):
+            line(name, summary, "ms", 1000)
+        line("queries/run", report['db_queries_per_run'], "")
+        for name, summary in sorted(report['db_queries_per_page'].items()):
+            line("queries/" + name, summary, "")
+        for endpoint, n in sorted(report['dropq_calls_per_run'].items()):
+            write("{0:<20} {1:.1f} calls/run".format(endpoint, n))
+        for error in report['errors']:
+            self.stderr.write(error)
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ("Print the timers, counters and queue depth collected from every "
+            "process writing to METRICS_DIR")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-queue', action='store_true', default=False,
+                            help="Leave out the queue depth, which needs the database")
+
+    def handle(self, *args, **options):
+        from webapp.apps.taxbrain.metrics import collect, render_text
+        from webapp.apps.taxbrain.scheduler import queue_depth
+
+        gauges = [] if options['no_queue'] else queue_depth()
+        self.stdout.write(render_text(collect(), gauges), ending='')
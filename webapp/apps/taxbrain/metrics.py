@@ -0,0 +1,314 @@
+"""
+In-process timers and counters, exposed in the Prometheus text format.
+
+Recording a value is a dictionary update under a lock, cheap enough for the
+request path. Each process keeps its own totals; when METRICS_DIR is set,
+every process also writes its totals to METRICS_DIR/<host>-<pid>.json at most every
+METRICS_FLUSH_SECONDS, and the metrics endpoint adds up all the files so
+that every gunicorn and worker process is counted. Files of processes of
+this host that have exited, and files of any host not written for
+METRICS_STALE_SECONDS, are removed on read.
+
+    from .metrics import timed, inc
+
+    with timed('taxbrain_stage_seconds', stage='render'):
+        ...
+
+    @timed('taxbrain_stage_seconds', stage='package_up_vars')
+    def package_up_vars(...):
+        ...
+
+    inc('taxbrain_cache_requests_total', cache='capabilities', result='hit')
+"""
+from bisect import bisect_left
+import errno
+from functools import wraps
+import glob
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 10))
+# Files not rewritten for this long are left out and removed. A live process
+# writes its file again with its full totals the next time it records one.
+METRICS_STALE_SECONDS = float(os.environ.get('METRICS_STALE_SECONDS', 3600))
+
+# Upper bounds in seconds, from template fragments to whole budget years
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300)
+
+HELP = {
+    'taxbrain_stage_seconds': 'Time spent in each stage of handling a run',
+    'dropq_request_seconds': 'Duration of HTTP requests to dropq hosts',
+    'dropq_requests_total': 'HTTP requests to dropq hosts by outcome',
+    'taxbrain_cache_requests_total': 'Cache lookups by result',
+    'dropq_jobs': 'Year jobs by status and priority',
+    'dropq_backlog_seconds': 'Predicted slot-seconds of queued and running year jobs',
+    'dropq_required_hosts': 'Dropq hosts needed to clear the backlog in time',
+    'dropq_hosts': 'Usable dropq hosts',
+    'dropq_hedges_total': 'Duplicate year jobs sent for stragglers',
+    'dropq_cancelled_jobs_total': 'Year jobs cancelled',
+    'dropq_lost_claims_total': 'Claimed year jobs that never reached a host',
+    'dropq_repinned_runs_total': 'Runs restarted because no host served their version',
+    'taxbrain_admission_refused_total': 'Submissions refused by admission limit',
+    'taxbrain_view_profiled_total': 'Requests profiled, by view',
+    'taxbrain_view_queries_total': 'SQL queries of profiled requests',
+    'taxbrain_view_writes_total': 'SQL writes of profiled requests',
+    'taxbrain_view_sql_seconds_total': 'SQL time of profiled requests',
+    'taxbrain_view_cache_hits_total': 'Cache hits of profiled requests',
+    'taxbrain_view_cache_misses_total': 'Cache misses of profiled requests',
+    'taxbrain_view_response_bytes_total': 'Response bytes of profiled requests',
+    'taxbrain_query_budget_exceeded_total': 'Profiled requests over their query budget',
+}
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+class Registry(object):
+    """
+    Counters and histograms of one process
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        # key -> [bucket counts..., +Inf count], sum, count
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.last_flush = 0
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.maybe_flush()
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        idx = bisect_left(self.buckets, value)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            hist[0][idx] += 1
+            hist[1] += value
+            hist[2] += 1
+        self.maybe_flush()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'buckets': list(self.buckets),
+                'counters': [[name, list(labels), value] for (name, labels), value
+                             in self.counters.items()],
+                'histograms': [[name, list(labels), list(hist[0]), hist[1], hist[2]]
+                               for (name, labels), hist in self.histograms.items()],
+            }
+
+    def maybe_flush(self):
+        if not METRICS_DIR:
+            return
+        now = time.time()
+        if now - self.last_flush < METRICS_FLUSH_SECONDS:
+            return
+        self.last_flush = now
+        try:
+            self.flush()
+        except (IOError, OSError) as e:
+            print "Couldn't write metrics: ", e
+
+    def flush(self):
+        """
+        Write this process's totals to METRICS_DIR, atomically
+        """
+        if not os.path.isdir(METRICS_DIR):
+            try:
+                os.makedirs(METRICS_DIR)
+            except OSError:
+                # Another process created it first
+                pass
+        fd, tmp = tempfile.mkstemp(dir=METRICS_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.rename(tmp, _snapshot_path())
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+
+
+class timed(object):
+    """
+    Record the wall time of a block or function call, in seconds, in the
+    histogram name with the given labels
+    """
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        registry.observe(self.name, time.time() - self.start, **self.labels)
+        return False
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(self.name, **self.labels):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def merge_snapshots(snapshots):
+    """
+    Add up the counters and histograms of several processes
+    """
+    counters = {}
+    histograms = {}
+    buckets = list(DEFAULT_BUCKETS)
+    for snap in snapshots:
+        for name, labels, value in snap.get('counters', []):
+            key = (name, tuple(tuple(l) for l in labels))
+            counters[key] = counters.get(key, 0) + value
+        if snap.get('histograms') and snap.get('buckets') != buckets:
+            # Written by a build with other buckets, can't be added up
+            continue
+        for name, labels, counts, total, count in snap.get('histograms', []):
+            key = (name, tuple(tuple(l) for l in labels))
+            hist = histograms.setdefault(key, [[0] * len(counts), 0.0, 0])
+            hist[0] = [a + b for a, b in zip(hist[0], counts)]
+            hist[1] += total
+            hist[2] += count
+    return buckets, counters, histograms
+
+
+def _snapshot_path():
+    return os.path.join(METRICS_DIR, '{0}-{1}.json'.format(socket.gethostname(),
+                                                          os.getpid()))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM: alive, but run by another user
+        return e.errno != errno.ESRCH
+    return True
+
+
+def _is_stale(path, now):
+    """
+    Whether a file in METRICS_DIR was left by a process that has exited or
+    stopped writing. Only processes of this host can be looked up, files of
+    other hosts count by their age.
+    """
+    try:
+        if now - os.path.getmtime(path) > METRICS_STALE_SECONDS:
+            return True
+    except OSError:
+        return True
+    host, _, pid = os.path.splitext(os.path.basename(path))[0].rpartition('-')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    return not _pid_alive(int(pid))
+
+
+def collect():
+    """
+    Snapshots of every process that has written to METRICS_DIR, with this
+    process's current totals in place of its file. Stale files are removed
+    instead of read, and so are temporary files of flushes that never
+    finished.
+    """
+    snapshots = [registry.snapshot()]
+    if METRICS_DIR:
+        now = time.time()
+        mine = _snapshot_path()
+        for path in glob.glob(os.path.join(METRICS_DIR, '*.tmp')):
+            try:
+                if now - os.path.getmtime(path) > METRICS_STALE_SECONDS:
+                    os.remove(path)
+            except OSError:
+                continue
+        for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+            if path == mine:
+                continue
+            if _is_stale(path, now):
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Already removed by another reader
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (IOError, ValueError):
+                # Removed or half written while we looked
+                continue
+    return snapshots
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+def _format_bound(bound):
+    return repr(float(bound))
+
+
+def render_text(snapshots, gauges=None):
+    """
+    Render snapshots and extra gauges, a list of (name, labels dict, value),
+    in the Prometheus text exposition format
+    """
+    buckets, counters, histograms = merge_snapshots(snapshots)
+    lines = []
+    typed = set()
+
+    def header(name, kind):
+        if name in typed:
+            return
+        typed.add(name)
+        if name in HELP:
+            lines.append('# HELP {0} {1}'.format(name, HELP[name]))
+        lines.append('# TYPE {0} {1}'.format(name, kind))
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name, 'counter')
+        lines.append('{0}{1} {2}'.format(name, _format_labels(labels), value))
+
+    for (name, labels), (counts, total, count) in sorted(histograms.items()):
+        header(name, 'histogram')
+        cumulative = 0
+        bounds = [_format_bound(b) for b in buckets] + ['+Inf']
+        for bound, n in zip(bounds, counts):
+            cumulative += n
+            lines.append('{0}_bucket{1} {2}'.format(
+                name, _format_labels(labels + (('le', bound),)), cumulative))
+        lines.append('{0}_sum{1} {2!r}'.format(name, _format_labels(labels), total))
+        lines.append('{0}_count{1} {2}'.format(name, _format_labels(labels), count))
+
+    for name, labels, value in gauges or []:
+        header(name, 'gauge')
+        lines.append('{0}{1} {2}'.format(
+            name, _format_labels(tuple(sorted(labels.items()))), value))
+
+    return '\n'.join(lines) + '\n'
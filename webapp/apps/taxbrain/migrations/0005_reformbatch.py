@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+import jsonfield.fields
+import uuidfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('taxbrain', '0004_outputurl_user'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReformBatch',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('uuid', uuidfield.fields.UUIDField(null=True, default=None, editable=False, max_length=32, blank=True, unique=True)),
+                ('creation_date', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(default=None, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='taxsaveinputs',
+            name='batch',
+            field=models.ForeignKey(related_name='runs', default=None, blank=True, to='taxbrain.ReformBatch', null=True),
+        ),
+        migrations.AddField(
+            model_name='taxsaveinputs',
+            name='job_ids',
+            field=jsonfield.fields.JSONField(default=None, null=True, blank=True),
+        ),
+    ]
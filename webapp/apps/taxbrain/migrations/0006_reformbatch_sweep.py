@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taxbrain', '0005_reformbatch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reformbatch',
+            name='sweep',
+            field=jsonfield.fields.JSONField(default=None, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='reformbatch',
+            name='baseline_result',
+            field=jsonfield.fields.JSONField(default=None, null=True, blank=True),
+        ),
+    ]
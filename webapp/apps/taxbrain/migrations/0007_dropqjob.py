@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('taxbrain', '0006_reformbatch_sweep'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DropqJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('year', models.PositiveSmallIntegerField()),
+                ('priority', models.PositiveSmallIntegerField(default=0, choices=[(0, 'interactive'), (1, 'batch'), (2, 'warm-up')])),
+                ('status', models.CharField(default='queued', max_length=10, db_index=True, choices=[('queued', 'Queued'), ('submitted', 'Submitted'), ('done', 'Done'), ('failed', 'Failed')])),
+                ('user_mods', models.TextField()),
+                ('hostname', models.CharField(default=None, max_length=255, null=True, blank=True)),
+                ('remote_id', models.CharField(default=None, max_length=64, null=True, blank=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('submitted_at', models.DateTimeField(default=None, null=True, blank=True)),
+                ('finished_at', models.DateTimeField(default=None, null=True, blank=True)),
+                ('run', models.ForeignKey(related_name='dropq_jobs', to='taxbrain.TaxSaveInputs')),
+                ('user', models.ForeignKey(default=None, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='dropqjob',
+            index_together=set([('status', 'priority')]),
+        ),
+        migrations.RemoveField(
+            model_name='taxsaveinputs',
+            name='job_ids',
+        ),
+    ]
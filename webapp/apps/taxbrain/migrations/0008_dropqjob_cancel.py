@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taxbrain', '0007_dropqjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dropqjob',
+            name='polled_at',
+            field=models.DateTimeField(default=None, null=True, blank=True),
+        ),
+        migrations.AlterField(
+            model_name='dropqjob',
+            name='status',
+            field=models.CharField(default='queued', max_length=10, db_index=True, choices=[('queued', 'Queued'), ('submitted', 'Submitted'), ('done', 'Done'), ('failed', 'Failed'), ('cancelled', 'Cancelled')]),
+        ),
+    ]
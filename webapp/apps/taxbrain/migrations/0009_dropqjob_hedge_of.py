@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taxbrain', '0008_dropqjob_cancel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dropqjob',
+            name='hedge_of',
+            field=models.ForeignKey(related_name='hedges', default=None, blank=True, to='taxbrain.DropqJob', null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taxbrain', '0009_dropqjob_hedge_of'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dropqjob',
+            name='worker_version',
+            field=models.CharField(default=None, max_length=255, null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('taxbrain', '0010_dropqjob_worker_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dropqjob',
+            name='profile',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='RunProfile',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('kind', models.CharField(max_length=10, choices=[('request', 'Request'), ('job', 'Year job')])),
+                ('name', models.CharField(max_length=255)),
+                ('view', models.CharField(default='', max_length=100, blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('duration', models.FloatField(default=0)),
+                ('samples', models.PositiveIntegerField(default=0)),
+                ('data', models.TextField()),
+                ('run', models.ForeignKey(related_name='profiles', default=None, blank=True, to='taxbrain.TaxSaveInputs', null=True)),
+                ('user', models.ForeignKey(default=None, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taxbrain', '0011_runprofile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dropqjob',
+            name='trace_id',
+            field=models.CharField(default='', max_length=32, db_index=True, blank=True),
+        ),
+        migrations.CreateModel(
+            name='TraceSpan',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('trace_id', models.CharField(default='', max_length=32, db_index=True, blank=True)),
+                ('name', models.CharField(max_length=20)),
+                ('year', models.PositiveSmallIntegerField(default=None, null=True, blank=True)),
+                ('hostname', models.CharField(default=None, max_length=255, null=True, blank=True)),
+                ('start', models.DateTimeField(default=None, null=True, blank=True)),
+                ('duration', models.FloatField()),
+                ('run', models.ForeignKey(related_name='spans', to='taxbrain.TaxSaveInputs')),
+            ],
+        ),
+    ]
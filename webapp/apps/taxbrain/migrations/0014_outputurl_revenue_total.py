@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+def backfill_revenue_total(apps, schema_editor):
+    OutputUrl = apps.get_model('taxbrain', 'OutputUrl')
+    urls = (OutputUrl.objects.filter(revenue_total__isnull=True)
+            .select_related('unique_inputs')
+            .only('pk', 'unique_inputs', 'unique_inputs__tax_result'))
+    for url in urls.iterator():
+        results = url.unique_inputs.tax_result
+        try:
+            total = sum(float(v) for v in results['fiscal_tots'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        OutputUrl.objects.filter(pk=url.pk).update(revenue_total=total)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('taxbrain', '0013_dropqjob_durations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outputurl',
+            name='revenue_total',
+            field=models.FloatField(default=None, null=True, blank=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='outputurl',
+            index_together=set([('user', 'id')]),
+        ),
+        migrations.RunPython(backfill_revenue_total, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import zlib
+
+from django.db import models, migrations
+
+# Runs copied per bulk insert
+BATCH_SIZE = 100
+
+
+def move_results(apps, schema_editor):
+    TaxSaveInputs = apps.get_model('taxbrain', 'TaxSaveInputs')
+    TaxResult = apps.get_model('taxbrain', 'TaxResult')
+    runs = (TaxSaveInputs.objects.filter(tax_result__isnull=False)
+            .only('pk', 'tax_result'))
+    rows = []
+    for run in runs.iterator():
+        raw = json.dumps(run.tax_result)
+        rows.append(TaxResult(run_id=run.pk, data=zlib.compress(raw, 6),
+                              raw_bytes=len(raw)))
+        if len(rows) == BATCH_SIZE:
+            TaxResult.objects.bulk_create(rows)
+            rows = []
+    TaxResult.objects.bulk_create(rows)
+
+
+def restore_results(apps, schema_editor):
+    TaxSaveInputs = apps.get_model('taxbrain', 'TaxSaveInputs')
+    TaxResult = apps.get_model('taxbrain', 'TaxResult')
+    for result in TaxResult.objects.iterator():
+        results = json.loads(zlib.decompress(bytes(result.data)))
+        TaxSaveInputs.objects.filter(pk=result.run_id).update(tax_result=results)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taxbrain', '0014_outputurl_revenue_total'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaxResult',
+            fields=[
+                ('run', models.OneToOneField(related_name='result', primary_key=True, serialize=False, to='taxbrain.TaxSaveInputs')),
+                ('data', models.BinaryField()),
+                ('raw_bytes', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(move_results, restore_results),
+        migrations.RemoveField(
+            model_name='taxsaveinputs',
+            name='tax_result',
+        ),
+    ]
@@ -1,4 +1,6 @@
+import json
 import re
+import zlib
 
 from django.db import models
 from django.core import validators
@@ -311,16 +313,83 @@ class TaxSaveInputs(models.Model):
 
     """
 
-    # Result
-    tax_result = JSONField(default=None, blank=True, null=True)
     # Creation DateTime
     creation_date = models.DateTimeField(default=datetime.datetime(2015, 1, 1))
+    # Batch this run was submitted with through the API, if any
+    batch = models.ForeignKey('ReformBatch', null=True, blank=True,
+        default=None, related_name='runs')
 
     class Meta:
         permissions = (
             ("view_inputs", "Allowed to view Taxbrain."),
         )
 
+    # The results live in TaxResult, loaded only when tax_result is read
+    @property
+    def tax_result(self):
+        if not hasattr(self, '_tax_result'):
+            try:
+                self._tax_result = self.result.results()
+            except TaxResult.DoesNotExist:
+                return None
+        return self._tax_result
+
+    @tax_result.setter
+    def tax_result(self, value):
+        self._tax_result = value
+        self._tax_result_changed = True
+
+    @property
+    def has_result(self):
+        """
+        True if the results are stored, without loading them
+        """
+        if hasattr(self, '_tax_result'):
+            return self._tax_result is not None
+        return TaxResult.objects.filter(run=self.pk).exists()
+
+    def save(self, *args, **kwargs):
+        super(TaxSaveInputs, self).save(*args, **kwargs)
+        if getattr(self, '_tax_result_changed', False):
+            TaxResult.store(self.pk, self._tax_result)
+            self._tax_result_changed = False
+
+
+# zlib level of stored results
+RESULT_COMPRESSION_LEVEL = 6
+
+
+class TaxResult(models.Model):
+    """
+    The merged dropq results of a run, as zlib compressed JSON. Kept out of
+    TaxSaveInputs so that loading a run does not load its results.
+    """
+    run = models.OneToOneField(TaxSaveInputs, primary_key=True,
+        related_name='result')
+    data = models.BinaryField()
+    # Size of the uncompressed JSON
+    raw_bytes = models.IntegerField(default=0)
+
+    @staticmethod
+    def compress(results):
+        raw = json.dumps(results)
+        return zlib.compress(raw, RESULT_COMPRESSION_LEVEL), len(raw)
+
+    def results(self):
+        return json.loads(zlib.decompress(bytes(self.data)))
+
+    @classmethod
+    def store(cls, run_id, results):
+        """
+        Save the results of a run, replacing any it had; None removes them
+        """
+        if results is None:
+            cls.objects.filter(run=run_id).delete()
+            return
+        data, raw_bytes = cls.compress(results)
+        cls.objects.update_or_create(run_id=run_id,
+            defaults={'data': data, 'raw_bytes': raw_bytes})
+
 
 class OutputUrl(models.Model):
     """
@@ -331,9 +400,136 @@ class OutputUrl(models.Model):
     uuid = UUIDField(auto=True, default=None, null=True)
     taxcalc_vers = models.CharField(blank=True, default=None, null=True,
         max_length=50)
+    # Budget window total of fiscal_tots, so run listings need not load
+    # tax_result
+    revenue_total = models.FloatField(blank=True, default=None, null=True)
+
+    class Meta:
+        # Keyset pagination of a user's runs, newest first
+        index_together = [('user', 'id')]
 
     def get_absolute_url(self):
         kwargs = {
             'pk': self.pk
         }
         return reverse('output_detail', kwargs=kwargs)
+
+
+class ReformBatch(models.Model):
+    """
+    A group of reforms submitted together through the JSON API.
+    """
+    uuid = UUIDField(auto=True, default=None, null=True)
+    user = models.ForeignKey(User, null=True, default=None)
+    creation_date = models.DateTimeField(auto_now_add=True)
+    # For parameter sweeps: the swept field names and the grid points, in
+    # the same order as the batch's runs
+    sweep = JSONField(default=None, blank=True, null=True)
+    # Base plan tables shared by every point of a sweep
+    baseline_result = JSONField(default=None, blank=True, null=True)
+
+
+class DropqJob(models.Model):
+    """
+    One budget year of a run, as scheduled onto the dropq workers.
+    """
+    INTERACTIVE = 0
+    BATCH = 1
+    WARMUP = 2
+    PRIORITY_CHOICES = (
+        (INTERACTIVE, 'interactive'),
+        (BATCH, 'batch'),
+        (WARMUP, 'warm-up'),
+    )
+
+    QUEUED = 'queued'
+    SUBMITTED = 'submitted'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (SUBMITTED, 'Submitted'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    )
+
+    run = models.ForeignKey(TaxSaveInputs, related_name='dropq_jobs')
+    user = models.ForeignKey(User, null=True, default=None)
+    year = models.PositiveSmallIntegerField()
+    priority = models.PositiveSmallIntegerField(choices=PRIORITY_CHOICES,
+        default=INTERACTIVE)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+        default=QUEUED, db_index=True)
+    # Serialized user_mods sent to the dropq host
+    user_mods = models.TextField()
+    hostname = models.CharField(max_length=255, blank=True, default=None,
+        null=True)
+    # Job id assigned by the dropq host
+    remote_id = models.CharField(max_length=64, blank=True, default=None,
+        null=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    submitted_at = models.DateTimeField(blank=True, default=None, null=True)
+    finished_at = models.DateTimeField(blank=True, default=None, null=True)
+    # Last time anyone asked about the run, used to cancel abandoned runs
+    polled_at = models.DateTimeField(blank=True, default=None, null=True)
+    # Version key of the host the job was sent to, see registry.version_key
+    worker_version = models.CharField(max_length=255, blank=True, default=None,
+        null=True)
+    # The straggling job this one duplicates, for hedged requests
+    hedge_of = models.ForeignKey('self', null=True, blank=True, default=None,
+        related_name='hedges')
+    # Ask the dropq host for a sampled profile of the job
+    profile = models.BooleanField(default=False)
+    # Shared by all the jobs of a run, see tracing.py
+    trace_id = models.CharField(max_length=32, blank=True, default='',
+        db_index=True)
+    # Number of parameters the reform changes, see capacity.py
+    reform_size = models.PositiveSmallIntegerField(default=0)
+    # Compute time reported by the host when the result was fetched
+    compute_seconds = models.FloatField(blank=True, default=None, null=True)
+
+    class Meta:
+        index_together = [('status', 'priority')]
+
+
+class RunProfile(models.Model):
+    """
+    A sampled call profile of one request or year job, in the collapsed
+    stack format of sampler.SamplingProfiler
+    """
+    REQUEST = 'request'
+    JOB = 'job'
+    KIND_CHOICES = (
+        (REQUEST, 'Request'),
+        (JOB, 'Year job'),
+    )
+
+    run = models.ForeignKey(TaxSaveInputs, null=True, blank=True, default=None,
+        related_name='profiles')
+    user = models.ForeignKey(User, null=True, default=None)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    # Method and path of a request, year of a job
+    name = models.CharField(max_length=255)
+    view = models.CharField(max_length=100, blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    duration = models.FloatField(default=0)
+    samples = models.PositiveIntegerField(default=0)
+    data = models.TextField()
+
+
+class TraceSpan(models.Model):
+    """
+    Time a run spent in one stage, for one year job or the whole run
+    """
+    run = models.ForeignKey(TaxSaveInputs, related_name='spans')
+    trace_id = models.CharField(max_length=32, blank=True, default='',
+        db_index=True)
+    name = models.CharField(max_length=20)
+    year = models.PositiveSmallIntegerField(blank=True, default=None, null=True)
+    hostname = models.CharField(max_length=255, blank=True, default=None,
+        null=True)
+    start = models.DateTimeField(blank=True, default=None, null=True)
+    duration = models.FloatField()
@@ -0,0 +1,169 @@
+"""
+Per-view database and cache profiling.
+
+QueryProfilingMiddleware profiles a sample of requests, PROFILE_SAMPLE_RATE
+of them, and every request when QUERY_BUDGETS_ENFORCE is on. For each
+profiled request it counts the SQL queries, the writes among them, the
+total SQL time, the cache hits and misses and the bytes of the response,
+and adds them to the metrics under the name of the view.
+
+QUERY_BUDGETS maps url names to the most queries and writes a view may
+issue, e.g. {'output_detail': {'queries': 8, 'writes': 0}}. A profiled view
+that goes over its budget is counted in taxbrain_query_budget_exceeded_total;
+with QUERY_BUDGETS_ENFORCE on, as in webapp.test_settings, it raises
+QueryBudgetExceeded instead so that N+1 queries and writes on read fail
+the build.
+
+Cache lookups are only seen through a cache backend with
+ProfilingCacheMixin, such as ProfilingLocMemCache.
+"""
+import random
+import threading
+
+from django.conf import settings
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection
+
+from .metrics import inc
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+_local = threading.local()
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class RequestProfile(object):
+    """
+    Counts of one request, filled in while it runs
+    """
+    def __init__(self, view='unknown'):
+        self.view = view
+        self.queries = 0
+        self.writes = 0
+        self.sql_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.response_bytes = 0
+
+    def add_queries(self, queries):
+        for query in queries:
+            self.queries += 1
+            self.sql_seconds += float(query.get('time') or 0)
+            if query['sql'].lstrip().upper().startswith(WRITE_STATEMENTS):
+                self.writes += 1
+
+    def over_budget(self, budget):
+        """
+        Returns a description of every limit in budget this request went
+        over, empty if it kept to all of them
+        """
+        over = []
+        for limit, used in (('queries', self.queries), ('writes', self.writes)):
+            allowed = budget.get(limit)
+            if allowed is not None and used > allowed:
+                over.append("{0} {1} > {2}".format(limit, used, allowed))
+        return over
+
+    def record(self):
+        inc('taxbrain_view_profiled_total', view=self.view)
+        inc('taxbrain_view_queries_total', self.queries, view=self.view)
+        inc('taxbrain_view_writes_total', self.writes, view=self.view)
+        inc('taxbrain_view_sql_seconds_total', self.sql_seconds, view=self.view)
+        inc('taxbrain_view_cache_hits_total', self.cache_hits, view=self.view)
+        inc('taxbrain_view_cache_misses_total', self.cache_misses, view=self.view)
+        inc('taxbrain_view_response_bytes_total', self.response_bytes,
+            view=self.view)
+
+
+def current_profile():
+    """
+    The profile of the request this thread is handling, or None
+    """
+    return getattr(_local, 'profile', None)
+
+
+class QueryProfilingMiddleware(object):
+    """
+    Profile sampled requests. List it last in MIDDLEWARE_CLASSES so that
+    the session save and the other middleware are not charged to the view.
+    """
+    def process_request(self, request):
+        _local.profile = None
+        enforce = getattr(settings, 'QUERY_BUDGETS_ENFORCE', False)
+        rate = getattr(settings, 'PROFILE_SAMPLE_RATE', 0)
+        if not enforce and random.random() >= rate:
+            return None
+
+        _local.profile = RequestProfile()
+        request._profile_debug_cursor = connection.force_debug_cursor
+        # Start from an empty log, as Django does for every request, so the
+        # count doesn't depend on where a full log's deque wrapped
+        connection.queries_log.clear()
+        connection.force_debug_cursor = True
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        profile = current_profile()
+        if profile is not None and request.resolver_match is not None:
+            profile.view = request.resolver_match.view_name
+        return None
+
+    def process_response(self, request, response):
+        profile = current_profile()
+        if profile is None or not hasattr(request, '_profile_debug_cursor'):
+            return response
+        _local.profile = None
+
+        # The log keeps its last queries_log.maxlen queries, so a request
+        # making more is counted as making that many, still over any budget
+        profile.add_queries(list(connection.queries_log))
+        connection.force_debug_cursor = request._profile_debug_cursor
+        if not response.streaming:
+            profile.response_bytes = len(response.content)
+        profile.record()
+
+        budget = getattr(settings, 'QUERY_BUDGETS', {}).get(profile.view)
+        over = profile.over_budget(budget) if budget else []
+        if over:
+            msg = "{0} went over its query budget: {1}".format(
+                profile.view, ", ".join(over))
+            if getattr(settings, 'QUERY_BUDGETS_ENFORCE', False):
+                raise QueryBudgetExceeded(msg)
+            inc('taxbrain_query_budget_exceeded_total', view=profile.view)
+        return response
+
+
+class ProfilingCacheMixin(object):
+    """
+    Count the hits and misses of get in the current request profile and in
+    taxbrain_cache_requests_total. The get_many of BaseCache goes through
+    get, so backends that keep it are counted in full.
+    """
+    _missing = object()
+
+    def _count(self, hits, misses):
+        if hits:
+            inc('taxbrain_cache_requests_total', hits, cache='django', result='hit')
+        if misses:
+            inc('taxbrain_cache_requests_total', misses, cache='django',
+                result='miss')
+        profile = current_profile()
+        if profile is not None:
+            profile.cache_hits += hits
+            profile.cache_misses += misses
+
+    def get(self, key, default=None, version=None, **kwargs):
+        value = super(ProfilingCacheMixin, self).get(key, self._missing,
+                                                     version, **kwargs)
+        if value is self._missing:
+            self._count(0, 1)
+            return default
+        self._count(1, 0)
+        return value
+
+
+class ProfilingLocMemCache(ProfilingCacheMixin, LocMemCache):
+    pass
@@ -0,0 +1,137 @@
+"""
+Registry of what each dropq host can run.
+
+Every host in DROPQ_WORKERS is probed through /dropq_capabilities for its
+taxcalc and dropq versions, dataset version, capacity and payload formats.
+The answers are kept in the Django cache and consulted by the scheduler
+before a job is sent anywhere: unreachable hosts get no jobs, and with
+ENFORCE_REMOTE_VERSION_CHECK neither do hosts running other versions than
+this webapp.
+
+Probing stays out of web requests where it can. run_dropq_scheduler
+refreshes the answers on every pass. A request finding them older than
+DROPQ_CAPABILITY_TTL seconds uses them anyway and starts one refresh in a
+background thread. Only a cold cache makes a request probe, all hosts at
+once and for at most DROPQ_PROBE_DEADLINE seconds.
+
+All years of a run must be computed by the same code and data, so hosts are
+grouped by version key and each run is pinned to the group its first year
+went to.
+"""
+import os
+import threading
+import time
+
+from django.core.cache import cache
+
+from .helpers import (DROPQ_WORKERS, ENFORCE_REMOTE_VERSION_CHECK,
+                      dropq_capabilities, taxcalc_version, dropq_version)
+from .metrics import inc
+
+DROPQ_CAPABILITY_TTL = int(os.environ.get('DROPQ_CAPABILITY_TTL', 60))
+# Longest a request waits for hosts to answer when nothing is cached
+DROPQ_PROBE_DEADLINE = float(os.environ.get('DROPQ_PROBE_DEADLINE', 2))
+# (probe time, {hostname: capabilities}), kept until replaced
+CAPABILITY_CACHE_KEY = 'taxbrain.dropq_capabilities'
+REFRESH_LOCK_KEY = 'taxbrain.dropq_capabilities.refresh'
+
+# Version key of hosts that do not report their versions
+UNKNOWN_VERSION = 'unknown'
+
+
+def version_key(caps):
+    """
+    Hosts with the same key produce results that can be merged into one run
+    """
+    if not caps.get('taxcalc_version'):
+        return UNKNOWN_VERSION
+    return ":".join([caps['taxcalc_version'], caps.get('dropq_version') or '',
+                     caps.get('dataset_version') or ''])
+
+
+def is_compatible(caps, enforce=ENFORCE_REMOTE_VERSION_CHECK):
+    """
+    Whether a host may receive jobs at all. caps is None for hosts that
+    could not be reached.
+    """
+    if caps is None:
+        return False
+    if not enforce:
+        return True
+    return (caps.get('taxcalc_version') == taxcalc_version and
+            caps.get('dropq_version') == dropq_version)
+
+
+def probe_hosts(deadline=None):
+    """
+    {hostname: capabilities or None} for every dropq host, probed in
+    parallel. Hosts that haven't answered after deadline seconds count as
+    unreachable.
+    """
+    hostnames = [hostname for hostname in DROPQ_WORKERS if hostname]
+    registry = dict((hostname, None) for hostname in hostnames)
+
+    def probe(hostname):
+        registry[hostname] = dropq_capabilities(hostname)
+
+    threads = [threading.Thread(target=probe, args=(hostname,))
+               for hostname in hostnames]
+    end = None if deadline is None else time.time() + deadline
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(None if end is None else max(end - time.time(), 0))
+    return dict(registry)
+
+
+def refresh_capabilities(deadline=None):
+    """
+    Probe every dropq host and store the answers in the cache
+    """
+    registry = probe_hosts(deadline)
+    cache.set(CAPABILITY_CACHE_KEY, (time.time(), registry), None)
+    return registry
+
+
+def _refresh_in_background():
+    # One refresh at a time for all the processes sharing the cache
+    if not cache.add(REFRESH_LOCK_KEY, True, DROPQ_CAPABILITY_TTL):
+        return
+    thread = threading.Thread(target=refresh_capabilities)
+    thread.daemon = True
+    thread.start()
+
+
+def host_capabilities():
+    """
+    {hostname: capabilities or None}. Answers older than
+    DROPQ_CAPABILITY_TTL are still used while a background refresh
+    replaces them; only a cold cache waits for the hosts.
+    """
+    cached = cache.get(CAPABILITY_CACHE_KEY)
+    if cached is None:
+        inc('taxbrain_cache_requests_total', cache='capabilities', result='miss')
+        return refresh_capabilities(DROPQ_PROBE_DEADLINE)
+
+    probed_at, registry = cached
+    if time.time() - probed_at > DROPQ_CAPABILITY_TTL:
+        inc('taxbrain_cache_requests_total', cache='capabilities', result='stale')
+        _refresh_in_background()
+    else:
+        inc('taxbrain_cache_requests_total', cache='capabilities', result='hit')
+    return registry
+
+
+def usable_hosts(default_capacity):
+    """
+    {hostname: (version key, capacity)} for the hosts that may receive jobs.
+    Hosts that do not report a capacity get default_capacity.
+    """
+    hosts = {}
+    for hostname, caps in host_capabilities().items():
+        if not is_compatible(caps):
+            continue
+        capacity = caps.get('capacity') or default_capacity
+        hosts[hostname] = (version_key(caps), int(capacity))
+    return hosts
@@ -0,0 +1,167 @@
+"""
+An opt-in sampling profiler for single requests and year jobs.
+
+SamplingProfiler runs a thread that looks at the stack of the profiled
+thread every PROFILE_INTERVAL seconds through sys._current_frames and
+counts each distinct stack. Nothing is installed on the profiled thread,
+so a profile costs the same however deep or hot the code is, and nothing
+at all runs unless a profile was asked for.
+
+Profiles are kept in the "collapsed" format, one stack per line with its
+sample count,
+
+    views.py:output_detail:213;helpers.py:taxcalc_results_to_tables:640 57
+
+which flamegraph.pl, speedscope and most other flame graph viewers read.
+
+Staff users ask for a profile of a request with an "X-Profile: 1" header
+or a profile=1 parameter; SamplingProfilerMiddleware stores it as a
+RunProfile and names its download URL in the X-Profile-Url response
+header. The same flag on a submission also profiles its year jobs on the
+dropq hosts that support it.
+"""
+from collections import Counter
+import os
+import sys
+import threading
+import time
+
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+# Stacks deeper than this are cut at the root end
+MAX_STACK_DEPTH = 100
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+
+# Views whose pk is the pk of a TaxSaveInputs
+RUN_VIEWS = ('tax_results', 'cancel_run', 'api_run_status')
+# Views whose pk is the pk of an OutputUrl
+OUTPUT_VIEWS = ('output_detail', 'csv_output', 'csv_input')
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return "{0}:{1}:{2}".format(os.path.basename(code.co_filename),
+                                code.co_name, frame.f_lineno)
+
+
+class SamplingProfiler(object):
+    """
+    Sample the stack of the thread that creates it until stopped.
+
+        with SamplingProfiler() as profiler:
+            ...
+        text = profiler.collapsed()
+    """
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.target = threading.current_thread().ident
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started = time.time()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.time() - self.started
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            if frame is None:
+                return
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            # Drop the reference to the live frame before the next wait
+            frame = None
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """
+        The profile in the collapsed stack format, busiest stacks first
+        """
+        return '\n'.join("{0} {1}".format(stack, count)
+                         for stack, count in self.stacks.most_common())
+
+
+def profile_requested(request):
+    """
+    True if a staff user asked for this request, and the runs it submits,
+    to be profiled
+    """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_staff:
+        return False
+    return (request.META.get(PROFILE_HEADER) == '1' or
+            request.GET.get('profile') == '1' or
+            (request.method == 'POST' and request.POST.get('profile') == '1'))
+
+
+def _run_for_view(view_name, view_kwargs):
+    from .models import OutputUrl
+
+    pk = view_kwargs.get('pk')
+    if pk is None:
+        return None
+    if view_name in RUN_VIEWS:
+        return int(pk)
+    if view_name in OUTPUT_VIEWS:
+        return (OutputUrl.objects.filter(pk=pk)
+                .values_list('unique_inputs_id', flat=True).first())
+    return None
+
+
+class SamplingProfilerMiddleware(object):
+    """
+    Profile the requests of staff users that ask for it. List it after
+    AuthenticationMiddleware.
+    """
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not profile_requested(request):
+            return None
+        request._sampling_profiler = SamplingProfiler().start()
+        request._sampling_view = (request.resolver_match.view_name
+                                  if request.resolver_match else view_func.__name__)
+        request._sampling_kwargs = view_kwargs
+        return None
+
+    def process_response(self, request, response):
+        profiler = getattr(request, '_sampling_profiler', None)
+        if profiler is None:
+            return response
+        profiler.stop()
+
+        from django.core.urlresolvers import reverse
+        from .models import RunProfile
+
+        view = request._sampling_view
+        profile = RunProfile.objects.create(
+            run_id=_run_for_view(view, request._sampling_kwargs),
+            user=request.user,
+            kind=RunProfile.REQUEST,
+            name="{0} {1}".format(request.method, request.path)[:255],
+            view=view[:100],
+            duration=profiler.duration,
+            samples=profiler.samples,
+            data=profiler.collapsed())
+        response['X-Profile-Url'] = reverse('run_profile', kwargs={'pk': profile.pk})
+        return response
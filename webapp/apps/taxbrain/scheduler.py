@@ -0,0 +1,799 @@
+"""
+Scheduling of dropq year jobs.
+
+Every run is split into one DropqJob per budget year.  Jobs wait in the
+database until a dropq host has a free slot, and are then handed out in
+order of priority class (interactive before batch before warm-up), then by
+the submitting user's current share of the cluster, then by year.  Ordering
+by year before creation time interleaves the years of concurrent runs, so a
+large batch cannot hold every slot while a single interactive run waits.
+
+A few slots on each host are held back for interactive jobs so that
+browser submissions never queue behind a batch.
+
+New runs are only admitted while the queue is below its global and per-user
+limits; beyond that submissions are turned away with an estimate of when to
+retry instead of piling up work that cannot finish.
+
+Runs can be cancelled, which drops their queued jobs and tells the hosts to
+abandon the running ones. Interactive runs whose processing page stops
+polling are cancelled automatically after DROPQ_ABANDON_SECONDS.
+
+A run is only as fast as its slowest year, so a year job that runs past a
+high percentile of recent durations for that year gets a duplicate (a
+hedge) on another host. Whichever copy finishes first is kept and the other
+is cancelled. Hedges only use slots left free after normal dispatch and are
+capped at a fraction of the running jobs.
+
+Hosts come from the capability registry, so only reachable, compatible hosts
+receive jobs, and every year of a run goes to hosts with the same version.
+"""
+from collections import defaultdict
+from datetime import timedelta
+import json
+import math
+import os
+
+from django.core.cache import cache
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from .helpers import (MAX_ATTEMPTS_SUBMIT_JOB, NUM_BUDGET_YEARS,
+                      START_YEAR, dropq_submit_year, dropq_job_ready,
+                      dropq_cancel_job)
+from .metrics import timed, inc
+from .capacity import (duration_model, backlog_seconds, pending_jobs,
+                       required_hosts, DROPQ_TARGET_DRAIN_SECONDS)
+from .models import DropqJob
+from .registry import usable_hosts
+from .tracing import new_trace_id
+
+# Concurrent year jobs a dropq host accepts if it does not report a capacity
+DROPQ_HOST_CAPACITY = int(os.environ.get('DROPQ_HOST_CAPACITY', 4))
+# Slots per host that only interactive jobs may use
+DROPQ_INTERACTIVE_RESERVE = int(os.environ.get('DROPQ_INTERACTIVE_RESERVE', 1))
+
+# Admission limits. Runs are in flight until their last year job finishes.
+DROPQ_MAX_RUNS = int(os.environ.get('DROPQ_MAX_RUNS', 2000))
+DROPQ_MAX_QUEUED_JOBS = int(os.environ.get('DROPQ_MAX_QUEUED_JOBS', 20000))
+DROPQ_MAX_USER_RUNS = int(os.environ.get('DROPQ_MAX_USER_RUNS', 500))
+DROPQ_MAX_USER_QUEUED_JOBS = int(os.environ.get('DROPQ_MAX_USER_QUEUED_JOBS', 5000))
+
+# A job claimed for a host that has no remote id after this long was lost
+# by a dispatcher that died or failed while sending it, and is requeued
+DROPQ_CLAIM_TIMEOUT = int(os.environ.get('DROPQ_CLAIM_TIMEOUT', 60))
+
+# A run pinned to a version no usable host serves, with no job sent or
+# finished for this long, starts over on the versions still served
+DROPQ_PIN_TIMEOUT = int(os.environ.get('DROPQ_PIN_TIMEOUT', 600))
+
+# Polls hand out free slots at most this often, see move_queue
+DROPQ_DISPATCH_INTERVAL = int(os.environ.get('DROPQ_DISPATCH_INTERVAL', 2))
+DISPATCH_LOCK_KEY = 'taxbrain.dispatch'
+
+# Interactive runs nobody has polled for this long are cancelled
+DROPQ_ABANDON_SECONDS = int(os.environ.get('DROPQ_ABANDON_SECONDS', 120))
+
+# A running year job is hedged once it has taken longer than this
+# percentile of recent durations for its year
+DROPQ_HEDGE_PERCENTILE = float(os.environ.get('DROPQ_HEDGE_PERCENTILE', 95))
+# Largest share of the running jobs that may be hedges
+DROPQ_HEDGE_BUDGET = float(os.environ.get('DROPQ_HEDGE_BUDGET', 0.05))
+# Finished jobs needed before durations are trusted for hedging
+HEDGE_MIN_SAMPLES = 20
+# Number of recent jobs the hedge thresholds are taken over
+HEDGE_SAMPLE = 500
+
+
+class Overloaded(Exception):
+    """
+    Raised when a submission would take the queue past one of its limits.
+    retry_after is a rough number of seconds until there is room again.
+    """
+    def __init__(self, message, retry_after):
+        super(Overloaded, self).__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_user_weights(spec):
+    """
+    Parse 'alice:2,bob:0.5' into {'alice': 2.0, 'bob': 0.5}. Users that are
+    not listed get a weight of 1.
+    """
+    weights = {}
+    for item in spec.split(','):
+        if ':' not in item:
+            continue
+        name, weight = item.rsplit(':', 1)
+        weights[name.strip()] = float(weight)
+    return weights
+
+DROPQ_USER_WEIGHTS = parse_user_weights(os.environ.get('DROPQ_USER_WEIGHTS', ''))
+
+
+def _user_key(job):
+    return job.user_id
+
+
+def plan_dispatch(candidates, host_free, user_load, weights=None,
+                  reserve=DROPQ_INTERACTIVE_RESERVE, host_versions=None,
+                  run_versions=None):
+    """
+    Decide which queued jobs go to which host.
+
+    candidates: queued jobs, each with priority, year, created, user_id and
+                run_id
+    host_free: {hostname: free slots}
+    user_load: {user_id: jobs currently running}
+    weights: {user_id: fair-share weight}
+    host_versions: {hostname: version key}
+    run_versions: {run_id: version key} for runs already pinned to a version
+
+    Returns a list of (job, hostname) pairs. Jobs are taken greedily: after
+    each pick the user's load goes up, so the next pick favors whoever has
+    the smallest weighted share at that point. The first job placed for a
+    run pins the run to its host's version.
+    """
+    weights = weights or {}
+    host_versions = host_versions or {}
+    run_versions = dict(run_versions or {})
+    host_free = dict(host_free)
+    user_load = defaultdict(int, user_load)
+    remaining = list(candidates)
+    plan = []
+
+    def sort_key(job):
+        share = user_load[_user_key(job)] / float(weights.get(_user_key(job), 1))
+        return (job.priority, share, job.year, job.created)
+
+    while remaining:
+        job = min(remaining, key=sort_key)
+        # Non-interactive jobs must leave the reserve free on the host
+        floor = 0 if job.priority == DropqJob.INTERACTIVE else reserve
+        hosts = [h for h, free in host_free.items() if free > floor]
+        pinned = run_versions.get(job.run_id)
+        if pinned is not None:
+            hosts = [h for h in hosts if host_versions.get(h) == pinned]
+            if not hosts:
+                # Hosts of this run's version are full, others may not be
+                remaining.remove(job)
+                continue
+        if not hosts:
+            if job.priority == DropqJob.INTERACTIVE:
+                break
+            # Only interactive work can still be placed
+            remaining = [j for j in remaining
+                         if j.priority == DropqJob.INTERACTIVE]
+            continue
+        hostname = max(hosts, key=lambda h: host_free[h])
+        host_free[hostname] -= 1
+        user_load[_user_key(job)] += 1
+        if hostname in host_versions:
+            run_versions.setdefault(job.run_id, host_versions[hostname])
+        remaining.remove(job)
+        plan.append((job, hostname))
+    return plan
+
+
+def enqueue_runs(runs, user_mods, priority, user=None, profile=False):
+    """
+    Queue the year jobs for each run in runs and hand out whatever fits.
+    user_mods holds the output of package_up_vars for each run. With
+    profile, the dropq hosts are asked for a sampled profile of each job.
+    """
+    jobs = []
+    now = timezone.now()
+    for run, mods in zip(runs, user_mods):
+        payload = json.dumps({START_YEAR: mods})
+        trace_id = new_trace_id()
+        for year in range(0, NUM_BUDGET_YEARS):
+            jobs.append(DropqJob(run=run, user=user, year=year,
+                                 priority=priority, user_mods=payload,
+                                 polled_at=now, profile=profile,
+                                 trace_id=trace_id, reform_size=len(mods)))
+    DropqJob.objects.bulk_create(jobs)
+    dispatch_pending()
+
+
+def _pending_jobs():
+    return DropqJob.objects.filter(status__in=[DropqJob.QUEUED,
+                                               DropqJob.SUBMITTED])
+
+
+def check_admission(user, num_runs):
+    """
+    Raise Overloaded if queueing num_runs more runs for user would exceed
+    the global or per-user limits on in-flight runs and queued year jobs.
+    """
+    new_jobs = num_runs * NUM_BUDGET_YEARS
+    queued = DropqJob.objects.filter(status=DropqJob.QUEUED)
+    runs = _pending_jobs().values('run').distinct()
+
+    # (queryset, limit, units being added, year jobs per unit, description)
+    limits = [(queued, DROPQ_MAX_QUEUED_JOBS, new_jobs, 1, 'year jobs'),
+              (runs, DROPQ_MAX_RUNS, num_runs, NUM_BUDGET_YEARS, 'runs')]
+    if user is not None:
+        limits += [(queued.filter(user=user), DROPQ_MAX_USER_QUEUED_JOBS,
+                    new_jobs, 1, 'of your year jobs'),
+                   (runs.filter(user=user), DROPQ_MAX_USER_RUNS, num_runs,
+                    NUM_BUDGET_YEARS, 'of your runs')]
+
+    for queryset, limit, adding, jobs_each, what in limits:
+        current = queryset.count()
+        if current + adding > limit:
+            # Wait for enough of the queue to drain to make room
+            excess = (current + adding - limit) * jobs_each
+            retry_after = int(math.ceil(queue_wait_seconds(excess)))
+            inc('taxbrain_admission_refused_total', limit=what)
+            msg = ("The calculators are busy: {0} {1} are already waiting. "
+                   "Please try again in about {2}.").format(
+                       current, what, format_wait(retry_after))
+            raise Overloaded(msg, retry_after)
+
+
+def average_job_seconds():
+    """
+    Mean run time of the most recently finished year jobs
+    """
+    return duration_model().mean_seconds()
+
+
+def cluster_slots(priority=DropqJob.INTERACTIVE):
+    """
+    Number of year jobs the cluster runs at once for the given priority
+    """
+    reserve = 0
+    if priority != DropqJob.INTERACTIVE:
+        reserve = DROPQ_INTERACTIVE_RESERVE
+    capacities = [capacity for _, capacity in
+                  usable_hosts(DROPQ_HOST_CAPACITY).values()]
+    return max(sum(max(capacity - reserve, 0) for capacity in capacities), 1)
+
+
+def queue_wait_seconds(num_jobs, priority=DropqJob.INTERACTIVE, job_seconds=None):
+    """
+    Time for the cluster to work through num_jobs year jobs
+    """
+    if job_seconds is None:
+        job_seconds = average_job_seconds()
+    return num_jobs / float(cluster_slots(priority)) * job_seconds
+
+
+def format_wait(seconds):
+    if seconds < 90:
+        return "a minute"
+    if seconds < 90 * 60:
+        return "{0} minutes".format(int(round(seconds / 60.0)))
+    return "{0:.1f} hours".format(seconds / 3600.0)
+
+
+def run_progress(run_id):
+    """
+    Summarize where a run stands: how many of its year jobs are queued,
+    running and done, its position in the queue (1 when nothing is ahead
+    of it) and the estimated seconds until it starts and finishes.
+    """
+    counts = dict(DropqJob.objects.filter(run=run_id, hedge_of__isnull=True)
+                  .values_list('status').annotate(n=Count('id')))
+    progress = {
+        'queued': counts.get(DropqJob.QUEUED, 0),
+        'running': counts.get(DropqJob.SUBMITTED, 0),
+        'done': counts.get(DropqJob.DONE, 0),
+        'position': 0,
+        'eta_start_seconds': 0,
+        'eta_seconds': 0,
+    }
+    if not progress['queued'] and not progress['running']:
+        return progress
+
+    model = duration_model()
+    job_seconds = model.mean_seconds()
+    first = (DropqJob.objects.filter(run=run_id, status=DropqJob.QUEUED)
+             .order_by('year', 'created').first())
+    ahead = 0
+    if first is not None:
+        # Same ordering as the dispatcher, ignoring fair share
+        jobs_ahead = DropqJob.objects.filter(status=DropqJob.QUEUED).filter(
+            Q(priority__lt=first.priority) |
+            Q(priority=first.priority, year__lt=first.year) |
+            Q(priority=first.priority, year=first.year,
+              created__lt=first.created))
+        ahead = jobs_ahead.count()
+        progress['position'] = jobs_ahead.values('run').distinct().count() + 1
+        progress['eta_start_seconds'] = int(queue_wait_seconds(
+            ahead, first.priority, job_seconds))
+        priority = first.priority
+    else:
+        priority = DropqJob.INTERACTIVE
+
+    # Remaining waves of this run's own jobs after the ones ahead of it,
+    # then its slowest year
+    remaining = queue_wait_seconds(ahead + progress['queued'], priority,
+                                   job_seconds)
+    unfinished = (DropqJob.objects.filter(run=run_id, hedge_of__isnull=True,
+                                          status__in=[DropqJob.QUEUED,
+                                                      DropqJob.SUBMITTED])
+                  .values_list('year', 'reform_size'))
+    slowest = max([model.predict(year, size) for year, size in unfinished] or
+                  [job_seconds])
+    progress['eta_seconds'] = int(remaining + slowest)
+    return progress
+
+
+def new_run_eta(reform_size, priority=DropqJob.INTERACTIVE):
+    """
+    Predicted seconds until a run submitted now would finish: the queued
+    jobs it would wait behind, then its own years
+    """
+    model = duration_model()
+    ahead = DropqJob.objects.filter(status=DropqJob.QUEUED,
+                                    priority__lte=priority).count()
+    wait = queue_wait_seconds(ahead + NUM_BUDGET_YEARS, priority,
+                              model.mean_seconds())
+    slowest = max(model.predict(year, reform_size)
+                  for year in range(NUM_BUDGET_YEARS))
+    return wait + slowest
+
+
+def _host_capacity(hosts):
+    """
+    Mean slots of the given hosts, DROPQ_HOST_CAPACITY when there are none
+    """
+    capacities = [capacity for _, capacity in hosts.values()]
+    if not capacities:
+        return DROPQ_HOST_CAPACITY
+    return sum(capacities) / float(len(capacities))
+
+
+def capacity_report(reform_size=1):
+    """
+    The duration model, the backlog and the number of dropq hosts needed
+    to clear it within DROPQ_TARGET_DRAIN_SECONDS, for autoscaling
+    """
+    model = duration_model()
+    hosts = usable_hosts(DROPQ_HOST_CAPACITY)
+    backlog = backlog_seconds(model)
+    return {
+        'hosts': len(hosts),
+        'slots': sum(capacity for _, capacity in hosts.values()),
+        'backlog_seconds': backlog,
+        'target_drain_seconds': DROPQ_TARGET_DRAIN_SECONDS,
+        'required_hosts': required_hosts(backlog, _host_capacity(hosts)),
+        'new_run_eta_seconds': new_run_eta(reform_size),
+        'model': model.describe(),
+    }
+
+
+def _host_load():
+    running = (DropqJob.objects.filter(status=DropqJob.SUBMITTED)
+               .values('hostname').annotate(n=Count('id')))
+    return dict((row['hostname'], row['n']) for row in running)
+
+
+def _user_load():
+    running = (DropqJob.objects.filter(status=DropqJob.SUBMITTED)
+               .values('user').annotate(n=Count('id')))
+    return dict((row['user'], row['n']) for row in running)
+
+
+def requeue_lost_claims():
+    """
+    Put back in the queue the jobs claimed more than DROPQ_CLAIM_TIMEOUT
+    seconds ago that never got a remote id, so they stop holding a host
+    slot. A job lost this way too often fails like one the hosts refuse.
+    Returns the number of jobs requeued or failed.
+    """
+    cutoff = timezone.now() - timedelta(seconds=DROPQ_CLAIM_TIMEOUT)
+    lost = DropqJob.objects.filter(status=DropqJob.SUBMITTED,
+                                   remote_id__isnull=True,
+                                   submitted_at__lt=cutoff)
+    if not lost.exists():
+        return 0
+    cleared = dict(hostname=None, worker_version=None, submitted_at=None,
+                   attempts=F('attempts') + 1)
+    failed = lost.filter(attempts__gte=MAX_ATTEMPTS_SUBMIT_JOB - 1).update(
+        status=DropqJob.FAILED, **cleared)
+    requeued = lost.update(status=DropqJob.QUEUED, **cleared)
+    if failed or requeued:
+        inc('dropq_lost_claims_total', failed + requeued)
+    return failed + requeued
+
+
+def repin_stranded_runs(host_versions):
+    """
+    Start over the queued runs pinned to a version that none of the usable
+    hosts in host_versions ({hostname: version key}) serves, once nothing
+    has been sent or finished for them in DROPQ_PIN_TIMEOUT seconds. Their
+    finished years can't be merged with years from another version, so
+    every year goes back in the queue unpinned and open hedges are
+    cancelled. Nothing is restarted while no host is usable at all.
+    Returns the number of runs restarted.
+    """
+    versions = set(host_versions.values())
+    if not versions:
+        return 0
+
+    queued_runs = DropqJob.objects.filter(status=DropqJob.QUEUED).values('run')
+    pinned = set(DropqJob.objects.filter(run__in=queued_runs,
+                                         worker_version__isnull=False)
+                 .exclude(worker_version__in=versions)
+                 .values_list('run', flat=True).distinct())
+    if not pinned:
+        return 0
+    cutoff = timezone.now() - timedelta(seconds=DROPQ_PIN_TIMEOUT)
+    active = set(DropqJob.objects.filter(run__in=pinned)
+                 .filter(Q(submitted_at__gte=cutoff) | Q(finished_at__gte=cutoff))
+                 .values_list('run', flat=True).distinct())
+    stranded = pinned - active
+    if not stranded:
+        return 0
+
+    jobs = DropqJob.objects.filter(run__in=stranded)
+    jobs.filter(hedge_of__isnull=False,
+                status__in=[DropqJob.SUBMITTED, DropqJob.DONE]).update(
+        status=DropqJob.CANCELLED, finished_at=timezone.now())
+    jobs.filter(hedge_of__isnull=True,
+                status__in=[DropqJob.SUBMITTED, DropqJob.DONE]).update(
+        status=DropqJob.QUEUED, hostname=None, remote_id=None,
+        submitted_at=None, finished_at=None, compute_seconds=None)
+    jobs.update(worker_version=None)
+    inc('dropq_repinned_runs_total', len(stranded))
+    return len(stranded)
+
+
+def dispatch_candidates(slots):
+    """
+    The queued jobs dispatch chooses from: the first slots jobs of every
+    user with queued work, in (priority, year, created) order. Taking them
+    per user means one user's large batch can't fill the candidates and
+    keep everyone else from their fair share. One ordered scan over the
+    queue, stopped once every user has their share.
+    """
+    queued = DropqJob.objects.filter(status=DropqJob.QUEUED).order_by()
+    wanted = queued.values('user').distinct().count() * slots
+    taken = defaultdict(int)
+    candidates = []
+    jobs = (queued.only('id', 'run', 'user', 'year', 'priority', 'created')
+            .order_by('priority', 'year', 'created'))
+    for job in jobs.iterator():
+        if len(candidates) >= wanted:
+            break
+        if taken[job.user_id] < slots:
+            taken[job.user_id] += 1
+            candidates.append(job)
+    return candidates
+
+
+@timed('taxbrain_stage_seconds', stage='dispatch')
+def dispatch_pending():
+    """
+    Submit queued jobs to hosts with free slots. Safe to call from several
+    processes at once: a job is claimed with a conditional update before it
+    is sent, so only one caller ever submits it.
+    """
+    hosts = usable_hosts(DROPQ_HOST_CAPACITY)
+    host_versions = dict((h, version) for h, (version, _) in hosts.items())
+    repin_stranded_runs(host_versions)
+    load = _host_load()
+    host_free = dict((h, capacity - load.get(h, 0))
+                     for h, (_, capacity) in hosts.items())
+    slots = sum(max(free, 0) for free in host_free.values())
+    if not slots:
+        return 0
+
+    candidates = dispatch_candidates(slots)
+    run_versions = dict(DropqJob.objects.filter(
+        run__in=set(job.run_id for job in candidates),
+        worker_version__isnull=False).values_list('run', 'worker_version'))
+    weights = {}
+    if DROPQ_USER_WEIGHTS:
+        from django.contrib.auth.models import User
+        for pk, name in User.objects.filter(
+                username__in=DROPQ_USER_WEIGHTS.keys()).values_list('pk', 'username'):
+            weights[pk] = DROPQ_USER_WEIGHTS[name]
+
+    submitted = 0
+    plan = plan_dispatch(candidates, host_free, _user_load(), weights,
+                         host_versions=host_versions, run_versions=run_versions)
+    for job, hostname in plan:
+        # Whole seconds, so the claim compares equal however the database
+        # stores it
+        claimed_at = timezone.now().replace(microsecond=0)
+        claimed = DropqJob.objects.filter(pk=job.pk, status=DropqJob.QUEUED).update(
+            status=DropqJob.SUBMITTED, hostname=hostname,
+            worker_version=host_versions[hostname], submitted_at=claimed_at)
+        if not claimed:
+            continue
+        job = DropqJob.objects.get(pk=job.pk)
+        remote_id = dropq_submit_year(hostname, job.user_mods, job.year,
+                                      profile=job.profile, trace_id=job.trace_id)
+        # The job may have been cancelled, or requeued as lost and claimed
+        # again, while it was being sent, so only touch it if it is still
+        # this claim
+        claimed_job = DropqJob.objects.filter(pk=job.pk, status=DropqJob.SUBMITTED,
+                                              submitted_at=claimed_at)
+        if remote_id is None:
+            attempts = job.attempts + 1
+            status = (DropqJob.FAILED if attempts >= MAX_ATTEMPTS_SUBMIT_JOB
+                      else DropqJob.QUEUED)
+            claimed_job.update(attempts=attempts, status=status, hostname=None,
+                               worker_version=None, submitted_at=None)
+            continue
+        if not claimed_job.update(remote_id=remote_id):
+            dropq_cancel_job(hostname, remote_id, trace_id=job.trace_id)
+            continue
+        submitted += 1
+    return submitted
+
+
+def cancel_runs(run_ids, user=None):
+    """
+    Cancel the unfinished year jobs of the given runs: queued jobs are
+    dropped and running ones are cancelled on their hosts, which frees
+    their slots for other runs. Only jobs belonging to user are touched if
+    user is given. Returns the number of jobs cancelled.
+    """
+    pending = _pending_jobs().filter(run__in=run_ids)
+    if user is not None:
+        pending = pending.filter(user=user)
+    running = list(pending.filter(status=DropqJob.SUBMITTED,
+                                  remote_id__isnull=False)
+                   .values_list('hostname', 'remote_id', 'trace_id'))
+    cancelled = pending.update(status=DropqJob.CANCELLED,
+                               finished_at=timezone.now())
+    inc('dropq_cancelled_jobs_total', cancelled)
+    for hostname, remote_id, trace_id in running:
+        dropq_cancel_job(hostname, remote_id, trace_id=trace_id)
+    if cancelled:
+        dispatch_pending()
+    return cancelled
+
+
+def cancel_abandoned_runs():
+    """
+    Cancel interactive runs whose processing page has not been polled for
+    DROPQ_ABANDON_SECONDS, e.g. because the tab was closed.
+    """
+    cutoff = timezone.now() - timedelta(seconds=DROPQ_ABANDON_SECONDS)
+    run_ids = list(_pending_jobs().filter(priority=DropqJob.INTERACTIVE,
+                                          polled_at__lt=cutoff)
+                   .values_list('run', flat=True).distinct())
+    if not run_ids:
+        return 0
+    return cancel_runs(run_ids)
+
+
+def percentile(values, pct):
+    """
+    The pct-th percentile of values, interpolating between neighbours
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * pct / 100.0
+    low = int(math.floor(rank))
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def hedge_thresholds(durations, pct=DROPQ_HEDGE_PERCENTILE,
+                     min_samples=HEDGE_MIN_SAMPLES):
+    """
+    Turn (year, seconds) pairs into {year: threshold seconds}. Years with
+    too few samples of their own fall back to the threshold over all
+    years, stored under None. Returns {} if there is too little data.
+    """
+    by_year = defaultdict(list)
+    for year, seconds in durations:
+        by_year[year].append(seconds)
+    everything = [seconds for _, seconds in durations]
+    if len(everything) < min_samples:
+        return {}
+
+    thresholds = {None: percentile(everything, pct)}
+    for year, values in by_year.items():
+        if len(values) >= min_samples:
+            thresholds[year] = percentile(values, pct)
+    return thresholds
+
+
+def _recent_durations():
+    recent = (DropqJob.objects.filter(status=DropqJob.DONE,
+                                      hedge_of__isnull=True,
+                                      submitted_at__isnull=False)
+              .order_by('-finished_at')
+              .values_list('year', 'submitted_at', 'finished_at')[:HEDGE_SAMPLE])
+    return [(year, (end - start).total_seconds()) for year, start, end in recent]
+
+
+def hedge_stragglers():
+    """
+    Submit a duplicate of each year job that has run past its hedge
+    threshold to another host with a free slot, within the hedge budget.
+    Returns the number of hedges sent.
+    """
+    thresholds = hedge_thresholds(_recent_durations())
+    if not thresholds:
+        return 0
+
+    running = DropqJob.objects.filter(status=DropqJob.SUBMITTED)
+    budget = int(math.ceil(DROPQ_HEDGE_BUDGET * running.count()))
+    budget -= running.filter(hedge_of__isnull=False).count()
+    if budget <= 0:
+        return 0
+
+    now = timezone.now()
+    shortest = min(thresholds.values())
+    candidates = (running.filter(hedge_of__isnull=True, remote_id__isnull=False,
+                                 submitted_at__lt=now - timedelta(seconds=shortest))
+                  .exclude(hedges__status__in=[DropqJob.SUBMITTED, DropqJob.DONE])
+                  .order_by('submitted_at'))
+    stragglers = []
+    for job in candidates:
+        limit = thresholds.get(job.year, thresholds[None])
+        if (now - job.submitted_at).total_seconds() > limit:
+            stragglers.append(job)
+    if not stragglers:
+        return 0
+
+    # A host that is running stragglers is not a healthy place for hedges
+    slow_hosts = set(job.hostname for job in stragglers)
+    hosts = usable_hosts(DROPQ_HOST_CAPACITY)
+    load = _host_load()
+    host_free = dict((h, capacity - load.get(h, 0))
+                     for h, (_, capacity) in hosts.items() if h not in slow_hosts)
+
+    sent = 0
+    for job in stragglers[:budget]:
+        # The hedge must run the same version as the rest of the run, and
+        # like in plan_dispatch a non-interactive one must leave the reserve
+        # free on the host
+        floor = (0 if job.priority == DropqJob.INTERACTIVE
+                 else DROPQ_INTERACTIVE_RESERVE)
+        same_version = [h for h, free in host_free.items()
+                        if free > floor and hosts[h][0] == job.worker_version]
+        if not same_version:
+            continue
+        hostname = max(same_version, key=lambda h: host_free[h])
+        remote_id = dropq_submit_year(hostname, job.user_mods, job.year,
+                                      trace_id=job.trace_id)
+        if remote_id is None:
+            del host_free[hostname]
+            continue
+        host_free[hostname] -= 1
+        DropqJob.objects.create(run_id=job.run_id, user_id=job.user_id,
+                                year=job.year, priority=job.priority,
+                                user_mods=job.user_mods, hedge_of=job,
+                                status=DropqJob.SUBMITTED, hostname=hostname,
+                                worker_version=job.worker_version,
+                                remote_id=remote_id, submitted_at=now,
+                                polled_at=job.polled_at, trace_id=job.trace_id)
+        inc('dropq_hedges_total', host=hostname)
+        sent += 1
+    return sent
+
+
+def _cancel_jobs(jobs):
+    for job in jobs:
+        if DropqJob.objects.filter(pk=job.pk, status=DropqJob.SUBMITTED).update(
+                status=DropqJob.CANCELLED, finished_at=timezone.now()):
+            dropq_cancel_job(job.hostname, job.remote_id, trace_id=job.trace_id)
+
+
+def refresh_jobs(jobs):
+    """
+    Poll the hosts for the given submitted jobs and mark the finished ones.
+    When a job or its hedge finishes, the first copy to finish wins: its
+    remote id is recorded on the original job and the other copy is
+    cancelled.
+    """
+    for job in jobs:
+        if job.remote_id is None:
+            # Claimed but not yet acknowledged by the host
+            continue
+        if not dropq_job_ready(job.hostname, job.remote_id, trace_id=job.trace_id):
+            continue
+
+        now = timezone.now()
+        if job.hedge_of_id is None:
+            won = DropqJob.objects.filter(pk=job.pk, status=DropqJob.SUBMITTED).update(
+                status=DropqJob.DONE, finished_at=now)
+            if won:
+                _cancel_jobs(DropqJob.objects.filter(hedge_of=job.pk,
+                                                     status=DropqJob.SUBMITTED))
+            continue
+
+        original = DropqJob.objects.filter(pk=job.hedge_of_id,
+                                           status=DropqJob.SUBMITTED).first()
+        won = original is not None and DropqJob.objects.filter(
+            pk=original.pk, status=DropqJob.SUBMITTED).update(
+                status=DropqJob.DONE, finished_at=now, hostname=job.hostname,
+                remote_id=job.remote_id)
+        if won:
+            DropqJob.objects.filter(pk=job.pk).update(status=DropqJob.DONE,
+                                                      finished_at=now)
+            dropq_cancel_job(original.hostname, original.remote_id,
+                             trace_id=original.trace_id)
+        else:
+            _cancel_jobs([job])
+
+
+def move_queue():
+    """
+    Recover lost claims, hand out free slots and hedge stragglers, at most
+    once every DROPQ_DISPATCH_INTERVAL seconds for all the processes
+    sharing the cache. Page polls call this, run_dropq_scheduler does the
+    same work on its own schedule. Returns the number of jobs submitted.
+    """
+    if not cache.add(DISPATCH_LOCK_KEY, True, DROPQ_DISPATCH_INTERVAL):
+        return 0
+    requeue_lost_claims()
+    submitted = dispatch_pending()
+    hedge_stragglers()
+    return submitted
+
+
+def refresh_runs(run_ids):
+    """
+    Poll the running jobs of the given runs, hand out any freed slots, and
+    return {run_id: status} where status is one of DropqJob.DONE,
+    DropqJob.FAILED, DropqJob.CANCELLED or DropqJob.QUEUED (still pending).
+    """
+    _pending_jobs().filter(run__in=run_ids).update(polled_at=timezone.now())
+    refresh_jobs(DropqJob.objects.filter(run__in=run_ids,
+                                         status=DropqJob.SUBMITTED))
+    move_queue()
+
+    counts = defaultdict(dict)
+    rows = (DropqJob.objects.filter(run__in=run_ids, hedge_of__isnull=True)
+            .values('run', 'status').annotate(n=Count('id')))
+    for row in rows:
+        counts[row['run']][row['status']] = row['n']
+
+    statuses = {}
+    for run_id in run_ids:
+        by_status = counts.get(run_id, {})
+        if by_status.get(DropqJob.FAILED):
+            statuses[run_id] = DropqJob.FAILED
+        elif by_status.get(DropqJob.CANCELLED):
+            statuses[run_id] = DropqJob.CANCELLED
+        elif by_status and by_status.keys() == [DropqJob.DONE]:
+            statuses[run_id] = DropqJob.DONE
+        else:
+            statuses[run_id] = DropqJob.QUEUED
+    return statuses
+
+
+def queue_depth():
+    """
+    Gauges of the unfinished year jobs by status and priority, and of the
+    backlog and the hosts needed to clear it, for the metrics endpoint.
+    One aggregate query over the pending jobs serves all of them, the
+    model comes from the cache.
+    """
+    priorities = dict(DropqJob.PRIORITY_CHOICES)
+    pending = list(pending_jobs())
+    counts = defaultdict(int)
+    for status, priority, _, _, _, _, n in pending:
+        counts[(status, priority)] += n
+    gauges = [('dropq_jobs', {'status': status, 'priority': priorities[priority]}, n)
+              for (status, priority), n in sorted(counts.items())]
+
+    hosts = usable_hosts(DROPQ_HOST_CAPACITY)
+    backlog = backlog_seconds(duration_model(), pending)
+    gauges += [('dropq_backlog_seconds', {}, backlog),
+               ('dropq_required_hosts', {},
+                required_hosts(backlog, _host_capacity(hosts))),
+               ('dropq_hosts', {}, len(hosts))]
+    return gauges
+
+
+def run_job_ids(run_id):
+    """
+    (remote_id, hostname) pairs for a finished run, in year order, as
+    expected by dropq_get_results
+    """
+    return [tuple(pair) for pair in
+            DropqJob.objects.filter(run=run_id, hedge_of__isnull=True)
+            .order_by('year')
+            .values_list('remote_id', 'hostname')]
@@ -1,71 +1,310 @@
 import taxcalc
 import pandas as pd
+from pandas.core.internals import BlockManager, make_block
 import os
 import json
 from taxcalc import *
 import dropq
 
+import billiard
 from celery import Celery
+from celery.signals import worker_init
+from collections import OrderedDict
+import multiprocessing
+import numpy as np
+import resource
+import shutil
+import tempfile
 import time
 
-import boto
-from boto.s3.connection import S3Connection
 import os
 
 from .helpers import *
+from .dataset import default_dataset_manager, dataset_version, DATASET_VERIFY
+from .tracing import TRACE_HEADER, span, store_spans
+
+import datetime
+import django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'webapp.settings')
+django.setup()
+from .models import TaxSaveInputs, TaxResult
 
-AWS_KEY_ID = os.environ['AWS_KEY_ID']
-AWS_SECRET_ID = os.environ['AWS_SECRET_ID']
 NUM_BUDGET_YEARS = int(os.environ.get('NUM_BUDGET_YEARS', 10))
 START_YEAR = int(os.environ.get('START_YEAR', 2015))
 DUMP_DEBUG = os.environ.get('DUMP_DEBUG', None) == 'True'
+# Bump when the layout of the columnar cache changes
+PUF_CACHE_FORMAT = 2
+# Processes used to run the budget years of a single task in parallel. By
+# default the cores are split between the task processes of the worker, so
+# a host never runs more year processes than it has cores.
+YEAR_PROCESSES = int(os.environ.get('YEAR_PROCESSES', 0))
+# Task processes of the Celery worker this process belongs to
+WORKER_CONCURRENCY = 1
 
-if not os.path.exists("puf.csv.gz"):
-    print "downloading records"
-    aws_connection = S3Connection(AWS_KEY_ID, AWS_SECRET_ID)
-    bucket = aws_connection.get_bucket('pufbucket')
-    key = bucket.get_key("puf.csv.gz")
-    key.get_contents_to_filename("puf.csv.gz")
-    print "done downloading records"
+app = Celery('tasks', broker=os.environ.get('REDISGREEN_URL'), backend=os.environ.get('REDISGREEN_URL'))
 
-app = Celery('tasks', broker=os.environ['REDISGREEN_URL'], backend=os.environ['REDISGREEN_URL'])
+# The microdata, loaded once per process and shared by every task it runs,
+# and the version of the dataset it was loaded from
+TAX_DTA = None
+TAX_DTA_VERSION = None
+# The (resolved directory, checksum) of the columnar cache TAX_DTA is mapped
+# from, if it is
+TAX_DTA_CACHE = None
 
-@app.task
-def get_tax_results_async(mods, inputs_pk):
-    print "mods is ", mods
-    user_mods = package_up_vars(mods)
-    print "user_mods is ", user_mods
-    print "begin work"
-    cur_path = os.path.abspath(os.path.dirname(__file__))
-    tax_dta = pd.read_csv("puf.csv.gz", compression='gzip')
-    mY_dec, mX_dec, df_dec, mY_bin, mX_bin, df_bin, fiscal_tots = dropq.run_models(tax_dta,
-        num_years=NUM_BUDGET_YEARS, user_mods={START_YEAR:user_mods})
 
-    if DUMP_DEBUG:
-        with open("mY_dec.txt", "w") as f1:
-            f1.write(json.dumps(mY_dec, sort_keys=True, indent=4, separators=(',', ': ')) + '\n')
-    
-        with open("mX_dec.txt", "w") as f1:
-            f1.write(json.dumps(mX_dec, sort_keys=True, indent=4, separators=(',', ': ')) + '\n')
+def build_columnar_cache(frame, cache_dir, checksum):
+    """
+    Write the columns of frame to cache_dir, one 2-D .npy file per dtype
+    holding a row for each column of that dtype, next to a schema.json
+    recording the column names, the blocks, the row count and the checksum
+    of the csv the frame was parsed from.
+
+    Each build goes to a new versioned directory and cache_dir is a symlink
+    to the current one, switched atomically with a rename. Readers see the
+    old cache or the new one, never none or half of one.
+    """
+    parent = os.path.dirname(os.path.abspath(cache_dir))
+    name = os.path.basename(os.path.abspath(cache_dir))
+    version_dir = tempfile.mkdtemp(prefix=name + '.', dir=parent)
+
+    positions = OrderedDict()
+    for i in range(len(frame.columns)):
+        positions.setdefault(frame.dtypes.iloc[i], []).append(i)
+    blocks = []
+    for i, (dtype, cols) in enumerate(positions.items()):
+        values = np.empty((len(cols), len(frame)), dtype=dtype)
+        for row, col in enumerate(cols):
+            values[row] = frame.iloc[:, col].values
+        filename = "block{0}.npy".format(i)
+        np.save(os.path.join(version_dir, filename), values)
+        blocks.append({'file': filename, 'dtype': values.dtype.str,
+                       'positions': cols,
+                       # object blocks are pickled and can't be mapped
+                       'mmap': values.dtype != np.object_})
+
+    schema = {'format': PUF_CACHE_FORMAT, 'source_sha256': checksum,
+              'rows': len(frame), 'columns': list(frame.columns),
+              'blocks': blocks}
+    with open(os.path.join(version_dir, 'schema.json'), 'w') as f:
+        json.dump(schema, f)
+
+    previous = None
+    if os.path.islink(cache_dir):
+        previous = os.path.realpath(cache_dir)
+    elif os.path.isdir(cache_dir):
+        # a cache from before caches were versioned
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    link = "{0}.link{1}".format(os.path.abspath(cache_dir), os.getpid())
+    os.symlink(os.path.basename(version_dir), link)
+    os.rename(link, cache_dir)
+
+    # Keep the version just replaced for readers still loading it
+    keep = (os.path.realpath(version_dir), previous)
+    for entry in os.listdir(parent):
+        path = os.path.join(parent, entry)
+        if (entry.startswith(name + '.') and os.path.isdir(path) and
+                not os.path.islink(path) and os.path.realpath(path) not in keep):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def load_columnar_cache(cache_dir, checksum, mmap_mode='r'):
+    """
+    Build the microdata frame on top of the memory-mapped blocks in
+    cache_dir, without copying them, so that every process on the host
+    shares the same pages. Returns None if there is no cache or it was
+    built from a different csv.
+
+    The blocks are mapped read-only by default. With mmap_mode='c' they are
+    mapped copy-on-write: writes to the frame stay private to it and only
+    the pages written are copied.
+    """
+    # Resolved once, so a concurrent rebuild can't mix two versions
+    cache_dir = os.path.realpath(cache_dir)
+    schema_path = os.path.join(cache_dir, 'schema.json')
+    if not os.path.exists(schema_path):
+        return None
+
+    with open(schema_path) as f:
+        schema = json.load(f)
+    if (schema.get('format') != PUF_CACHE_FORMAT or
+            schema.get('source_sha256') != checksum):
+        return None
+
+    blocks = []
+    for block in schema['blocks']:
+        values = np.load(os.path.join(cache_dir, block['file']),
+                         mmap_mode=mmap_mode if block['mmap'] else None)
+        if values.shape != (len(block['positions']), schema['rows']):
+            return None
+        blocks.append(make_block(values, placement=block['positions'], ndim=2))
+
+    axes = [pd.Index(schema['columns']), pd.Index(np.arange(schema['rows']))]
+    return pd.DataFrame(BlockManager(blocks, axes))
+
+
+def load_tax_dta():
+    """
+    Return the resident microdata frame. The first call in a process makes
+    sure the dataset is installed locally and loads it from its columnar
+    cache, building that cache if it is missing or stale.
+    """
+    global TAX_DTA, TAX_DTA_VERSION, TAX_DTA_CACHE
+    if TAX_DTA is None:
+        print "loading records"
+        path, sha256 = default_dataset_manager().ensure(verify=DATASET_VERIFY)
+        cache_dir = os.path.splitext(path)[0] + '.columns'
+        TAX_DTA = load_columnar_cache(cache_dir, sha256)
+        if TAX_DTA is None:
+            print "building columnar cache of records"
+            build_columnar_cache(pd.read_csv(path, compression='gzip'),
+                                 cache_dir, sha256)
+            TAX_DTA = load_columnar_cache(cache_dir, sha256)
+        TAX_DTA_CACHE = (os.path.realpath(cache_dir), sha256)
+        TAX_DTA_VERSION = dataset_version(sha256)
+        print "done loading records, dataset version ", TAX_DTA_VERSION
+    return TAX_DTA
+
+
+def task_tax_dta():
+    """
+    Return a frame of the microdata for one task to hand to dropq, which
+    adds and overwrites columns of the frame it is given. The frame maps
+    the resident cache again copy-on-write, so it shares the unmodified
+    pages with every other process and leaves the resident frame as it was.
+    """
+    load_tax_dta()
+    tax_dta = load_columnar_cache(*TAX_DTA_CACHE, mmap_mode='c')
+    if tax_dta is None:
+        # the cache version we loaded was removed by later rebuilds
+        tax_dta = TAX_DTA.copy()
+    return tax_dta
+
 
-        with open("df_dec.txt", "w") as f1:
-            f1.write(json.dumps(df_dec, sort_keys=True, indent=4, separators=(',', ': ')) + '\n')
+def loaded_dataset_version():
+    """
+    Version of the resident dataset, loading it if necessary
+    """
+    load_tax_dta()
+    return TAX_DTA_VERSION
 
-        with open("mY_bin.txt", "w") as f1:
-            f1.write(json.dumps(mY_bin, sort_keys=True, indent=4, separators=(',', ': ')) + '\n')
 
-        with open("mX_bin.txt", "w") as f1:
-            f1.write(json.dumps(mX_bin, sort_keys=True, indent=4, separators=(',', ': ')) + '\n')
+@worker_init.connect
+def preload_tax_dta(sender=None, **kwargs):
+    """
+    Load the microdata in the worker's parent process before the pool
+    forks, so that every child shares it copy-on-write.
+    """
+    global WORKER_CONCURRENCY
+    WORKER_CONCURRENCY = getattr(sender, 'concurrency', None) or 1
+    load_tax_dta()
 
-        with open("df_bin.txt", "w") as f1:
-            f1.write(json.dumps(df_bin, sort_keys=True, indent=4, separators=(',', ': ')) + '\n')
 
-        with open("fiscal_tots.txt", "w") as f1:
-            f1.write(json.dumps(fiscal_tots, sort_keys=True, indent=4, separators=(',', ': ')) + '\n')
+def max_rss_kb():
+    """
+    Peak resident set size of this process, in kilobytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Pool of processes running single budget years, created on first use
+YEAR_POOL = None
+YEAR_POOL_FAILED = False
+
+
+def run_nth_year(year_n, user_mods):
+    """
+    Run dropq for a single budget year against the resident microdata.
+    This is the same per-year entry point the dropq hosts use.
+    """
+    return dropq.run_nth_year(year_n, start_year=START_YEAR, tax_dta=task_tax_dta(),
+                              user_mods=user_mods, return_json=True)
+
+
+def run_nth_year_args(args):
+    """
+    Pool.map helper unpacking the (year_n, user_mods) pair
+    """
+    return run_nth_year(*args)
+
+
+def year_pool_size():
+    size = YEAR_PROCESSES or multiprocessing.cpu_count() // WORKER_CONCURRENCY
+    return max(1, min(size, NUM_BUDGET_YEARS))
+
+
+def get_year_pool():
+    """
+    Return the year pool of this process, or None if years should run
+    serially. The microdata is loaded before the pool forks so its
+    processes share the mapped frame.
+
+    The pool is a billiard pool: Celery's prefork task processes are
+    daemonic, and multiprocessing refuses to start children from those.
+    """
+    global YEAR_POOL, YEAR_POOL_FAILED
+    size = year_pool_size()
+    if YEAR_POOL is None and size > 1 and not YEAR_POOL_FAILED:
+        load_tax_dta()
+        try:
+            YEAR_POOL = billiard.Pool(size)
+        except OSError as e:
+            print "could not start year pool, running years serially: ", e
+            YEAR_POOL_FAILED = True
+    return YEAR_POOL
+
+
+def run_budget_years(user_mods):
+    """
+    Run dropq over the whole budget window. Years are spread across the
+    year pool when there is one and merged back into a single result dict.
+    """
+    pool = get_year_pool()
+    if pool is None:
+        mY_dec, mX_dec, df_dec, mY_bin, mX_bin, df_bin, fiscal_tots = dropq.run_models(task_tax_dta(),
+            num_years=NUM_BUDGET_YEARS, user_mods=user_mods)
+        return {'mY_dec': mY_dec, 'mX_dec': mX_dec, 'df_dec': df_dec,
+                'mY_bin': mY_bin, 'mX_bin': mX_bin, 'df_bin': df_bin,
+                'fiscal_tots': fiscal_tots}
+
+    args = [(year_n, user_mods) for year_n in range(NUM_BUDGET_YEARS)]
+    year_results = pool.map(run_nth_year_args, args, chunksize=1)
+    return merge_dropq_year_results(year_results)
+
+
+@app.task(bind=True)
+def get_tax_results_async(self, mods, inputs_pk):
+    """
+    Run the whole budget window for a run. Queue it with the run's trace id
+    in the task headers, apply_async(..., headers=trace_headers(trace_id)),
+    to have its compute and store spans recorded under that trace.
+    """
+    trace_id = (getattr(self.request, 'headers', None) or {}).get(TRACE_HEADER)
+    print "trace is ", trace_id
+    print "mods is ", mods
+    user_mods = package_up_vars(mods)
+    print "user_mods is ", user_mods
+    print "begin work"
+    start_rss = max_rss_kb()
+    start = time.time()
+    results = run_budget_years({START_YEAR:user_mods})
+    spans = [span('compute', time.time() - start, start=start)]
+
+    if DUMP_DEBUG:
+        for table_id in ['mY_dec', 'mX_dec', 'df_dec', 'mY_bin', 'mX_bin',
+                         'df_bin', 'fiscal_tots']:
+            with open(table_id + ".txt", "w") as f1:
+                f1.write(json.dumps(results[table_id], sort_keys=True, indent=4, separators=(',', ': ')) + '\n')
 
-    results = {'mY_dec': mY_dec, 'mX_dec': mX_dec, 'df_dec': df_dec,
-               'mY_bin': mY_bin, 'mX_bin': mX_bin, 'df_bin': df_bin,
-               'fiscal_tots': fiscal_tots, 'inputs_pk': inputs_pk}
+    # Store the results straight into the database rather than shipping
+    # them back through the Redis result backend
+    start = time.time()
+    TaxResult.store(inputs_pk, results)
+    TaxSaveInputs.objects.filter(pk=inputs_pk).update(
+        creation_date=datetime.datetime.now())
+    spans.append(span('store', time.time() - start, start=start))
+    if trace_id:
+        store_spans(inputs_pk, trace_id, spans)
 
-    print "end work"
-    return results
+    print "end work, peak RSS grew by {0} kB during task".format(
+        max_rss_kb() - start_rss)
+    return {'status': 'SUCCESS', 'inputs_pk': inputs_pk}
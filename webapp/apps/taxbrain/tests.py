@@ -1,10 +1,68 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from mock import patch, Mock
 
-from .models import TaxSaveInputs
+from .models import (TaxSaveInputs, TaxResult, DropqJob, RunProfile, OutputUrl,
+                     TraceSpan)
 from .models import convert_to_floats
 from .helpers import (expand_1D, expand_2D, expand_list, package_up_vars,
-                     format_csv)
+                     format_csv, expand_sweep_grid, split_baseline_tables,
+                     revenue_total, merge_dropq_year_results)
+from .scheduler import (plan_dispatch, queue_wait_seconds, format_wait,
+                        cancel_runs, percentile, hedge_thresholds, enqueue_runs,
+                        dispatch_candidates, requeue_lost_claims,
+                        hedge_stragglers, repin_stranded_runs, move_queue,
+                        DROPQ_PIN_TIMEOUT, DISPATCH_LOCK_KEY)
+from .registry import (is_compatible, version_key, host_capabilities,
+                       UNKNOWN_VERSION, CAPABILITY_CACHE_KEY,
+                       DROPQ_CAPABILITY_TTL)
+from .capacity import (DurationModel, required_hosts, backlog_seconds,
+                       DEFAULT_JOB_SECONDS)
+from .metrics import (Registry, render_text, registry, collect,
+                      METRICS_STALE_SECONDS)
+from .profiling import QueryBudgetExceeded
+from .sampler import SamplingProfiler
+from .benchmarks import (synthetic_dropq_results, synthetic_year_result,
+                         compare_reports)
+from .loadtest import FakeDropqHost
+from .views import finish_run
+from .helpers import (taxcalc_results_to_tables, dropq_submit_year,
+                      dropq_job_ready, dropq_get_results, _fetch_spans,
+                      baseline_cache_key, BASELINE_TABLES, taxcalc_version,
+                      dropq_version, START_YEAR)
 import taxcalc
+from redis import StrictRedis
+from rq import Queue
+
+from process_work import ProcessPoolWorker, REAP_INTERVAL
+with patch('gevent.monkey.patch_all'):
+    # the gevent worker patches the whole process when imported
+    import custom_work
+import gevent
+from rq.worker import StopRequested
+
+from .dropq_wire import encode_year_result, decode_year_result
+from .dataset import DatasetManager, LocalSource, file_checksum
+from .dropq_service import (DropqJobStore, DropqServer, _init_pool,
+                            RESULT_TTL_IN_SECONDS)
+from .tasks import (build_columnar_cache, load_columnar_cache, get_year_pool,
+                    run_nth_year_args, task_tax_dta)
+import numpy as np
+import pandas as pd
+from datetime import timedelta
+import json
+import mmap
+import multiprocessing
+import threading
+import os
+import requests
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
 
 def cycler(max):
     count = 0
@@ -128,3 +186,1104 @@ class TaxInputTests(TestCase):
 
         ans = format_csv(tax_results, u'42')
         assert ans[0] == ['#URL: http://www.ospc.org/taxbrain/42/']
+
+    def test_expand_sweep_grid_range(self):
+        names, points = expand_sweep_grid(
+            {'II_rt7': {'start': 0.35, 'stop': 0.45, 'step': 0.01}})
+        assert names == ['II_rt7']
+        assert len(points) == 11
+        assert points[0] == [0.35]
+        assert points[-1] == [0.45]
+
+    def test_expand_sweep_grid_two_params(self):
+        names, points = expand_sweep_grid({'II_rt7': [0.35, 0.4],
+                                           'II_em': [3000, 4000, 5000]})
+        assert names == ['II_em', 'II_rt7']
+        assert len(points) == 6
+        assert points[1] == [3000, 0.4]
+
+    def test_expand_sweep_grid_too_many_params(self):
+        with self.assertRaises(ValueError):
+            expand_sweep_grid({'II_rt5': [0.3], 'II_rt6': [0.3], 'II_rt7': [0.3]})
+
+    def test_expand_sweep_grid_too_many_points(self):
+        # refused from the counts, before a list of 10^12 values is built
+        with self.assertRaises(ValueError):
+            expand_sweep_grid({'II_rt7': {'start': 0, 'stop': 1, 'step': 1e-12}},
+                              max_points=500)
+        with self.assertRaises(ValueError):
+            expand_sweep_grid({'II_rt7': range(100), 'II_em': range(100)},
+                              max_points=500)
+
+    def test_split_baseline_tables(self):
+        results = {'mX_dec': 1, 'mX_bin': 2, 'mY_dec': 3, 'fiscal_tots': [4]}
+        baseline, rest = split_baseline_tables(results)
+        assert baseline == {'mX_dec': 1, 'mX_bin': 2}
+        assert rest == {'mY_dec': 3, 'fiscal_tots': [4]}
+
+
+class DropqDispatchTests(TestCase):
+
+    def job(self, user_id, year, priority=DropqJob.BATCH, created=0):
+        return Mock(user_id=user_id, year=year, priority=priority,
+                    created=created)
+
+    def test_interactive_jumps_the_queue(self):
+        batch = [self.job(1, yr) for yr in range(3)]
+        interactive = self.job(2, 0, priority=DropqJob.INTERACTIVE, created=1)
+
+        plan = plan_dispatch(batch + [interactive], {'host1': 3}, {}, reserve=1)
+
+        # one slot is held back for interactive work, so only one batch job
+        # gets through and the interactive job goes first
+        assert [job for job, _ in plan] == [interactive, batch[0]]
+
+    def test_fair_share_interleaves_users(self):
+        alice = [self.job(1, yr) for yr in range(3)]
+        bob = [self.job(2, yr, created=1) for yr in range(3)]
+
+        plan = plan_dispatch(alice + bob, {'host1': 2, 'host2': 2},
+                             {1: 2}, reserve=0)
+
+        # alice already has two jobs running, bob catches up first
+        assert [job.user_id for job, _ in plan] == [2, 2, 1, 2]
+        assert sorted(host for _, host in plan) == ['host1', 'host1',
+                                                    'host2', 'host2']
+
+    @patch('webapp.apps.taxbrain.scheduler.usable_hosts',
+           Mock(return_value={'host1': ('v1', 4), 'host2': ('v1', 4)}))
+    @patch('webapp.apps.taxbrain.scheduler.DROPQ_INTERACTIVE_RESERVE', 1)
+    def test_queue_wait(self):
+        # 8 slots for interactive work, 6 once the reserve is held back
+        assert queue_wait_seconds(16, job_seconds=30) == 60
+        assert queue_wait_seconds(12, DropqJob.BATCH, job_seconds=30) == 60
+        assert format_wait(60) == "a minute"
+        assert format_wait(600) == "10 minutes"
+
+    def test_runs_pinned_to_one_version(self):
+        pinned = [Mock(user_id=1, run_id=7, year=yr, priority=DropqJob.BATCH,
+                       created=0) for yr in range(2)]
+        fresh = [Mock(user_id=2, run_id=8, year=yr, priority=DropqJob.BATCH,
+                      created=0) for yr in range(2)]
+
+        plan = plan_dispatch(pinned + fresh, {'old': 1, 'new': 4}, {},
+                             reserve=0, host_versions={'old': 'v1', 'new': 'v2'},
+                             run_versions={7: 'v1'})
+
+        hosts = dict((job, host) for job, host in plan)
+        # run 7 only fits one more year on the v1 host, run 8 stays on v2
+        assert hosts[pinned[0]] == 'old'
+        assert pinned[1] not in hosts
+        assert hosts[fresh[0]] == hosts[fresh[1]] == 'new'
+
+    def test_candidates_per_user(self):
+        alice = User.objects.create_user('alice')
+        bob = User.objects.create_user('bob')
+        run = TaxSaveInputs.objects.create()
+        big_batch = [DropqJob.objects.create(run=run, user=alice, year=yr % 10,
+                                             user_mods='{}', priority=DropqJob.BATCH)
+                     for yr in range(30)]
+        late = DropqJob.objects.create(run=run, user=bob, year=9, user_mods='{}',
+                                       priority=DropqJob.BATCH)
+
+        candidates = dispatch_candidates(2)
+
+        # bob's job is a candidate even though alice queued 30 before it
+        assert late in candidates
+        assert len([job for job in candidates if job.user_id == alice.pk]) == 2
+
+    @patch('webapp.apps.taxbrain.scheduler.hedge_stragglers', Mock())
+    @patch('webapp.apps.taxbrain.scheduler.dispatch_pending')
+    def test_polls_move_the_queue_at_most_once_per_interval(self, mock_dispatch):
+        cache.delete(DISPATCH_LOCK_KEY)
+        mock_dispatch.return_value = 0
+
+        move_queue()
+        move_queue()
+
+        assert mock_dispatch.call_count == 1
+        cache.delete(DISPATCH_LOCK_KEY)
+        move_queue()
+        assert mock_dispatch.call_count == 2
+
+    def test_lost_claims_requeued(self):
+        run = TaxSaveInputs.objects.create()
+        long_ago = timezone.now() - timedelta(hours=1)
+        lost = DropqJob.objects.create(run=run, year=0, user_mods='{}',
+                                       status=DropqJob.SUBMITTED,
+                                       hostname='host1', submitted_at=long_ago)
+        sending = DropqJob.objects.create(run=run, year=1, user_mods='{}',
+                                          status=DropqJob.SUBMITTED,
+                                          hostname='host1',
+                                          submitted_at=timezone.now())
+
+        assert requeue_lost_claims() == 1
+
+        lost = DropqJob.objects.get(pk=lost.pk)
+        assert lost.status == DropqJob.QUEUED
+        assert lost.hostname is None
+        assert lost.attempts == 1
+        assert DropqJob.objects.get(pk=sending.pk).status == DropqJob.SUBMITTED
+
+    def test_stranded_runs_repinned(self):
+        long_ago = timezone.now() - timedelta(seconds=DROPQ_PIN_TIMEOUT + 60)
+        stranded, recent = [TaxSaveInputs.objects.create() for _ in range(2)]
+        for run, finished_at in ((stranded, long_ago), (recent, timezone.now())):
+            DropqJob.objects.create(run=run, year=0, user_mods='{}',
+                                    status=DropqJob.DONE, hostname='old',
+                                    worker_version='v1', remote_id='abc',
+                                    submitted_at=long_ago, finished_at=finished_at)
+            DropqJob.objects.create(run=run, year=1, user_mods='{}')
+
+        # nothing to restart on while no host is usable
+        assert repin_stranded_runs({}) == 0
+        assert repin_stranded_runs({'old': 'v1', 'new': 'v2'}) == 0
+        assert repin_stranded_runs({'new': 'v2'}) == 1
+
+        jobs = DropqJob.objects.filter(run=stranded)
+        assert set(jobs.values_list('status', 'worker_version', 'remote_id')) == \
+            set([(DropqJob.QUEUED, None, None)])
+        assert DropqJob.objects.get(run=recent, year=0).status == DropqJob.DONE
+
+    @patch('webapp.apps.taxbrain.scheduler.dispatch_pending')
+    @patch('webapp.apps.taxbrain.scheduler.dropq_cancel_job')
+    def test_cancel_run(self, mock_cancel, mock_dispatch):
+        run = TaxSaveInputs.objects.create()
+        done = DropqJob.objects.create(run=run, year=0, user_mods='{}',
+                                       status=DropqJob.DONE)
+        running = DropqJob.objects.create(run=run, year=1, user_mods='{}',
+                                          status=DropqJob.SUBMITTED,
+                                          hostname='host1', remote_id='abc',
+                                          trace_id='t1')
+        queued = DropqJob.objects.create(run=run, year=2, user_mods='{}')
+
+        assert cancel_runs([run.pk]) == 2
+
+        statuses = dict(DropqJob.objects.values_list('pk', 'status'))
+        assert statuses[done.pk] == DropqJob.DONE
+        assert statuses[running.pk] == DropqJob.CANCELLED
+        assert statuses[queued.pk] == DropqJob.CANCELLED
+        mock_cancel.assert_called_once_with('host1', 'abc', trace_id='t1')
+        assert mock_dispatch.called
+
+
+    def test_percentile(self):
+        assert percentile([], 95) is None
+        assert percentile([3, 1, 2], 50) == 2
+        assert percentile(range(0, 101), 95) == 95
+        assert percentile([10, 20], 75) == 17.5
+
+    def test_hedge_thresholds(self):
+        durations = [(0, float(s)) for s in range(1, 21)] + [(1, 100.0)]
+
+        thresholds = hedge_thresholds(durations, pct=50, min_samples=20)
+
+        # year 1 has a single sample and uses the overall threshold
+        assert thresholds[0] == 10.5
+        assert thresholds[None] == 11
+        assert 1 not in thresholds
+        assert hedge_thresholds(durations[:5], min_samples=20) == {}
+
+    @patch('webapp.apps.taxbrain.scheduler._recent_durations',
+           Mock(return_value=[(0, 10.0)] * 20))
+    @patch('webapp.apps.taxbrain.scheduler.usable_hosts',
+           Mock(return_value={'host1': ('v1', 4), 'host2': ('v1', 2)}))
+    @patch('webapp.apps.taxbrain.scheduler.DROPQ_INTERACTIVE_RESERVE', 1)
+    @patch('webapp.apps.taxbrain.scheduler.dropq_submit_year',
+           Mock(return_value='hedge1'))
+    def test_batch_hedges_leave_the_reserve(self):
+        run = TaxSaveInputs.objects.create()
+        long_ago = timezone.now() - timedelta(seconds=60)
+        straggler = DropqJob.objects.create(run=run, year=0, user_mods='{}',
+                                            priority=DropqJob.BATCH,
+                                            status=DropqJob.SUBMITTED,
+                                            hostname='host1', worker_version='v1',
+                                            remote_id='abc', submitted_at=long_ago)
+        # host2 has one free slot, the interactive reserve
+        DropqJob.objects.create(run=run, year=1, user_mods='{}',
+                                status=DropqJob.SUBMITTED, hostname='host2',
+                                worker_version='v1', remote_id='def',
+                                submitted_at=timezone.now())
+
+        assert hedge_stragglers() == 0
+
+        DropqJob.objects.filter(pk=straggler.pk).update(priority=DropqJob.INTERACTIVE)
+        assert hedge_stragglers() == 1
+        assert DropqJob.objects.get(hedge_of=straggler).hostname == 'host2'
+
+    @patch('webapp.apps.taxbrain.scheduler.dispatch_pending')
+    def test_trace_id_per_run(self, mock_dispatch):
+        runs = [TaxSaveInputs.objects.create() for _ in range(2)]
+
+        enqueue_runs(runs, [{'_II_em': [4000]}] * 2, DropqJob.BATCH)
+
+        trace_ids = [set(run.dropq_jobs.values_list('trace_id', flat=True))
+                     for run in runs]
+        assert all(len(ids) == 1 and '' not in ids for ids in trace_ids)
+        assert trace_ids[0] != trace_ids[1]
+
+    def test_duration_model(self):
+        # year 0 takes 10 s plus 2 s per changed parameter
+        samples = [(0, size, 10.0 + 2 * size) for size in range(1, 11)]
+        samples.append((1, 5, 30.0))
+
+        model = DurationModel(samples, min_samples=10)
+
+        assert model.predict(0, 20) == 50.0
+        # too few samples for its own line, year 1 uses the overall one
+        assert 1 not in model.years
+        assert model.overall is not None
+        assert DurationModel([]).predict(0, 3) == DEFAULT_JOB_SECONDS
+
+    def test_backlog_seconds(self):
+        run = TaxSaveInputs.objects.create()
+        for year in range(2):
+            DropqJob.objects.create(run=run, year=year, user_mods='{}')
+        DropqJob.objects.create(run=run, year=2, user_mods='{}',
+                                status=DropqJob.SUBMITTED,
+                                submitted_at=timezone.now() - timedelta(seconds=20))
+        DropqJob.objects.create(run=run, year=3, user_mods='{}',
+                                status=DropqJob.SUBMITTED,
+                                submitted_at=timezone.now() - timedelta(seconds=90))
+
+        # two queued jobs, 40 s left of one running job, none of the other
+        assert round(backlog_seconds(DurationModel([]))) == 3 * DEFAULT_JOB_SECONDS - 20
+
+    def test_required_hosts(self):
+        assert required_hosts(0, 4) == 0
+        # 3000 slot-seconds in 300 s needs 10 slots, three hosts of four
+        assert required_hosts(3000, 4, target_seconds=300) == 3
+        assert required_hosts(1, 4, target_seconds=300) == 1
+
+    def test_fetch_spans(self):
+        headers = {'X-Compute-Seconds': '4.5', 'X-Serialize-Seconds': '0.5'}
+
+        spans = dict((s['name'], s) for s in
+                     _fetch_spans(headers, 3, 'host1', 100.0, 2.0, 0.25))
+
+        assert spans['compute']['duration'] == 4.5
+        assert spans['transfer']['duration'] == 1.5
+        assert spans['decode']['duration'] == 0.25
+        assert spans['transfer']['year'] == 3
+        assert spans['transfer']['hostname'] == 'host1'
+        # hosts that don't time their jobs only get transfer and decode
+        assert len(_fetch_spans({}, 0, 'host1', 100.0, 2.0, 0.25)) == 2
+
+
+class WorkerRegistryTests(TestCase):
+
+    def test_version_key(self):
+        caps = {'taxcalc_version': '0.6.0.abcdef', 'dropq_version': '0.1.0.123456',
+                'dataset_version': 'f00ba4'}
+        assert version_key(caps) == '0.6.0.abcdef:0.1.0.123456:f00ba4'
+        assert version_key({}) == UNKNOWN_VERSION
+
+    @patch('webapp.apps.taxbrain.registry.taxcalc_version', '0.6.0.abcdef')
+    @patch('webapp.apps.taxbrain.registry.dropq_version', '0.1.0.123456')
+    def test_is_compatible(self):
+        caps = {'taxcalc_version': '0.6.0.abcdef', 'dropq_version': '0.1.0.123456'}
+        assert is_compatible(caps, enforce=True)
+        assert not is_compatible(dict(caps, dropq_version='0.2.0'), enforce=True)
+        assert not is_compatible({}, enforce=True)
+        assert is_compatible({}, enforce=False)
+        assert not is_compatible(None, enforce=False)
+
+    @patch('webapp.apps.taxbrain.registry._refresh_in_background')
+    @patch('webapp.apps.taxbrain.registry.dropq_capabilities')
+    def test_stale_answers_served(self, mock_probe, mock_refresh):
+        stale = {'host1': {'capacity': 2}}
+        cache.set(CAPABILITY_CACHE_KEY,
+                  (time.time() - DROPQ_CAPABILITY_TTL - 1, stale), None)
+
+        assert host_capabilities() == stale
+
+        assert not mock_probe.called
+        assert mock_refresh.call_count == 1
+
+    @patch('webapp.apps.taxbrain.registry.DROPQ_WORKERS', ['slow', 'fast'])
+    @patch('webapp.apps.taxbrain.registry.DROPQ_PROBE_DEADLINE', 0.2)
+    @patch('webapp.apps.taxbrain.registry.dropq_capabilities')
+    def test_cold_probe_is_bounded(self, mock_probe):
+        mock_probe.side_effect = lambda hostname: time.sleep(
+            2 if hostname == 'slow' else 0) or {}
+        cache.delete(CAPABILITY_CACHE_KEY)
+
+        start = time.time()
+        registry = host_capabilities()
+
+        assert time.time() - start < 1
+        assert registry == {'slow': None, 'fast': {}}
+
+
+class MetricsTests(TestCase):
+
+    def test_render_merges_processes(self):
+        one, two = Registry(buckets=(0.1, 1)), Registry(buckets=(0.1, 1))
+        one.observe('dropq_request_seconds', 0.05, host='h1', op='poll')
+        two.observe('dropq_request_seconds', 0.5, host='h1', op='poll')
+        two.observe('dropq_request_seconds', 5, host='h1', op='poll')
+        one.inc('dropq_requests_total', host='h1', op='poll', outcome='ok')
+        two.inc('dropq_requests_total', 2, host='h1', op='poll', outcome='ok')
+
+        with patch('webapp.apps.taxbrain.metrics.DEFAULT_BUCKETS', (0.1, 1)):
+            text = render_text([one.snapshot(), two.snapshot()],
+                               [('dropq_jobs', {'status': 'queued'}, 7)])
+
+        lines = text.splitlines()
+        assert 'dropq_requests_total{host="h1",op="poll",outcome="ok"} 3' in lines
+        assert 'dropq_request_seconds_bucket{host="h1",op="poll",le="0.1"} 1' in lines
+        assert 'dropq_request_seconds_bucket{host="h1",op="poll",le="1.0"} 2' in lines
+        assert 'dropq_request_seconds_bucket{host="h1",op="poll",le="+Inf"} 3' in lines
+        assert 'dropq_request_seconds_count{host="h1",op="poll"} 3' in lines
+        assert 'dropq_jobs{status="queued"} 7' in lines
+        assert '# TYPE dropq_request_seconds histogram' in lines
+
+    def test_stale_snapshots_removed(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        host = socket.gethostname()
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        files = {
+            'live': '{0}-{1}.json'.format(host, os.getppid()),
+            'dead': '{0}-{1}.json'.format(host, dead.pid),
+            'other_host': 'elsewhere-{0}.json'.format(dead.pid),
+            'old': 'elsewhere-1.json',
+        }
+        for name in files.values():
+            with open(os.path.join(tmp, name), 'w') as f:
+                json.dump(Registry().snapshot(), f)
+        long_ago = time.time() - METRICS_STALE_SECONDS - 1
+        os.utime(os.path.join(tmp, files['old']), (long_ago, long_ago))
+
+        with patch('webapp.apps.taxbrain.metrics.METRICS_DIR', tmp):
+            snapshots = collect()
+
+        assert len(snapshots) == 3
+        assert sorted(os.listdir(tmp)) == sorted([files['live'],
+                                                  files['other_host']])
+
+
+class QueryProfilingTests(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser('staff', 'staff@example.com', 'secret')
+        self.client.login(username='staff', password='secret')
+
+    @patch('webapp.apps.taxbrain.scheduler.usable_hosts',
+           Mock(return_value={'host1': ('v1', 4)}))
+    @override_settings(QUERY_BUDGETS_ENFORCE=True)
+    def test_within_budget(self):
+        run = TaxSaveInputs.objects.create()
+        for year in range(3):
+            DropqJob.objects.create(run=run, year=year, user_mods='{}')
+        DropqJob.objects.create(run=run, year=3, user_mods='{}',
+                                status=DropqJob.SUBMITTED, hostname='host1',
+                                remote_id='abc', submitted_at=timezone.now())
+
+        response = self.client.get('/taxbrain/metrics/')
+
+        assert response.status_code == 200
+        assert 'dropq_hosts 1' in response.content.splitlines()
+        counters = dict(((name, tuple(labels)), value) for name, labels, value
+                        in registry.snapshot()['counters'])
+        assert counters[('taxbrain_view_queries_total', (('view', 'metrics'),))] > 0
+
+    @override_settings(QUERY_BUDGETS_ENFORCE=True,
+                       QUERY_BUDGETS={'metrics': {'queries': 0}})
+    def test_over_budget_fails(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get('/taxbrain/metrics/')
+
+    @override_settings(QUERY_BUDGETS_ENFORCE=True)
+    def test_output_detail_within_budget(self):
+        run = TaxSaveInputs.objects.create(tax_result=synthetic_dropq_results())
+        url = OutputUrl.objects.create(unique_inputs=run)
+
+        # an older run without a taxcalc version is shown, not updated
+        response = self.client.get('/taxbrain/{0}/'.format(url.pk))
+
+        assert response.status_code == 200
+        assert OutputUrl.objects.get(pk=url.pk).taxcalc_vers is None
+
+    @patch('webapp.apps.taxbrain.scheduler.usable_hosts', Mock(return_value={}))
+    @override_settings(QUERY_BUDGETS_ENFORCE=True)
+    def test_tax_results_within_budget(self):
+        # the page a waiting user polls, with the run still queued
+        run = TaxSaveInputs.objects.create()
+        for year in range(3):
+            DropqJob.objects.create(run=run, year=year, user_mods='{}')
+
+        response = self.client.get('/taxbrain/processing/{0}/'.format(run.pk))
+
+        assert response.status_code == 200
+        assert response.context['progress']['queued'] == 3
+
+
+class FinishRunTests(TestCase):
+
+    def setUp(self):
+        self.run = TaxSaveInputs.objects.create()
+        self.job_ids = [('abc', 'host1')]
+
+    @patch('webapp.apps.taxbrain.views.dropq_get_results')
+    def test_finished_once(self, mock_get):
+        mock_get.return_value = synthetic_dropq_results(1)
+
+        first = finish_run(self.run, self.job_ids, None)
+        again = finish_run(TaxSaveInputs.objects.get(pk=self.run.pk),
+                           self.job_ids, None)
+
+        assert mock_get.call_count == 1
+        assert again == first
+        assert first.taxcalc_vers is not None
+        assert OutputUrl.objects.filter(unique_inputs=self.run).count() == 1
+
+    @patch('webapp.apps.taxbrain.views.dropq_get_results')
+    def test_deferred_run_keeps_creation_date(self, mock_get):
+        mock_get.return_value = synthetic_dropq_results(1)
+        default = TaxSaveInputs._meta.get_field('creation_date').default
+        # as the API status views load it
+        deferred = TaxSaveInputs.objects.only('pk', 'batch').get(pk=self.run.pk)
+
+        finish_run(deferred, self.job_ids, None)
+
+        run = TaxSaveInputs.objects.get(pk=self.run.pk)
+        assert run.creation_date != default
+        assert run.tax_result == synthetic_dropq_results(1)
+
+
+class CsvInputTests(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser('staff', 'staff@example.com', 'secret')
+        self.client.login(username='staff', password='secret')
+
+    def test_only_input_fields(self):
+        run = TaxSaveInputs.objects.create()
+        url = OutputUrl.objects.create(unique_inputs=run)
+        RunProfile.objects.create(run=run, kind=RunProfile.JOB, name='year 0',
+                                  data='main 1', samples=1)
+        TraceSpan.objects.create(run=run, trace_id='t1', name='store', year=None,
+                                 hostname='', start=timezone.now(), duration=0.1)
+
+        response = self.client.get('/taxbrain/{0}/input.csv/'.format(url.pk))
+
+        assert response.status_code == 200
+        header = response.content.splitlines()[0].split(',')
+        concrete = set(f.name for f in TaxSaveInputs._meta.concrete_fields)
+        assert set(header) <= concrete
+        assert 'id' not in header and 'profiles' not in header
+        assert 'spans' not in header
+
+
+class TaxResultTests(TestCase):
+
+    def test_round_trip(self):
+        results = synthetic_dropq_results()
+        run = TaxSaveInputs.objects.create(tax_result=results)
+
+        stored = TaxResult.objects.get(run=run)
+        assert len(stored.data) < stored.raw_bytes
+        run = TaxSaveInputs.objects.get(pk=run.pk)
+        assert run.has_result
+        assert run.tax_result == results
+
+    def test_no_result(self):
+        run = TaxSaveInputs.objects.create()
+
+        assert not run.has_result
+        assert TaxSaveInputs.objects.get(pk=run.pk).tax_result is None
+
+
+class RunHistoryTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('staff', 'staff@example.com',
+                                                  'secret')
+        self.client.login(username='staff', password='secret')
+        other = User.objects.create_user('other', password='secret')
+        self.urls = [OutputUrl.objects.create(unique_inputs=TaxSaveInputs.objects.create(),
+                                              user=self.user, revenue_total=float(i))
+                     for i in range(3)]
+        OutputUrl.objects.create(unique_inputs=TaxSaveInputs.objects.create(),
+                                 user=other)
+
+    def test_revenue_total(self):
+        assert revenue_total({'fiscal_tots': ['1.5', 2, '-0.5']}) == 3.0
+        assert revenue_total({}) is None
+
+    @override_settings(QUERY_BUDGETS_ENFORCE=True)
+    def test_keyset_pages(self):
+        first = json.loads(self.client.get('/taxbrain/api/history/?limit=2').content)
+        assert [r['revenue_total'] for r in first['runs']] == [2.0, 1.0]
+        assert first['next'] == '/taxbrain/api/history/?limit=2&before={0}'.format(
+            self.urls[1].pk)
+
+        rest = json.loads(self.client.get(first['next']).content)
+        assert [r['revenue_total'] for r in rest['runs']] == [0.0]
+        assert rest['next'] is None
+
+        page = self.client.get('/taxbrain/history/')
+        assert page.status_code == 200
+        assert len(page.context['runs']) == 3
+
+
+def _busy_loop(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class SamplingProfilerTests(TestCase):
+
+    def test_samples_the_profiled_thread(self):
+        with SamplingProfiler(interval=0.001) as profiler:
+            _busy_loop(0.2)
+
+        assert profiler.samples > 0
+        top = profiler.collapsed().splitlines()[0]
+        assert ':_busy_loop:' in top
+        assert int(top.rsplit(' ', 1)[1]) > 0
+
+    def test_staff_request_profile_is_stored(self):
+        User.objects.create_superuser('staff', 'staff@example.com', 'secret')
+        self.client.login(username='staff', password='secret')
+
+        response = self.client.get('/taxbrain/metrics/', HTTP_X_PROFILE='1')
+        profile = RunProfile.objects.get()
+
+        assert response['X-Profile-Url'] == '/taxbrain/profiles/{0}/'.format(profile.pk)
+        assert profile.kind == RunProfile.REQUEST
+        assert profile.view == 'metrics'
+        download = self.client.get(response['X-Profile-Url'])
+        assert download.content == profile.data.encode('utf-8')
+
+
+class BenchmarkTests(TestCase):
+
+    def test_synthetic_results_render(self):
+        results = synthetic_dropq_results(num_years=3)
+
+        assert results == synthetic_dropq_results(num_years=3)
+        assert len(results['fiscal_tots']) == 3
+        tables = taxcalc_results_to_tables(results)
+        assert len(tables['result_years']) == 3
+        assert len(format_csv(results, 1)) > 3 * 6
+
+    def test_compare_reports(self):
+        baseline = {'results': {'a': {'min': 1.0}, 'b': {'min': 1.0},
+                                'c': {'min': 1.0}}}
+        report = {'results': {'a': {'min': 1.5}, 'b': {'min': 0.5},
+                              'c': {'min': 1.05}, 'new': {'min': 1.0}}}
+
+        rows = dict((row[0], row[4]) for row in
+                    compare_reports(report, baseline, tolerance=0.1))
+
+        assert rows == {'a': 'slower', 'b': 'faster', 'c': 'same'}
+
+
+class FakeDropqHostTests(TestCase):
+
+    def test_year_jobs_round_trip(self):
+        host = FakeDropqHost(latency=0, jitter=0, result_bytes=100).start()
+        try:
+            job_ids = [(dropq_submit_year(host.address, '{}', year), host.address)
+                       for year in range(2)]
+            assert all(dropq_job_ready(host.address, id_) for id_, _ in job_ids)
+
+            results = dropq_get_results(job_ids)
+        finally:
+            host.stop()
+
+        assert len(results['fiscal_tots']) == 2
+        assert host.jobs.counts['/dropq_start_job'] == 2
+
+    def test_missing_year_raises(self):
+        host = FakeDropqHost(latency=0, jitter=0, result_bytes=100).start()
+        try:
+            job_ids = [(dropq_submit_year(host.address, '{}', year), host.address)
+                       for year in range(2)]
+            dropq_get_results(job_ids)
+            # dropq hands out each result once
+            with self.assertRaises(IOError):
+                dropq_get_results(job_ids)
+        finally:
+            host.stop()
+
+    def test_injected_failures(self):
+        host = FakeDropqHost(failure_rate=1.0).start()
+        try:
+            assert dropq_submit_year(host.address, '{}', 0) is None
+        finally:
+            host.stop()
+
+
+class _FakeAsyncResult(object):
+    """
+    A pool job that runs in the test's own process when the test says so
+    """
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = False
+        self.error = None
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+        self.done = True
+
+    def ready(self):
+        return self.done
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class _FakePool(object):
+
+    def __init__(self):
+        self.started = []
+
+    def apply_async(self, func, args):
+        result = _FakeAsyncResult(func, args)
+        self.started.append(result)
+        return result
+
+    def run_all(self):
+        for result in self.started:
+            if not result.ready():
+                result.run()
+
+
+def _fake_year(year_n, user_mods):
+    if any('fail' in mods for mods in user_mods.values()):
+        raise ValueError('bad reform')
+    return {'fiscal_tots': [str(year_n)]}
+
+
+@patch('webapp.apps.taxbrain.dropq_service.run_nth_year', _fake_year)
+class DropqServiceTests(TestCase):
+
+    def setUp(self):
+        self.pool = _FakePool()
+        self.store = DropqJobStore(self.pool, 'v1')
+        _init_pool(self.store.cancelled)
+
+    def tearDown(self):
+        _init_pool(None)
+
+    def test_start_ready_result(self):
+        job_id = self.store.start(3, {2015: {}})
+        assert self.store.ready(job_id) is False
+
+        self.pool.run_all()
+        assert self.store.ready(job_id) is True
+        result = self.store.result(job_id)
+
+        assert result['fiscal_tots'] == ['3']
+        assert result['dataset_version'] == 'v1'
+        assert 'compute_seconds' in result
+        # fetched results are forgotten
+        assert self.store.ready(job_id) is None
+
+    def test_expire(self):
+        old = self.store.start(0, {2015: {}})
+        running = self.store.start(1, {2015: {}})
+        self.pool.started[0].run()
+        long_ago = time.time() - RESULT_TTL_IN_SECONDS - 1
+        for job_id in (old, running):
+            async_result, _, key = self.store.jobs[job_id]
+            self.store.jobs[job_id] = (async_result, long_ago, key)
+
+        self.store.start(2, {2015: {}})
+
+        # only finished jobs expire
+        assert self.store.ready(old) is None
+        assert self.store.ready(running) is False
+
+    def test_cache_hit_skips_pool(self):
+        first = self.store.start(0, {2015: {'_II_em': [4000]}})
+        self.pool.run_all()
+        expected = self.store.result(first)
+
+        again = self.store.start(0, {2015: {'_II_em': [4000]}})
+
+        assert len(self.pool.started) == 1
+        assert self.store.ready(again) is True
+        assert self.store.result(again)['fiscal_tots'] == expected['fiscal_tots']
+        # a profiled job always runs
+        self.store.start(0, {2015: {'_II_em': [4000]}}, profile=True)
+        assert len(self.pool.started) == 2
+
+    def test_cancel_before_start(self):
+        job_id = self.store.start(0, {2015: {}})
+
+        assert self.store.cancel(job_id)
+        self.pool.run_all()
+
+        assert self.pool.started[0].get() is None
+        assert self.store.ready(job_id) is None
+        assert not self.store.cancel('unknown')
+        # the bookkeeping of the skipped job goes with the next expiry
+        self.store.start(1, {2015: {}})
+        assert self.store.cancelled == {}
+
+
+@patch('webapp.apps.taxbrain.dropq_service.run_nth_year', _fake_year)
+class DropqRequestHandlerTests(TestCase):
+
+    def setUp(self):
+        self.pool = _FakePool()
+        self.server = DropqServer(('127.0.0.1', 0), self.pool, 'v1', capacity=2)
+        _init_pool(self.server.jobs.cancelled)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://{0}:{1}'.format(*self.server.server_address)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        _init_pool(None)
+
+    def start_job(self, user_mods):
+        response = requests.post(self.url + '/dropq_start_job',
+                                 data={'year': 0, 'user_mods': json.dumps(user_mods)})
+        assert response.status_code == 200
+        return response.text
+
+    def test_round_trip(self):
+        job_id = self.start_job({2015: {}})
+        query = self.url + '/dropq_query_result?job_id=' + job_id
+        assert requests.get(query).text == 'NO'
+
+        self.pool.run_all()
+        assert requests.get(query).text == 'YES'
+        response = requests.get(self.url + '/dropq_get_result?job_id=' + job_id)
+
+        assert response.status_code == 200
+        assert response.json()['fiscal_tots'] == ['0']
+        assert 'X-Compute-Seconds' in response.headers
+
+    @patch('webapp.apps.taxbrain.dropq_service.run_nth_year',
+           lambda year_n, user_mods: synthetic_year_result(year_n))
+    def test_held_baseline_not_sent(self):
+        cache.clear()
+        host = '{0}:{1}'.format(*self.server.server_address)
+        version = version_key({'taxcalc_version': taxcalc_version,
+                               'dropq_version': dropq_version,
+                               'dataset_version': 'v1'})
+
+        def run(user_mods):
+            job_ids = [(self.start_job(user_mods), host)]
+            self.pool.run_all()
+            return dropq_get_results(job_ids, version=version)
+
+        first = run({2015: {'_II_em': [4000]}})
+        assert cache.get(baseline_cache_key(version, START_YEAR)) is not None
+
+        job_id = self.start_job({2015: {'_II_em': [5000]}})
+        self.pool.run_all()
+        response = requests.get(self.url + '/dropq_get_result',
+                                params={'job_id': job_id, 'baseline': version})
+        assert not any(name in response.json() for name in BASELINE_TABLES)
+        # hosts of another version send them anyway
+        job_id = self.start_job({2015: {'_II_em': [5000]}})
+        response = requests.get(self.url + '/dropq_get_result',
+                                params={'job_id': job_id, 'baseline': 'other'})
+        assert all(name in response.json() for name in BASELINE_TABLES)
+
+        assert run({2015: {'_II_em': [6000]}}) == first
+
+    def test_not_found(self):
+        assert requests.get(self.url + '/nowhere').status_code == 404
+        assert requests.post(self.url + '/nowhere').status_code == 404
+        for path in ('/dropq_query_result', '/dropq_get_result'):
+            assert requests.get(self.url + path + '?job_id=x').status_code == 404
+        assert requests.post(self.url + '/dropq_cancel_job',
+                             data={'job_id': 'x'}).status_code == 404
+
+    def test_failed_job(self):
+        job_id = self.start_job({2015: {'fail': True}})
+        self.pool.run_all()
+
+        response = requests.get(self.url + '/dropq_get_result?job_id=' + job_id)
+
+        assert response.status_code == 500
+
+
+class DropqWireFormatTests(TestCase):
+
+    def test_round_trip(self):
+        result = {'mY_dec': {'perc0-10_3': ['1.5', '2', '-3.25'],
+                             'all_3': ['4.5', '5', '6.00']},
+                  'df_dec': {'all_3': ['1', '12.5%'],
+                             'all_4': ['1.0', 7]},
+                  'fiscal_tots': '1234.5',
+                  'taxcalc_version': '0.1.0.abcdef'}
+
+        ans = decode_year_result(encode_year_result(result))
+
+        assert ans == result
+        assert ans['df_dec']['all_4'][1] == 7
+
+    def test_json_and_binary_merge_the_same(self):
+        years = [synthetic_year_result(n) for n in range(3)]
+        as_json = [json.loads(json.dumps(r)) for r in years]
+        as_binary = [decode_year_result(encode_year_result(r)) for r in years]
+
+        assert merge_dropq_year_results(as_binary) == merge_dropq_year_results(as_json)
+
+    def test_non_numeric_cells_refused(self):
+        with self.assertRaises(ValueError):
+            encode_year_result({'mY_dec': {'all_0': ['n/a']}})
+
+    def test_bad_magic(self):
+        payload = encode_year_result({'fiscal_tots': '1'})
+        with self.assertRaises(ValueError):
+            decode_year_result(b'XXXX' + payload[4:])
+
+
+class DatasetManagerTests(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp_dir, 'source')
+        os.makedirs(self.source_dir)
+        with open(os.path.join(self.source_dir, 'puf.csv.gz'), 'wb') as f:
+            f.write(b'records')
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_install_then_warm_start(self):
+        manager = DatasetManager(self.cache_dir, 'puf.csv.gz',
+                                 LocalSource(self.source_dir))
+        assert manager.current() is None
+
+        path, sha256 = manager.ensure()
+        assert file_checksum(path) == sha256
+        assert sha256[:12] in os.path.basename(path)
+
+        # a second manager finds the installed version without the source
+        warm = DatasetManager(self.cache_dir, 'puf.csv.gz',
+                              LocalSource('/nonexistent'))
+        assert warm.ensure(verify=True) == (path, sha256)
+
+    def test_truncated_file_is_not_current(self):
+        manager = DatasetManager(self.cache_dir, 'puf.csv.gz',
+                                 LocalSource(self.source_dir))
+        path, _ = manager.install()
+        with open(path, 'wb') as f:
+            f.write(b'rec')
+        assert manager.current() is None
+
+    def test_hash_mismatch_not_installed(self):
+        manager = DatasetManager(self.cache_dir, 'puf.csv.gz',
+                                 LocalSource(self.source_dir),
+                                 expected_sha256='0' * 64)
+        with self.assertRaises(IOError):
+            manager.install()
+        assert os.listdir(self.cache_dir) == []
+
+
+def _finish_after(job_id, seconds):
+    time.sleep(seconds)
+    return job_id
+
+
+def _is_mapped(values):
+    while values is not None:
+        if isinstance(values, (np.memmap, mmap.mmap)):
+            return True
+        values = getattr(values, 'base', None)
+    return False
+
+
+class ColumnarCacheTests(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp, 'puf.columns')
+        self.frame = pd.DataFrame({'a': [1.5, 2.5], 'b': [1, 2], 'c': [4., 5.]},
+                                  columns=['a', 'b', 'c'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_loaded_frame_is_mapped(self):
+        build_columnar_cache(self.frame, self.cache_dir, 'sha')
+        loaded = load_columnar_cache(self.cache_dir, 'sha')
+
+        assert loaded.equals(self.frame)
+        assert all(_is_mapped(loaded[name].values) for name in loaded.columns)
+        assert load_columnar_cache(self.cache_dir, 'other') is None
+
+    def test_task_frame_is_copy_on_write(self):
+        build_columnar_cache(self.frame, self.cache_dir, 'sha')
+        resident = load_columnar_cache(self.cache_dir, 'sha')
+        cache = (os.path.realpath(self.cache_dir), 'sha')
+
+        with patch('webapp.apps.taxbrain.tasks.TAX_DTA', resident), \
+                patch('webapp.apps.taxbrain.tasks.TAX_DTA_CACHE', cache):
+            task_frame = task_tax_dta()
+            assert all(_is_mapped(task_frame[name].values)
+                       for name in task_frame.columns)
+            task_frame['a'].values[0] = 9.5
+            task_frame['d'] = task_frame['c'] * 2
+
+            assert resident.equals(self.frame)
+            assert task_tax_dta().equals(self.frame)
+
+    def test_rebuild_switches_link(self):
+        for sha in ('one', 'two', 'three'):
+            build_columnar_cache(self.frame, self.cache_dir, sha)
+
+        assert os.path.islink(self.cache_dir)
+        assert load_columnar_cache(self.cache_dir, 'three').equals(self.frame)
+        # the current version and the one it replaced
+        assert len(os.listdir(self.tmp)) == 3
+
+
+def _sleepy_year(year_n, seconds):
+    time.sleep(seconds)
+    return os.getpid()
+
+
+def _years_in_daemon(results):
+    pool = get_year_pool()
+    start = time.time()
+    pids = pool.map(run_nth_year_args, [(0, 0.5), (1, 0.5)], chunksize=1)
+    elapsed = time.time() - start
+    pool.terminate()
+    pool.join()
+    results.put((len(set(pids)), elapsed))
+
+
+class YearPoolTests(TestCase):
+
+    @patch('webapp.apps.taxbrain.tasks.YEAR_PROCESSES', 2)
+    @patch('webapp.apps.taxbrain.tasks.YEAR_POOL', None)
+    @patch('webapp.apps.taxbrain.tasks.load_tax_dta', Mock())
+    @patch('webapp.apps.taxbrain.tasks.run_nth_year', _sleepy_year)
+    def test_years_run_in_parallel_in_a_daemon(self):
+        # like a task process of Celery's prefork pool
+        results = multiprocessing.Queue()
+        task_process = multiprocessing.Process(target=_years_in_daemon,
+                                               args=(results,))
+        task_process.daemon = True
+        task_process.start()
+        processes, elapsed = results.get(timeout=30)
+        task_process.join(10)
+
+        assert processes == 2
+        assert elapsed < 0.9
+
+
+class GeventWorkerTests(TestCase):
+
+    def setUp(self):
+        self.connection = Mock(spec=StrictRedis)
+        self.queue = Queue('default', connection=self.connection)
+        self.worker = custom_work.GeventWorker([self.queue],
+                                               connection=self.connection,
+                                               pool_size=1, prefetch=True)
+
+    def tearDown(self):
+        self.worker.gevent_pool.kill()
+
+    def _curr_pool_len_writes(self):
+        return len([c for c in self.connection.hset.call_args_list
+                    if c[0][1] == 'curr_pool_len'])
+
+    @patch('custom_work.HEARTBEAT_INTERVAL', 0.01)
+    def test_prefetched_job_returns_to_the_head_on_stop(self):
+        worker = self.worker
+        worker.gevent_pool.spawn(gevent.sleep, 10)
+        prefetched = Mock(id='next', description='next job')
+
+        def dequeue(*args, **kwargs):
+            # the pool is still full when the job is taken
+            assert worker.gevent_pool.full()
+            worker._stopped = True
+            return prefetched, self.queue
+
+        with patch.object(Queue, 'dequeue_any', side_effect=dequeue):
+            with self.assertRaises(StopRequested):
+                worker.dequeue_job_and_maintain_ttl(None)
+
+        self.connection.lpush.assert_called_once_with(self.queue.key, 'next')
+        assert not self.connection.rpush.called
+
+    def test_heartbeats_rate_limited(self):
+        worker = self.worker
+        worker.heartbeat()
+        worker.heartbeat()
+        assert self._curr_pool_len_writes() == 1
+
+        # a job timeout or a change in the pool always goes through
+        worker.heartbeat(timeout=30)
+        worker.gevent_pool.spawn(gevent.sleep, 10)
+        worker.heartbeat()
+        assert self._curr_pool_len_writes() == 3
+
+        later = time.time() + custom_work.HEARTBEAT_INTERVAL + 1
+        with patch('custom_work.time', Mock(**{'time.return_value': later})):
+            worker.heartbeat()
+        assert self._curr_pool_len_writes() == 4
+
+    def test_freed_slot_wakes_the_wait(self):
+        worker = self.worker
+        running = worker.gevent_pool.spawn(gevent.sleep, 0.05)
+        running.link(lambda _: worker.slot_freed.set())
+
+        start = time.time()
+        worker.wait_for_free_slot()
+
+        assert time.time() - start < custom_work.HEARTBEAT_INTERVAL / 2.0
+        assert not worker.gevent_pool.full()
+
+
+class ProcessPoolWorkerTests(TestCase):
+
+    def setUp(self):
+        connection = Mock(spec=StrictRedis)
+        self.queue = Queue('default', connection=connection)
+        self.worker = ProcessPoolWorker([self.queue], connection=connection,
+                                        pool_size=1)
+
+    def test_reaps_on_callback_before_ready(self):
+        # Python 2 runs the callback before the result is marked ready
+        not_ready = Mock(**{'ready.return_value': False})
+        self.worker.in_flight['running'] = (not_ready, Mock(), self.queue)
+        self.worker.job_done('running')
+
+        assert self.worker.reap() == 1
+        assert self.worker.in_flight == {}
+
+    def test_freed_slot_is_refilled_promptly(self):
+        worker = self.worker
+        worker.process_pool = multiprocessing.Pool(1)
+        try:
+            running = worker.process_pool.apply_async(
+                _finish_after, ('running', 0.2), callback=worker.job_done)
+            worker.in_flight['running'] = (running, Mock(), self.queue)
+            next_job = Mock(id='next', description='next job')
+
+            start = time.time()
+            with patch.object(Queue, 'dequeue_any',
+                              return_value=(next_job, self.queue)):
+                job, _ = worker.dequeue_job_and_maintain_ttl(None)
+
+            assert job is next_job
+            assert worker.in_flight == {}
+            assert time.time() - start < REAP_INTERVAL / 2.0
+        finally:
+            worker.process_pool.terminate()
@@ -0,0 +1,99 @@
+"""
+Trace ids and per-stage spans of a run.
+
+Every run gets a trace id when it is submitted. It is stored on each of
+its year jobs and sent as an X-Trace-Id header on every request to the
+dropq hosts about them, which echo it back. The spans of a run are stored
+under its trace id. get_tax_results_async records its spans under the
+trace id found in its task headers, for callers that queue it with one.
+
+As a run finishes its stages are stored as TraceSpan rows:
+
+    queue_wait  a year job waiting in the queue for a dropq slot
+    remote      from submission to the poll that found the job done
+    compute     the dropq computation itself, as timed by the host
+    serialize   encoding the result on the host
+    transfer    fetching the result, less the host's serialize time
+    decode      decoding the result in the webapp
+    store       saving the merged results and the results page
+
+Year job spans carry the year and the host that ran the job. compute and
+serialize are only known for hosts that send X-Compute-Seconds and
+X-Serialize-Seconds with the result, like run_dropq_worker.
+"""
+import datetime
+import uuid
+
+from django.utils import timezone
+
+TRACE_HEADER = 'X-Trace-Id'
+COMPUTE_HEADER = 'X-Compute-Seconds'
+SERIALIZE_HEADER = 'X-Serialize-Seconds'
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def trace_headers(trace_id):
+    """
+    HTTP or Celery headers carrying trace_id, empty without one
+    """
+    return {TRACE_HEADER: trace_id} if trace_id else {}
+
+
+def span(name, duration, year=None, hostname=None, start=None):
+    """
+    A span as collected before it is stored; start is a Unix time
+    """
+    return {'name': name, 'duration': duration, 'year': year,
+            'hostname': hostname, 'start': start}
+
+
+def job_spans(jobs):
+    """
+    queue_wait and remote spans of finished year jobs
+    """
+    spans = []
+    for job in jobs:
+        if job.submitted_at is None:
+            continue
+        spans.append(span('queue_wait',
+                          (job.submitted_at - job.created).total_seconds(),
+                          job.year, job.hostname, job.created))
+        if job.finished_at is not None:
+            spans.append(span('remote',
+                              (job.finished_at - job.submitted_at).total_seconds(),
+                              job.year, job.hostname, job.submitted_at))
+    return spans
+
+
+def store_spans(run_id, trace_id, spans):
+    """
+    Save spans collected for a run
+    """
+    from .models import TraceSpan
+
+    rows = []
+    for s in spans:
+        start = s['start']
+        if isinstance(start, (int, float)):
+            start = datetime.datetime.fromtimestamp(start, timezone.utc)
+        rows.append(TraceSpan(run_id=run_id, trace_id=trace_id or '',
+                              name=s['name'], year=s['year'],
+                              hostname=s['hostname'], start=start,
+                              duration=s['duration']))
+    TraceSpan.objects.bulk_create(rows)
+
+
+def run_trace(run_id):
+    """
+    The trace id and the spans of a run, longest first, for display
+    """
+    from .models import DropqJob, TraceSpan
+
+    trace_id = (DropqJob.objects.filter(run=run_id, hedge_of__isnull=True)
+                .values_list('trace_id', flat=True).first())
+    spans = (TraceSpan.objects.filter(run=run_id).order_by('-duration')
+             .values('name', 'year', 'hostname', 'duration'))
+    return {'trace_id': trace_id, 'spans': list(spans)}
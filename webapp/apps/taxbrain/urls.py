@@ -1,6 +1,9 @@
 from django.conf.urls import patterns, include, url
 
-from .views import personal_results, tax_results, output_detail, csv_input, csv_output, pdf_view
+from .views import (personal_results, tax_results, cancel_run, output_detail, csv_input,
+                    csv_output, pdf_view, api_batch_submit, api_batch_status,
+                    api_run_status, api_sweep_submit, api_sweep_results,
+                    metrics, capacity, run_profile, run_history, api_history)
 
 
 urlpatterns = patterns('',
@@ -9,6 +12,20 @@ urlpatterns = patterns('',
     url(r'^(?P<pk>\d+)/input.csv/$', csv_input, name='csv_input'),
     url(r'^(?P<pk>\d+)/', output_detail, name='output_detail'),
     url(r'^pdf/$', pdf_view),
+    url(r'^history/$', run_history, name='run_history'),
     # Redirect for temporary page.
+    url(r'^processing/(?P<pk>\d+)/cancel/$', cancel_run, name='cancel_run'),
     url(r'^processing/(?P<pk>\d+)/', tax_results, name='tax_results'),
+    # JSON API for programmatic batch submission
+    url(r'^api/batch/$', api_batch_submit, name='api_batch_submit'),
+    url(r'^api/batch/(?P<batch_id>[0-9a-f]{32})/$', api_batch_status,
+        name='api_batch_status'),
+    url(r'^api/runs/(?P<pk>\d+)/$', api_run_status, name='api_run_status'),
+    url(r'^api/sweep/$', api_sweep_submit, name='api_sweep_submit'),
+    url(r'^api/sweep/(?P<batch_id>[0-9a-f]{32})/$', api_sweep_results,
+        name='api_sweep_results'),
+    url(r'^api/history/$', api_history, name='api_history'),
+    url(r'^metrics/$', metrics, name='metrics'),
+    url(r'^capacity/$', capacity, name='capacity'),
+    url(r'^profiles/(?P<pk>\d+)/$', run_profile, name='run_profile'),
 )
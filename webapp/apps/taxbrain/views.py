@@ -1,34 +1,152 @@
 import csv
 import pdfkit
 import json
+import os
 import taxcalc
 import dropq
 import datetime
+import time
 
 from django.core import serializers
 from django.core.context_processors import csrf
 from django.core.exceptions import ValidationError
 from django.contrib.auth.decorators import login_required, permission_required
-from django.http import HttpResponseRedirect, HttpResponse, Http404
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.http import (HttpResponseRedirect, HttpResponse, Http404,
+                         HttpResponseNotAllowed, JsonResponse)
 from django.shortcuts import render, render_to_response, get_object_or_404, redirect
 from django.template import loader, Context
 from django.template.context import RequestContext
+from django.utils.http import urlencode
 from django.utils.translation import ugettext_lazy as _
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import DetailView, TemplateView
 from django.contrib.auth.models import User
 
 from djqscsv import render_to_csv_response
 
 from .forms import PersonalExemptionForm
-from .models import TaxSaveInputs, OutputUrl
+from .models import (TaxSaveInputs, TaxResult, OutputUrl, ReformBatch, DropqJob,
+                     RunProfile)
 from .helpers import (TAXCALC_DEFAULT_PARAMS, taxcalc_results_to_tables, format_csv,
-                      submit_dropq_calculation, dropq_results_ready, dropq_get_results)
+                      dropq_get_results, package_up_vars, worker_data_from_inputs,
+                      expand_sweep_grid, split_baseline_tables, sweep_revenue_table,
+                      revenue_total)
+from .scheduler import (Overloaded, check_admission, enqueue_runs, refresh_runs,
+                        run_job_ids, run_progress, format_wait, cancel_runs,
+                        cancel_abandoned_runs, queue_depth, capacity_report)
+from .metrics import timed, collect, render_text
+from .sampler import profile_requested
+from .tracing import job_spans, span, store_spans, run_trace
 
 
+# Bearer token that lets a metrics scraper in without a staff login
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
 tcversion_info = taxcalc._version.get_versions()
 
 taxcalc_version = ".".join([tcversion_info['version'], tcversion_info['full'][:6]])
 
+# Largest number of reforms accepted in a single batch API request
+MAX_BATCH_REFORMS = 500
+
+# Runs per page of a user's run history, by default and at most
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 200
+
+NO_INPUTS_MESSAGE = "Please specify a tax-law change before submitting."
+
+# Columns of TaxSaveInputs that are not reform inputs, left out of input.csv
+CSV_INPUT_EXCLUDED_FIELDS = ('id', 'inflation', 'inflation_years',
+                             'medical_inflation', 'medical_years',
+                             'creation_date', 'batch')
+
+
+def finish_run(model, job_ids, user):
+    """
+    Fetch the dropq results for a run whose year jobs are all done, store
+    them on the run and create the OutputUrl that displays them.
+
+    Overlapping polls can all see the run done, but dropq hands out each
+    result only once. The run's row stays locked while its results are
+    fetched and stored, so the first caller finishes it and the others
+    wait, then return the OutputUrl it made.
+    """
+    with transaction.atomic():
+        list(TaxSaveInputs.objects.select_for_update().filter(pk=model.pk)
+             .values_list('pk', flat=True))
+        if TaxResult.objects.filter(run=model.pk).exists():
+            return model.outputurl_set.first()
+        return _store_run_results(model, job_ids, user)
+
+def _store_run_results(model, job_ids, user):
+    jobs = list(DropqJob.objects.filter(run=model, hedge_of__isnull=True))
+    trace_id = jobs[0].trace_id if jobs else None
+    # every year of a run goes to hosts of the same version
+    version = jobs[0].worker_version if jobs else None
+    spans = job_spans(jobs)
+    profiles = {}
+    with timed('taxbrain_stage_seconds', stage='fetch_results'):
+        results = dropq_get_results(job_ids, profiles, spans, trace_id, version)
+    # Kept on the jobs for the duration model
+    for s in spans:
+        if s['name'] == 'compute':
+            DropqJob.objects.filter(run=model, year=s['year'],
+                                    hedge_of__isnull=True).update(
+                compute_seconds=s['duration'])
+
+    # Stored on the OutputUrl so run listings need not load the results
+    total = revenue_total(results)
+
+    batch = model.batch if model.batch_id else None
+    if batch is not None and batch.sweep:
+        # Every point of a sweep has the same base plan, keep one copy of
+        # those tables on the batch instead of one per point
+        baseline, results = split_baseline_tables(results)
+        if batch.baseline_result is None:
+            batch.baseline_result = baseline
+            batch.save(update_fields=['baseline_result'])
+
+    store_start = time.time()
+    model.tax_result = results
+    model.creation_date = datetime.datetime.now()
+    # API status views load the run deferred, name the field so it is saved
+    model.save(update_fields=['creation_date'])
+
+    # Only runs submitted with profiling on come back with job profiles
+    RunProfile.objects.bulk_create([
+        RunProfile(run=model, user=user, kind=RunProfile.JOB,
+                   name='year {0}'.format(year), data=data,
+                   samples=sum(int(line.rsplit(' ', 1)[1])
+                               for line in data.splitlines()))
+        for year, data in sorted(profiles.items())])
+
+    unique_url = OutputUrl()
+    unique_url.unique_inputs = model
+    unique_url.user = user
+    unique_url.revenue_total = total
+    unique_url.taxcalc_vers = taxcalc_version
+    unique_url.save()
+
+    spans.append(span('store', time.time() - store_start, start=store_start))
+    store_spans(model.pk, trace_id, spans)
+
+    return unique_url
+
+def full_tax_result(inputs):
+    """
+    Return the results of a run, filling in the base plan tables kept on the
+    batch for parameter sweep points.
+    """
+    results = inputs.tax_result
+    if results is not None and inputs.batch_id:
+        baseline = inputs.batch.baseline_result
+        if baseline:
+            results = dict(results)
+            results.update(baseline)
+    return results
+
 @permission_required('taxbrain.view_inputs')
 def personal_results(request):
     """
@@ -36,30 +154,40 @@ def personal_results(request):
     handles the calculation on the inputs.
     """
     no_inputs = False
+    message = None
     if request.method=='POST':
         # Client is attempting to send inputs, validate as form data
         personal_inputs = PersonalExemptionForm(request.POST)
 
         if personal_inputs.is_valid():
-            model = personal_inputs.save()
+            model = personal_inputs.save(commit=False)
 
             # prepare taxcalc params from TaxSaveInputs model
-            curr_dict = model.__dict__
-
-            for key, value in curr_dict.items():
-                if type(value) == type(unicode()):
-                    curr_dict[key] = [float(x) for x in value.split(',') if x]
+            user_mods = package_up_vars(worker_data_from_inputs(model))
 
-            worker_data ={k:v for k, v in curr_dict.items() if not (v == [] or v == None)}
-
-            # start calc job
-            submitted_ids = submit_dropq_calculation(worker_data)
-            if not submitted_ids:
+            if not user_mods:
                 no_inputs = True
                 form_personal_exemp = personal_inputs
             else:
-                request.session['submitted_ids'] = submitted_ids
-                return redirect('tax_results', model.pk)
+                # a resubmit from the same session supersedes the last run
+                previous = request.session.pop('pending_run', None)
+                if previous is not None:
+                    cancel_runs([previous], user=request.user)
+                cancel_abandoned_runs()
+
+                try:
+                    check_admission(request.user, 1)
+                except Overloaded as e:
+                    message = str(e)
+                    form_personal_exemp = personal_inputs
+                else:
+                    # queue the year jobs ahead of any batch work
+                    model.save()
+                    enqueue_runs([model], [user_mods], DropqJob.INTERACTIVE,
+                                 user=request.user,
+                                 profile=profile_requested(request))
+                    request.session['pending_run'] = model.pk
+                    return redirect('tax_results', model.pk)
 
         else:
             # received POST but invalid results, return to form with errors
@@ -76,9 +204,12 @@ def personal_results(request):
     }
 
     if no_inputs is True:
-        init_context['message'] = "Please specify a tax-law change before submitting."
+        init_context['message'] = NO_INPUTS_MESSAGE
+    elif message is not None:
+        init_context['message'] = message
 
-    return render(request, 'taxbrain/input_form.html', init_context)
+    with timed('taxbrain_stage_seconds', stage='render_input_form'):
+        return render(request, 'taxbrain/input_form.html', init_context)
 
 @permission_required('taxbrain.view_inputs')
 def tax_results(request, pk):
@@ -86,23 +217,44 @@ def tax_results(request, pk):
     This view allows the app to wait for the taxcalc results to be
     returned.
     """
-    submitted_ids = request.session['submitted_ids']
-    if dropq_results_ready(submitted_ids):
-        model = TaxSaveInputs.objects.get(pk=pk)
-        model.tax_result = dropq_get_results(submitted_ids)
-
-        model.creation_date = datetime.datetime.now()
-        model.save()
-
+    model = get_object_or_404(TaxSaveInputs, pk=pk)
+    if model.has_result:
+        unique_url = model.outputurl_set.first()
+        if unique_url is not None:
+            return redirect(unique_url)
+
+    status = refresh_runs([model.pk])[model.pk]
+    if status == DropqJob.DONE:
         current_user = User.objects.get(pk=request.user.id)
-        unique_url = OutputUrl()
-        unique_url.unique_inputs = model
-        unique_url.user = current_user
-        unique_url.save()
+        unique_url = finish_run(model, run_job_ids(model.pk), current_user)
 
         return redirect(unique_url)
 
-    return render_to_response('taxbrain/not_ready.html', {'raw_results':'raw_results'})
+    context = {'raw_results':'raw_results', 'pk': model.pk}
+    if status == DropqJob.FAILED:
+        context['error'] = "The calculation could not be submitted. Please try again."
+    elif status == DropqJob.CANCELLED:
+        context['error'] = "This calculation was cancelled."
+    else:
+        progress = run_progress(model.pk)
+        context['progress'] = progress
+        context['eta'] = format_wait(progress['eta_seconds'])
+        context['eta_start'] = format_wait(progress['eta_start_seconds'])
+    with timed('taxbrain_stage_seconds', stage='render_not_ready'):
+        return render(request, 'taxbrain/not_ready.html', context)
+
+@permission_required('taxbrain.view_inputs')
+def cancel_run(request, pk):
+    """
+    Cancel a run from its processing page and go back to the input form.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    cancel_runs([int(pk)], user=request.user)
+    if request.session.get('pending_run') == int(pk):
+        del request.session['pending_run']
+    return redirect('tax_form')
 
 @permission_required('taxbrain.view_inputs')
 def output_detail(request, pk):
@@ -114,13 +266,11 @@ def output_detail(request, pk):
     except:
         raise Http404
 
-    if url.taxcalc_vers != None:
-        pass
-    else:
+    # Set when the run finishes, older runs show the current version
+    if url.taxcalc_vers is None:
         url.taxcalc_vers = taxcalc_version
-        url.save()
 
-    output = url.unique_inputs.tax_result
+    output = full_tax_result(url.unique_inputs)
     created_on = url.unique_inputs.creation_date
     tables = taxcalc_results_to_tables(output)
     inputs = url.unique_inputs
@@ -133,7 +283,8 @@ def output_detail(request, pk):
         'created_on':created_on
     }
 
-    return render(request, 'taxbrain/results.html', context)
+    with timed('taxbrain_stage_seconds', stage='render_results'):
+        return render(request, 'taxbrain/results.html', context)
 
 @permission_required('taxbrain.view_inputs')
 def csv_output(request, pk):
@@ -150,7 +301,7 @@ def csv_output(request, pk):
     filename = "taxbrain_outputs_" + suffix + ".csv"
     response['Content-Disposition'] = 'attachment; filename="' + filename + '"'
 
-    results = url.unique_inputs.tax_result
+    results = full_tax_result(url.unique_inputs)
     csv_results = format_csv(results, pk)
     writer = csv.writer(response)
     for csv_row in csv_results:
@@ -165,17 +316,9 @@ def csv_input(request, pk):
     except:
         raise Http404
 
-
-    def filter_names(x):
-        """
-        Any of these field names we don't care about
-        """
-        return x not in ['outputurl', 'id', 'inflation', 'inflation_years',
-                         'medical_inflation', 'medical_years', 'tax_result',
-                         'creation_date']
-
-    field_names = [f.name for f in TaxSaveInputs._meta.get_fields(include_parents=False)]
-    field_names = tuple(filter(filter_names, field_names))
+    # Only columns of the run itself, so relations to it never end up here
+    field_names = tuple(f.name for f in TaxSaveInputs._meta.concrete_fields
+                        if f.name not in CSV_INPUT_EXCLUDED_FIELDS)
 
     # Create the HttpResponse object with the appropriate CSV header.
     response = HttpResponse(content_type='text/csv')
@@ -203,3 +346,415 @@ def pdf_view(request):
     response['Content-Disposition'] = 'attachment; filename="tax_results.pdf"'
 
     return response
+
+
+def _api_value(value):
+    """
+    Normalize a reform value from the JSON API into what the form expects:
+    numbers and lists of numbers become comma separated strings.
+    """
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (list, tuple)):
+        return ",".join(str(v) for v in value)
+    return str(value)
+
+def _finished_runs(pks):
+    """
+    The pks among pks of the runs whose results are stored
+    """
+    return set(TaxResult.objects.filter(run__in=pks)
+               .values_list('run_id', flat=True))
+
+def _run_status(request, model, user, job_status, finished):
+    """
+    Report the status of an API run, collecting its results if every year
+    job has finished since the last check. job_status is the run's entry
+    from refresh_runs, finished whether its results were already stored.
+    """
+    status = {
+        'pk': model.pk,
+        'status_url': request.build_absolute_uri(
+            reverse('api_run_status', kwargs={'pk': model.pk})),
+    }
+
+    if not finished:
+        if job_status == DropqJob.FAILED:
+            status['status'] = 'FAILED'
+            return status
+        if job_status == DropqJob.CANCELLED:
+            status['status'] = 'CANCELLED'
+            return status
+        if job_status != DropqJob.DONE:
+            status['status'] = 'PENDING'
+            status.update(run_progress(model.pk))
+            return status
+        unique_url = finish_run(model, run_job_ids(model.pk), user)
+    else:
+        unique_url = model.outputurl_set.first()
+
+    status['status'] = 'DONE'
+    if unique_url is not None:
+        status['results_url'] = request.build_absolute_uri(
+            unique_url.get_absolute_url())
+    if request.user.is_staff:
+        # Where the run spent its time, and on which hosts
+        status['trace'] = run_trace(model.pk)
+    return status
+
+def _json_body(request):
+    """
+    Parse the JSON body of an API POST. Returns (payload, None) on success
+    and (None, error_response) otherwise. Only application/json bodies are
+    accepted, which keeps cross-site form posts out of the CSRF exempt
+    API views.
+    """
+    if request.method != 'POST':
+        return None, HttpResponseNotAllowed(['POST'])
+
+    if request.META.get('CONTENT_TYPE', '').split(';')[0] != 'application/json':
+        return None, JsonResponse({'error': 'Expected an application/json body.'},
+                                  status=415)
+
+    try:
+        return json.loads(request.body), None
+    except ValueError:
+        return None, JsonResponse({'error': 'Malformed JSON.'}, status=400)
+
+def _submit_reforms(request, reforms, sweep=None):
+    """
+    Validate a list of reforms, insert the input rows with a single query
+    and queue their year jobs at batch priority. Each reform maps
+    TaxSaveInputs field names to values.
+    """
+    if len(reforms) > MAX_BATCH_REFORMS:
+        msg = 'At most {0} reforms may be submitted at once.'.format(MAX_BATCH_REFORMS)
+        return JsonResponse({'error': msg}, status=400)
+
+    new_runs = []
+    user_mods_list = []
+    errors = {}
+    for idx, reform in enumerate(reforms):
+        if not isinstance(reform, dict):
+            errors[idx] = {'__all__': ['Each reform must be a JSON object.']}
+            continue
+
+        form = PersonalExemptionForm({k: _api_value(v) for k, v in reform.items()})
+        if not form.is_valid():
+            errors[idx] = {field: [unicode(e) for e in errs]
+                           for field, errs in form.errors.items()}
+            continue
+
+        model = form.save(commit=False)
+        user_mods = package_up_vars(worker_data_from_inputs(model))
+        if not user_mods:
+            errors[idx] = {'__all__': [NO_INPUTS_MESSAGE]}
+            continue
+
+        new_runs.append(model)
+        user_mods_list.append(user_mods)
+
+    if errors:
+        return JsonResponse({'errors': errors}, status=400)
+
+    try:
+        check_admission(request.user, len(new_runs))
+    except Overloaded as e:
+        response = JsonResponse({'error': str(e), 'retry_after': e.retry_after},
+                                status=503)
+        response['Retry-After'] = str(e.retry_after)
+        return response
+
+    batch = ReformBatch.objects.create(user=request.user, sweep=sweep)
+    for model in new_runs:
+        model.batch = batch
+    TaxSaveInputs.objects.bulk_create(new_runs)
+
+    # bulk_create does not set primary keys, read them back in insert order
+    runs = list(batch.runs.order_by('pk').only('pk'))
+    enqueue_runs(runs, user_mods_list, DropqJob.BATCH, user=request.user,
+                 profile=profile_requested(request))
+
+    status_view = 'api_sweep_results' if sweep else 'api_batch_status'
+    runs = [model.pk for model in runs]
+    response = {
+        'batch_id': batch.uuid,
+        'status_url': request.build_absolute_uri(
+            reverse(status_view, kwargs={'batch_id': batch.uuid})),
+        'runs': [{'pk': pk,
+                  'status_url': request.build_absolute_uri(
+                      reverse('api_run_status', kwargs={'pk': pk}))}
+                 for pk in runs],
+    }
+
+    return JsonResponse(response, status=202)
+
+@csrf_exempt
+@permission_required('taxbrain.view_inputs', raise_exception=True)
+def api_batch_submit(request):
+    """
+    Accept a JSON list of reforms, either as the body itself or as
+    {"reforms": [...]}, and submit them all as one batch.
+    """
+    payload, error = _json_body(request)
+    if error is not None:
+        return error
+
+    reforms = payload.get('reforms') if isinstance(payload, dict) else payload
+    if not isinstance(reforms, list) or not reforms:
+        return JsonResponse({'error': 'Expected a non-empty list of reforms.'},
+                            status=400)
+
+    return _submit_reforms(request, reforms)
+
+@csrf_exempt
+@permission_required('taxbrain.view_inputs', raise_exception=True)
+def api_sweep_submit(request):
+    """
+    Accept a parameter sweep: {"base": {...}, "grid": {...}}. The base
+    reform is applied at every point and the grid maps up to two
+    TaxSaveInputs fields to a list of values or a {"start", "stop", "step"}
+    range. All year x point jobs are dispatched together as one batch.
+    """
+    payload, error = _json_body(request)
+    if error is not None:
+        return error
+
+    if not isinstance(payload, dict) or not isinstance(payload.get('grid'), dict):
+        return JsonResponse({'error': 'Expected a JSON object with a grid.'},
+                            status=400)
+
+    base = payload.get('base') or {}
+    grid = payload['grid']
+    unknown = [name for name in grid
+               if name not in PersonalExemptionForm.base_fields]
+    if unknown or not isinstance(base, dict):
+        msg = 'Unknown sweep fields: {0}'.format(", ".join(sorted(unknown)))
+        return JsonResponse({'error': msg}, status=400)
+
+    try:
+        names, points = expand_sweep_grid(grid, max_points=MAX_BATCH_REFORMS)
+    except (ValueError, TypeError, KeyError) as e:
+        return JsonResponse({'error': 'Invalid sweep grid: {0}'.format(e)},
+                            status=400)
+
+    reforms = []
+    for point in points:
+        reform = dict(base)
+        reform.update(zip(names, point))
+        reforms.append(reform)
+
+    sweep = {'params': names, 'points': points}
+    return _submit_reforms(request, reforms, sweep=sweep)
+
+@csrf_exempt
+@permission_required('taxbrain.view_inputs', raise_exception=True)
+def api_batch_status(request, batch_id):
+    """
+    Report the status of every run in a batch, collecting results for any
+    run that has finished. DELETE cancels the unfinished runs of the batch.
+    """
+    if request.method not in ('GET', 'DELETE'):
+        return HttpResponseNotAllowed(['GET', 'DELETE'])
+
+    batch = get_object_or_404(ReformBatch, uuid=batch_id)
+    if request.method == 'DELETE':
+        if batch.user_id != request.user.id:
+            return JsonResponse({'error': 'Not your batch.'}, status=403)
+        cancel_runs(list(batch.runs.values_list('pk', flat=True)))
+
+    runs = list(batch.runs.order_by('pk').only('pk', 'batch'))
+    finished = _finished_runs([model.pk for model in runs])
+    job_status = refresh_runs([model.pk for model in runs
+                               if model.pk not in finished])
+    statuses = [_run_status(request, model, batch.user, job_status.get(model.pk),
+                            model.pk in finished)
+                for model in runs]
+    done = len([s for s in statuses if s['status'] == 'DONE'])
+
+    response = {
+        'batch_id': batch.uuid,
+        'done': done,
+        'total': len(statuses),
+        'runs': statuses,
+    }
+
+    return JsonResponse(response)
+
+@csrf_exempt
+@permission_required('taxbrain.view_inputs', raise_exception=True)
+def api_run_status(request, pk):
+    """
+    Report the status of a single run submitted through the batch API.
+    DELETE cancels the run if it has not finished.
+    """
+    if request.method not in ('GET', 'DELETE'):
+        return HttpResponseNotAllowed(['GET', 'DELETE'])
+
+    queryset = TaxSaveInputs.objects.select_related('batch').only(
+        'pk', 'batch__user')
+    model = get_object_or_404(queryset, pk=pk)
+    user = model.batch.user if model.batch else None
+    if request.method == 'DELETE':
+        if user is None or user.pk != request.user.id:
+            return JsonResponse({'error': 'Not your run.'}, status=403)
+        cancel_runs([model.pk])
+    finished = model.has_result
+    job_status = refresh_runs([model.pk]) if not finished else {}
+
+    return JsonResponse(_run_status(request, model, user, job_status.get(model.pk),
+                                    finished))
+
+@permission_required('taxbrain.view_inputs', raise_exception=True)
+def api_sweep_results(request, batch_id):
+    """
+    Report the progress of a parameter sweep together with the consolidated
+    revenue-vs-parameter table for the points that have finished.
+    """
+    batch = get_object_or_404(ReformBatch, uuid=batch_id, sweep__isnull=False)
+    # Every finished point's results are needed for the table anyway
+    runs = list(batch.runs.order_by('pk').select_related('result')
+                .only('pk', 'batch'))
+    finished = set(model.pk for model in runs if model.tax_result is not None)
+    job_status = refresh_runs([model.pk for model in runs
+                               if model.pk not in finished])
+    statuses = [_run_status(request, model, batch.user, job_status.get(model.pk),
+                            model.pk in finished)
+                for model in runs]
+
+    point_results = [model.tax_result for model in runs]
+    table = sweep_revenue_table(batch.sweep['params'], batch.sweep['points'],
+                                point_results)
+
+    response = {
+        'batch_id': batch.uuid,
+        'done': len([s for s in statuses if s['status'] == 'DONE']),
+        'total': len(statuses),
+        'runs': statuses,
+        'table': table,
+    }
+
+    return JsonResponse(response)
+
+def _history_page(request):
+    """
+    One page of the runs of the current user, newest first. Pages are
+    keyed on the pk of the last run shown, passed back as ?before=<pk>, so
+    every page costs the same index range scan however far back it is.
+    Only the columns the listing shows are loaded; revenue_total stands in
+    for the results. Returns (runs, next_before), next_before None on the
+    last page.
+    """
+    try:
+        limit = int(request.GET.get('limit', HISTORY_PAGE_SIZE))
+        before = request.GET.get('before')
+        before = int(before) if before else None
+    except ValueError:
+        raise ValidationError("limit and before must be integers.")
+    limit = min(max(limit, 1), MAX_HISTORY_PAGE_SIZE)
+
+    runs = (OutputUrl.objects.filter(user=request.user)
+            .select_related('unique_inputs')
+            .only('pk', 'uuid', 'taxcalc_vers', 'revenue_total', 'unique_inputs',
+                  'unique_inputs__creation_date')
+            .order_by('-pk'))
+    if before is not None:
+        runs = runs.filter(pk__lt=before)
+    runs = list(runs[:limit + 1])
+    if len(runs) > limit:
+        runs = runs[:limit]
+        return runs, runs[-1].pk
+    return runs, None
+
+def _history_url(name, next_before, request):
+    if next_before is None:
+        return None
+    query = [('before', next_before)]
+    if 'limit' in request.GET:
+        query.insert(0, ('limit', request.GET['limit']))
+    return "{0}?{1}".format(reverse(name), urlencode(query))
+
+@permission_required('taxbrain.view_inputs')
+def run_history(request):
+    """
+    The runs of the current user, newest first, with their budget window
+    revenue totals.
+    """
+    try:
+        runs, next_before = _history_page(request)
+    except ValidationError:
+        raise Http404
+    context = {
+        'runs': runs,
+        'next_url': _history_url('run_history', next_before, request),
+    }
+    with timed('taxbrain_stage_seconds', stage='render_history'):
+        return render(request, 'taxbrain/history.html', context)
+
+@permission_required('taxbrain.view_inputs', raise_exception=True)
+def api_history(request):
+    """
+    The runs of the current user as JSON, newest first. "next" is the URL
+    of the following page, null on the last one.
+    """
+    try:
+        runs, next_before = _history_page(request)
+    except ValidationError as e:
+        return JsonResponse({'error': e.messages[0]}, status=400)
+    response = {
+        'runs': [{
+            'url': url.get_absolute_url(),
+            'uuid': url.uuid,
+            'run_id': url.unique_inputs_id,
+            'created': url.unique_inputs.creation_date,
+            'taxcalc_version': url.taxcalc_vers,
+            'revenue_total': url.revenue_total,
+        } for url in runs],
+        'next': _history_url('api_history', next_before, request),
+    }
+    return JsonResponse(response)
+
+def run_profile(request, pk):
+    """
+    Download a sampled profile in the collapsed stack format, for
+    flamegraph.pl or speedscope. Staff only.
+    """
+    if not request.user.is_staff:
+        return HttpResponse('Forbidden', status=403, content_type='text/plain')
+    profile = get_object_or_404(RunProfile, pk=pk)
+    response = HttpResponse(profile.data, content_type='text/plain')
+    response['Content-Disposition'] = (
+        'attachment; filename="taxbrain_profile_{0}.txt"'.format(profile.pk))
+    return response
+
+def _metrics_allowed(request):
+    auth = request.META.get('HTTP_AUTHORIZATION', '')
+    token_ok = bool(METRICS_TOKEN) and auth == 'Bearer ' + METRICS_TOKEN
+    return token_ok or request.user.is_staff
+
+def capacity(request):
+    """
+    The year job duration model, the backlog and the number of dropq hosts
+    needed to clear it, as JSON for an autoscaler. ?reform_size=n sets the
+    reform size of the new run ETA. Same access as the metrics page.
+    """
+    if not _metrics_allowed(request):
+        return JsonResponse({'error': 'Forbidden'}, status=403)
+    try:
+        reform_size = int(request.GET.get('reform_size', 1))
+    except ValueError:
+        return JsonResponse({'error': 'reform_size must be an integer.'},
+                            status=400)
+    return JsonResponse(capacity_report(reform_size))
+
+def metrics(request):
+    """
+    Timers, counters and queue depth of every TaxBrain process, in the
+    Prometheus text format. Open to staff and to requests carrying
+    "Authorization: Bearer <METRICS_TOKEN>".
+    """
+    if not _metrics_allowed(request):
+        return HttpResponse('Forbidden', status=403, content_type='text/plain')
+
+    body = render_text(collect(), queue_depth())
+    return HttpResponse(body, content_type='text/plain; version=0.0.4')
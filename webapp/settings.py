@@ -73,8 +73,35 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'webapp.apps.taxbrain.sampler.SamplingProfilerMiddleware',
+    'webapp.apps.taxbrain.profiling.QueryProfilingMiddleware',
 )
 
+# Share of requests whose queries and cache lookups are profiled
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.01))
+
+# Profile every request and fail the ones over their query budget
+QUERY_BUDGETS_ENFORCE = os.environ.get('QUERY_BUDGETS_ENFORCE', 'False') == 'True'
+
+# Most queries and writes per request, by url name
+QUERY_BUDGETS = {
+    'tax_form': {'queries': 30},
+    'tax_results': {'queries': 20},
+    'output_detail': {'queries': 15, 'writes': 0},
+    'csv_output': {'queries': 8, 'writes': 0},
+    'csv_input': {'queries': 8, 'writes': 0},
+    'metrics': {'queries': 8, 'writes': 0},
+    'capacity': {'queries': 10, 'writes': 0},
+    'run_history': {'queries': 8, 'writes': 0},
+    'api_history': {'queries': 8, 'writes': 0},
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'webapp.apps.taxbrain.profiling.ProfilingLocMemCache',
+    }
+}
+
 ROOT_URLCONF = 'webapp.urls'
 
 WSGI_APPLICATION = 'webapp.wsgi.application'
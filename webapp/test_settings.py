@@ -0,0 +1,7 @@
+"""
+Settings for the test suite: the production settings with the query
+budgets enforced, so a view going over its budget fails its tests.
+"""
+from .settings import *
+
+QUERY_BUDGETS_ENFORCE = True